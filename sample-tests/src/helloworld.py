@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import argparse
 import sys
+import time
 
 
 def print_hello_world(args):
@@ -12,6 +13,13 @@ def print_hello_world(args):
     if args.stderr:
         outfile = sys.stderr
 
+    if args.split:
+        # Write the line in two parts, pausing between them.
+        first, rest = msg.split(" ", 1)
+        print(first, end="", file=outfile, flush=True)
+        time.sleep(0.5)
+        msg = " " + rest
+
     print(msg, file=outfile)
 
 
@@ -28,6 +36,11 @@ if __name__ == "__main__":
     parser.add_argument(
         "--stderr", action="store_true", help="Prints to stderr instead"
     )
+    parser.add_argument(
+        "--split",
+        action="store_true",
+        help="Pauses partway through printing the line",
+    )
     parser.add_argument(
         "--returncode", type=int, help="Exits with the given code after printing"
     )
@@ -127,6 +127,17 @@ class LibmarksSampleTests(marks.TestCase):
         proc = self.process([self.helloworld, "--lower", "--stderr"])
         self.assert_stderr(proc, "HELLO world\n")
 
+    @marks.marks(category="readline-check", category_marks=5)
+    def test_readlineTimeoutPartial(self):
+        """
+        Check that a line partly read when a readline times out
+        is read in full afterwards
+        """
+        proc = self.process([self.helloworld, "--split"])
+        if proc.readline_stdout_timeout(0.1) is not None:
+            self.fail("Line read before it was complete")
+        self.assert_stdout(proc, "HELLO world\n")
+
     @marks.marks(category="return-code-check", category_marks=5)
     def test_returnCodeMatch(self):
         """
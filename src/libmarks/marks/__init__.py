@@ -7,9 +7,16 @@ Based on Python unittest framework.
 __all__ = [
     "__version__",
     "ignore_result",
+    "fixture_process",
+    "performance_sensitive",
     "main",
     "marks",
     "Process",
+    "InputData",
+    "ProcessTable",
+    "OutputCapture",
+    "MockServer",
+    "MockClient",
     "TestCase",
     "TestSuite",
     "TestLoader",
@@ -20,9 +27,13 @@ __all__ = [
 ]
 
 from .version import get_version
-from .procs import xProcess, xTracedProcess, xTimeoutProcess, ExplainProcess
+from .procs import xProcess, xTracedProcess, xTimeoutProcess, ExplainProcess, InputData
 from .process import set_ld_preload, get_ld_preload
-from .case import TestCase, marks, ignore_result
+from .proctree import ProcessTable
+from .capture import OutputCapture
+from .mock import MockServer, MockClient
+from .case import TestCase, marks, ignore_result, performance_sensitive
+from .fixtures import fixture_process
 from .suite import TestSuite
 from .loader import TestLoader, default_test_loader
 from .result import TestResult
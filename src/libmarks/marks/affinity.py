@@ -0,0 +1,97 @@
+import contextlib
+import multiprocessing as mp
+import os
+from .process import set_cpu_affinity
+
+# Plan shared with this marking worker, if CPUs are being pinned.
+_plan = None
+
+
+def _available_cpus():
+    """Get the CPUs this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return []
+
+
+class AffinityPlan(object):
+
+    """Placement of marking workers onto disjoint sets of CPUs.
+
+    The available CPUs are split into a contiguous set for each worker, with
+    some optionally held back for tests marked as performance sensitive,
+    which are then given a CPU to themselves. A worker, and every process it
+    starts, only runs on its own set.
+    """
+
+    def __init__(self, workers, reserved=0, cpus=None):
+        cpus = sorted(cpus) if cpus is not None else _available_cpus()
+        # Always leave at least one CPU for the workers.
+        reserved = max(min(reserved, len(cpus) - 1), 0)
+        shared = cpus[: len(cpus) - reserved]
+
+        self.reserved_cpus = cpus[len(shared) :]
+        """CPUs kept for performance sensitive tests"""
+        self.worker_cpus = []
+        """Set of CPUs for each worker"""
+        for i in range(workers):
+            if shared and workers > len(shared):
+                # More workers than CPUs, so workers must share.
+                self.worker_cpus.append([shared[i % len(shared)]])
+            elif shared:
+                start = i * len(shared) // workers
+                end = (i + 1) * len(shared) // workers
+                self.worker_cpus.append(shared[start:end])
+
+        # Sets (and reserved CPUs) not in use, shared between the workers.
+        self._free_sets = mp.Queue()
+        for i in range(len(self.worker_cpus)):
+            self._free_sets.put(i)
+        self._free_reserved = mp.Queue()
+        for cpu in self.reserved_cpus:
+            self._free_reserved.put(cpu)
+
+
+def init_worker(plan):
+    """Pool initializer, giving each worker the plan to pin itself with."""
+    global _plan
+    _plan = plan
+
+
+@contextlib.contextmanager
+def pinned_worker():
+    """Pin this worker (and so all processes it starts) to a free set of
+    CPUs while marking. Does nothing if CPUs are not being pinned.
+    """
+    if _plan is None or not _plan.worker_cpus:
+        yield
+        return
+
+    index = _plan._free_sets.get()
+    original = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, _plan.worker_cpus[index])
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, original)
+        _plan._free_sets.put(index)
+
+
+def reserve_cpu():
+    """Run processes started from now on on a reserved CPU, which no other
+    process being marked uses, waiting for one to be free.
+    Returns the CPU, or None if no CPUs are reserved.
+    """
+    if _plan is None or not _plan.reserved_cpus:
+        return None
+    cpu = _plan._free_reserved.get()
+    set_cpu_affinity([cpu])
+    return cpu
+
+
+def release_cpu(cpu):
+    """Release a CPU from reserve_cpu, for use by other tests."""
+    if cpu is None:
+        return
+    set_cpu_affinity([])
+    _plan._free_reserved.put(cpu)
@@ -0,0 +1,101 @@
+import bisect
+import re
+
+
+class OutputCapture(object):
+
+    """The complete output of a process stream, indexed by line.
+
+    The output is read once, and the offset of each line is recorded as it is
+    read, so lines can be accessed directly and the output searched any number
+    of times without reading or copying it again.
+
+    Lines are returned as strings, including their newline character (as
+    with readline). Searches are performed on the raw bytes of the output,
+    and patterns given as strings are compiled with re.MULTILINE.
+    """
+
+    def __init__(self, data, offsets, encoding="utf-8"):
+        self.data = data
+        """The raw bytes of the output"""
+        self.encoding = encoding
+        # Start of each line, followed by the end of the output.
+        self._offsets = memoryview(offsets).cast("q")
+        self._text = None
+
+    def __len__(self):
+        """Number of lines in the output."""
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        """Get a line, or a list of lines from a slice."""
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("line index out of range")
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return self.data[start:end].decode(self.encoding, errors="replace")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __contains__(self, text):
+        """Check if text appears anywhere in the output."""
+        return self._encode(text) in self.data
+
+    @property
+    def text(self):
+        """The output, as a string."""
+        if self._text is None:
+            self._text = self.data.decode(self.encoding, errors="replace")
+        return self._text
+
+    def _encode(self, text):
+        if isinstance(text, str):
+            return text.encode(self.encoding)
+        return text
+
+    def _compile(self, pattern):
+        if isinstance(pattern, re.Pattern):
+            if isinstance(pattern.pattern, str):
+                flags = pattern.flags & ~re.UNICODE
+                pattern = re.compile(self._encode(pattern.pattern), flags)
+            return pattern
+        return re.compile(self._encode(pattern), re.MULTILINE)
+
+    def line_number(self, offset):
+        """Get the (zero based) line containing the given byte offset."""
+        return bisect.bisect_right(self._offsets, offset, 0, len(self)) - 1
+
+    def find(self, text, start=0):
+        """Get the line number of the first line (from line start onwards)
+        containing text, or -1 if it does not appear.
+        """
+        if start >= len(self):
+            return -1
+        offset = self.data.find(self._encode(text), self._offsets[start])
+        if offset == -1:
+            return -1
+        return self.line_number(offset)
+
+    def search(self, pattern):
+        """Find the first match of a regular expression in the output.
+        Returns the match (against bytes) or None.
+        """
+        return self._compile(pattern).search(self.data)
+
+    def matching_lines(self, pattern):
+        """Get the line numbers of all lines matching a regular expression."""
+        lines = []
+        for match in self._compile(pattern).finditer(self.data):
+            line = self.line_number(match.start())
+            if not lines or lines[-1] != line:
+                lines.append(line)
+        return lines
+
+    def count(self, pattern):
+        """Count the lines matching a regular expression."""
+        return len(self.matching_lines(pattern))
@@ -3,16 +3,63 @@ import contextlib
 import sys
 import os
 import inspect
-import difflib
 import time
 import pathlib
+import signal
+import re
+import statistics
 
 from .result import TestResult
-from .util import strclass, safe_repr, coloured_text
-from .procs import xProcess, xTimeoutProcess, xTracedProcess, ExplainProcess
-
-
-BUFFER_SIZE = 8 * 1024
+from .util import strclass, safe_repr, coloured_text, open_fds
+from .util import listening_ports, port_accepts, protection_library
+from .procs import xProcess, xTimeoutProcess, xTracedProcess, ExplainProcess, InputData
+from .proctree import ProcessTable
+from .fixtures import fixture_processes
+from .affinity import reserve_cpu, release_cpu
+from .ports import reserve_port, release_port, held_fds as port_fds
+from .load import generate_load
+from .similarity import match_ratio, MAX_COST
+from .expected import expected_file, files_equal, held_fds
+from .diff import diff_files, diff_stream, DIFF_CONTEXT, DIFF_HUNKS
+from .mock import MockServer, MockClient
+from .process import set_child_subreaper, PatternSet
+from .process import wait_for_file as _wait_for_file
+from .process import create_network_namespace, set_network_namespace
+from .process import set_perf_counters, set_ld_preload, get_ld_preload
+
+
+# Interval (seconds) between checks when waiting for a condition.
+POLL_INTERVAL = 0.01
+
+# Most distinct lines to report when output lines are compared in any order.
+MAX_REPORTED_LINES = 10
+
+# Environment variables speeding up time in the protection library.
+TIME_SCALE_ENV = "MARKS_TIME_SCALE"
+TIME_EPOCH_ENV = "MARKS_TIME_EPOCH"
+
+# Name and units of each measure in the result of process.usage(), followed
+# by the instructions counted by process.perf_counters().
+USAGE_MEASURES = (
+    ("CPU time", "seconds"),
+    ("peak memory", "bytes"),
+    ("wall time", "seconds"),
+    ("instructions", "instructions"),
+)
+_INSTRUCTIONS = 3
+
+# Instructions assumed to be retired per second of CPU time, when limiting
+# instructions without hardware counters.
+FALLBACK_INSTRUCTION_RATE = 1e9
+
+
+def _format_usage(value, units):
+    """Format a measure of resource usage for a message."""
+    if units == "bytes":
+        return f"{value / 2**20:.1f} MiB"
+    if units == "instructions":
+        return f"{value:,.0f} instructions"
+    return f"{value:.3f}s"
 
 
 def marks(category, mark=None, category_marks=None):
@@ -37,6 +84,14 @@ def ignore_result(test_item):
     return test_item
 
 
+def performance_sensitive(test_item):
+    """Mark a test as sensitive to timing, so when marking with reserved
+    CPUs (-o reserve_cpus=N), its processes are given a CPU to themselves.
+    """
+    test_item.__marks_performance_sensitive__ = True
+    return test_item
+
+
 class _TestWrapper(object):
     def __init__(self):
         self.success = True
@@ -69,6 +124,29 @@ class TestCase(object):
     """Class for a Process"""
     timeout = None
     """Timeout duration, in seconds"""
+    idle_timeout = None
+    """Time (in seconds) a process may make no progress before it is stopped,
+    rather than waiting for the full timeout (None to disable)"""
+    fd_budget = None
+    """Maximum file descriptors a test may hold open at once (None for no limit)"""
+    cache_process_table = False
+    """Whether to reuse one snapshot of /proc for the duration of a test"""
+    sweep_leaked_processes = True
+    """Whether to kill processes started by a test that outlive it"""
+    isolate_network = False
+    """Whether to run the processes of each test in their own network
+    namespace, with only a loopback interface"""
+    count_instructions = False
+    """Whether to count the instructions (and cache misses) of processes with
+    hardware counters, for process.perf_counters()"""
+    fuzzy_mode = None
+    """Way outputs are compared for partial marks when fuzzy matching: "chars"
+    (characters in common), "lines" (lines in common, in order), "bytes"
+    (byte sequences in common), or None for the fuzzy_mode option (chars by
+    default)"""
+    time_scale = None
+    """Factor to speed up time by for processes (sleeps, timeouts, alarms
+    and clocks), or None to run them in real time"""
 
     def __init__(self, test_method_name="run_test", timeout=None):
         try:
@@ -94,8 +172,33 @@ class TestCase(object):
         self._process_count = 0
         self._processes = []
 
+        # Keep track of file descriptors used within a test.
+        self._baseline_fds = set()
+        self._process_fds = {}
+
+        # Snapshot of processes on the system, if cached for the test.
+        self._process_table = None
+
+        # Descendants that existed before the test, which it does not own.
+        self._baseline_pids = set()
+
+        # Ports reserved by the test, released when it finishes.
+        self._ports = []
+
+        # Process holding the network namespace of the test, if isolated,
+        # and the descriptors held open to join it.
+        self._network_pid = None
+        self._network_fds = set()
+
+        # Mock servers and clients of the test, closed when it finishes.
+        self._mocks = []
+
+        # Moment from which time is sped up for processes of the test.
+        self._time_epoch = None
+
         # Dict to collect information about tests.
         self.__details = {}
+        self.__per_test_details = set()
 
     def setup(self):
         pass
@@ -163,7 +266,31 @@ class TestCase(object):
         print(text, **kwargs)
 
     def process(self, argv, input_file=None, *args, **kwargs):
-        """Create a Process of the type specified for this test case"""
+        """Create a Process of the type specified for this test case
+
+        By default, the output of the process is read through pipes. Use
+        capture="file" for non-interactive processes whose output is only
+        checked once they finish: stdout and stderr are then written to
+        anonymous files, so the process never blocks on a slow reader, and
+        reading or comparing the output waits for the process to exit.
+
+        Input can be given as a file path (input_file), or generated in the
+        test and given as input_data: str, bytes, any buffer, or an
+        InputData to share the same input between several processes.
+
+        With a timeout, idle_timeout (in seconds) stops a process early if it
+        uses no CPU and reads or writes nothing for that long, or is blocked
+        reading its input while the test waits on its output.
+
+        time_scale speeds up time for the process (overriding the time_scale
+        of the test case): its sleeps, alarms and timeouts take that many
+        times less real time, while its clocks run that many times faster,
+        so its timing relative to other processes is kept. This requires the
+        protection library, which is preloaded if no other library is.
+        """
+        # Keep the arguments, so the process can be run again.
+        spawn_args = (list(argv), input_file, args, dict(kwargs))
+
         # Add the timeout to the init args.
         if self.timeout:
             kwargs.setdefault("timeout", self.timeout)
@@ -172,6 +299,22 @@ class TestCase(object):
         if kwargs.get("timeout") is not None and not isinstance(kwargs["timeout"], int):
             raise ValueError("Process timeout must be an integer.")
 
+        # Stop stalled processes early, if enabled.
+        if self.idle_timeout:
+            kwargs.setdefault("idle_timeout", self.idle_timeout)
+
+        time_scale = kwargs.pop("time_scale", self.time_scale)
+
+        # Hold generated input in memory, rather than in a file.
+        input_data = kwargs.pop("input_data", None)
+        temporary_input = None
+        if input_data is not None:
+            if input_file is not None:
+                raise ValueError("Only one of input_file or input_data may be set.")
+            if not isinstance(input_data, InputData):
+                input_data = temporary_input = InputData(input_data)
+            kwargs["input_file"] = input_data.path
+
         # Include the input file if it is set.
         if input_file is not None:
             kwargs["input_file"] = input_file
@@ -179,12 +322,29 @@ class TestCase(object):
         if self.option("explain"):
             # Ensure a real process is not created in export mode.
             self.process_class = ExplainProcess
+        elif self.fd_budget is not None:
+            self._check_fd_budget()
+            fds_before = open_fds()
 
         # Instantiate the new process.
-        p = self.process_class(argv, *args, **kwargs)
+        with self._scaled_time(time_scale):
+            p = self.process_class(argv, *args, **kwargs)
+
+        if temporary_input is not None:
+            # The process has its own copy of the input open by now.
+            temporary_input.close()
 
         # Store the process count on the process.
         p.count = self._process_count
+        p.spawn_args = spawn_args
+
+        if self.fd_budget is not None and not self.option("explain"):
+            # Record the descriptors held for the new process. Any of these
+            # recorded for earlier processes have since been closed and reused.
+            new_fds = open_fds() - fds_before
+            for _, fds in self._process_fds.values():
+                fds -= new_fds
+            self._process_fds[p.count] = (argv[:], new_fds)
 
         # Increment the process count, ready for the next process.
         self._process_count += 1
@@ -206,12 +366,47 @@ class TestCase(object):
             print(f"\t{' '.join(argv)}", end="")
             if input_file is not None:
                 print(f" < {input_file}", end="")
+            elif input_data is not None:
+                print(f" < (generated input, {input_data.size} bytes)", end="")
             print(f" > {self._stdout_filename(p)} 2> {self._stderr_filename(p)}")
 
         return p
 
+    def _check_fd_budget(self, spawning=True):
+        """Fail the test if it holds more descriptors than its budget (or,
+        when spawning a process, if it has none left to spare).
+
+        The failure lists the descriptors still held by each process, so the
+        process that should have been closed can be found.
+        """
+        open_now = open_fds()
+        held = open_now - self._baseline_fds - held_fds() - self._network_fds
+        held -= port_fds()
+        if len(held) < self.fd_budget or (
+            not spawning and len(held) == self.fd_budget
+        ):
+            return
+
+        msg = (
+            f"file descriptor budget exceeded: {len(held)} open "
+            f"(budget {self.fd_budget})"
+        )
+        unowned = set(held)
+        for p in self._processes:
+            argv, fds = self._process_fds.get(p.count, ([], set()))
+            fds = fds & open_now
+            unowned -= fds
+            if fds:
+                command = " ".join(argv)
+                msg += f"\n{' ' * 8}Process {p.count} ({command}): {len(fds)} open"
+        if unowned:
+            msg += f"\n{' ' * 8}Not held by a process: {len(unowned)} open"
+        self.fail(msg)
+
     def _cleanup_processes(self):
-        """Attempt to kill all processes started within a test"""
+        """Attempt to kill all processes started within a test, and release
+        the resources they hold.
+        """
         if self.option("explain"):
             # Do not cleanup, as no processes are running.
             return
@@ -224,6 +419,63 @@ class TestCase(object):
                 # This is most likely due to the process already
                 # being dead, so ignore.
                 pass
+            p.close()
+
+        self._processes = []
+        self._process_fds = {}
+
+    def _sweep_enabled(self):
+        """Check if leaked processes can and should be swept after a test."""
+        return (
+            self.sweep_leaked_processes
+            and not self.option("explain")
+            and os.path.isdir("/proc/self")
+        )
+
+    def _sweep_processes(self, result):
+        """Kill and reap any descendants started during the test that are still
+        running, such as those that called setsid() or double forked.
+
+        Orphaned descendants are adopted by this process (as a subreaper), so
+        they can be found even after their parent has exited.
+        """
+        table = ProcessTable()
+
+        # Fixture processes (and their descendants) outlive tests by design,
+        # including those first started during this test.
+        exempt = set(self._baseline_pids)
+        for fixture in fixture_processes(self.__class__):
+            pid = fixture.pid(self.__class__)
+            if pid is not None:
+                exempt.add(pid)
+                exempt.update(p.pid for p in table.descendants(pid))
+
+        leaked = [
+            p for p in table.descendants(os.getpid()) if p.pid not in exempt
+        ]
+        if not leaked:
+            return
+
+        for p in leaked:
+            try:
+                os.kill(p.pid, signal.SIGKILL)
+            except OSError:
+                # Process has already exited.
+                pass
+
+        # Reap parents before children, as each child is adopted by this
+        # process once its parent has exited.
+        for p in leaked:
+            try:
+                os.waitpid(p.pid, 0)
+            except OSError:
+                # Not a child of this process, so cannot be reaped here.
+                pass
+
+        # Record the leaked processes against the test, for the results.
+        leaked_processes = result.get_details().get("leaked processes", {})
+        leaked_processes[self.id()] = [f"{p.name} ({p.pid})" for p in leaked]
+        self.add_detail("leaked processes", leaked_processes)
 
     def run(self, result=None, **kwargs):
         original_result = result
@@ -237,17 +489,43 @@ class TestCase(object):
         if not ignored:
             result.start_test(self)
 
+        # Restart any shared processes that died during an earlier test.
+        for fixture in fixture_processes(self.__class__):
+            fixture.check(self.__class__)
+
         # Reset count for processes within test
         self._process_count = 0
         self._processes = []
+        self._process_fds = {}
+        self._process_table = None
+
+        # Record descriptors open before the test, which it does not own.
+        if self.fd_budget is not None and not self.option("explain"):
+            self._baseline_fds = open_fds()
+
+        # Record processes running before the test, which it does not own.
+        if self._sweep_enabled():
+            set_child_subreaper()
+            table = ProcessTable()
+            self._baseline_pids = {p.pid for p in table.descendants(os.getpid())}
 
         # Reset information collected for this test.
         self.__details = {}
+        self.__per_test_details = set()
+
+        # Give the processes of a timing sensitive test a CPU to themselves.
+        cpu = None
+        if getattr(self.test_method, "__marks_performance_sensitive__", False):
+            if not self.option("explain"):
+                cpu = reserve_cpu()
 
         wrapper = _TestWrapper()
         try:
             # Perform setup.
             with wrapper.test_executer(self):
+                if self.isolate_network and not self.option("explain"):
+                    self._isolate_network()
+                set_perf_counters(bool(self.count_instructions))
                 self.setup()
 
             if wrapper.success:
@@ -255,6 +533,10 @@ class TestCase(object):
                 with wrapper.test_executer(self, is_test=True):
                     self.test_method()
 
+                    # Check for descriptors leaked after the last process.
+                    if self.fd_budget is not None and not self.option("explain"):
+                        self._check_fd_budget(spawning=False)
+
                 # Perform tear down.
                 with wrapper.test_executer(self):
                     self.tear_down()
@@ -262,6 +544,10 @@ class TestCase(object):
                 # Clean up processes.
                 self._cleanup_processes()
 
+            # Kill anything which escaped the clean up.
+            if self._sweep_enabled():
+                self._sweep_processes(result)
+
             # Process details.
             self._process_details(result)
 
@@ -277,6 +563,11 @@ class TestCase(object):
             self._cleanup_processes()
             raise
         finally:
+            release_cpu(cpu)
+            set_perf_counters(False)
+            self._close_mocks()
+            self._release_network()
+            self._release_ports()
             if not ignored:
                 result.stop_test(self)
             if original_result is None:
@@ -295,7 +586,11 @@ class TestCase(object):
             # Ignore errors when in update mode.
             return
         if process.timeout():
-            msg = "Timeout occurred"
+            reason = process.stall_reason()
+            if reason:
+                msg = f"Process stopped early: {reason}"
+            else:
+                msg = "Timeout occurred"
 
         # Kill process, to ensure it is not left around.
         if not self.option("explain"):
@@ -303,40 +598,39 @@ class TestCase(object):
 
         raise self.failure_exception(msg)
 
-    def _get_process_output(self, stream_readline):
-        """ Returns the full process output from the given process stream """
-        proc_lines = []
-        while True:
-            line = stream_readline()
-            if not line:
-                break
-            proc_lines.append(line)
-        return "".join(proc_lines)
+    def _fuzzy_ratio(self, expected_lines, actual_lines):
+        """ Returns the match ratio between two outputs, given as lines """
+        mode = self.fuzzy_mode or self.option("fuzzy_mode", "chars")
+        max_cost = int(self.option("fuzzy_max_cost", MAX_COST))
+        return match_ratio(expected_lines, actual_lines, mode, max_cost)
 
     def _file_output_match_ratio(self, stream_readline, file):
         """ Returns the match ratio between a process and file """
-        proc_lines = self._get_process_output(stream_readline)
-        file_lines = pathlib.Path(file).resolve().read_text()
-        return self._match_ratio(proc_lines, file_lines)
+        expected = expected_file(file)
+        return self._fuzzy_ratio(expected.lines(), iter(stream_readline, ""))
 
     def _string_output_match_ratio(self, stream_readline, string):
         """ Returns the match ratio between a process and string """
-        proc_lines = self._get_process_output(stream_readline)
-        return self._match_ratio(proc_lines, string)
+        return self._fuzzy_ratio(
+            string.splitlines(keepends=True), iter(stream_readline, "")
+        )
 
     def _file_match_ratio(self, file1, file2):
         """ Returns the match ratio between two files """
-        f1_lines = pathlib.Path(file1).resolve().read_text()
-        f2_lines = pathlib.Path(file2).resolve().read_text()
-        return self._match_ratio(f1_lines, f2_lines)
+        # Identical files need not be read line by line.
+        if files_equal(file1, file2):
+            return 1.0
+        with open(pathlib.Path(file1).resolve()) as f1:
+            return self._fuzzy_ratio(f1, expected_file(file2).lines())
 
     def _match_ratio(self, expected_output, actual_output):
         """ Returns the match ratio between two strings """
-        diff = difflib.SequenceMatcher(
-            None, expected_output, actual_output, autojunk=False
+        if expected_output == actual_output:
+            return 1.0
+        return self._fuzzy_ratio(
+            expected_output.splitlines(keepends=True),
+            actual_output.splitlines(keepends=True),
         )
-        ratio = diff.quick_ratio()
-        return ratio
 
     def _compare_files(self, file1, file2, msg1=None, msg2=None, msg=None, type="file"):
         if not os.path.exists(file1):
@@ -344,81 +638,145 @@ class TestCase(object):
         elif not os.path.exists(file2):
             return msg2 or f"file missing: {file2}"
         else:
-            # Files exist, so open and compare them
-            f1 = open(file1, "rb")
-            f2 = open(file2, "rb")
-
-            different = False
-            while True:
-                b1 = f1.read(BUFFER_SIZE)
-                b2 = f2.read(BUFFER_SIZE)
-
-                if b1 != b2:
-                    different = True
-                    break
-
-                if not b1:
-                    # Reached end of file, and they are the same
-                    break
-
-            f1.close()
-            f2.close()
+            # Files exist, so compare them (against the cached expected file).
+            different = not files_equal(file1, file2)
 
             if different:
                 msg = msg or f"{type} mismatch"
                 if self.option("show_diff"):
-                    # Add diff of output to message.
-                    f1 = open(file1, "r")
-                    f2 = open(file2, "r")
-                    diff = difflib.unified_diff(
-                        f1.readlines(), f2.readlines(), fromfile=file1, tofile=file2
-                    )
+                    # Add diff of output (around the first difference) to message.
+                    context, hunks = self._diff_limits()
+                    diff = diff_files(file1, file2, context, hunks)
+                    msg += f"\nDiff leading to failure:\n{diff}"
+                return msg
+
+    def _compare_files_unordered(self, file1, file2, msg=None, type="file"):
+        if not os.path.exists(file1):
+            return f"file missing: {file1}"
+        elif not os.path.exists(file2):
+            return f"file missing: {file2}"
+        else:
+            comparison = self._count_unordered(file1, file2, MAX_REPORTED_LINES)
+            return self._unordered_result(type, comparison, msg)
+
+    def _count_unordered(self, file1, file2, max_reported):
+        """Compare the lines of two files in any order, giving the same result
+        as compare_stdout_unordered on a process. As there, only the count
+        and first offset of each distinct expected line are kept, and the
+        text of the missing lines reported is read again from the file.
+        """
+        # [count, offset of first appearance] by hash, in order of appearance.
+        expected = {}
+        expected_lines = offset = 0
+        with open(file2, "rb") as f:
+            for line in f:
+                key = hash(line)
+                entry = expected.get(key)
+                if entry is None:
+                    expected[key] = [1, offset]
+                else:
+                    entry[0] += 1
+                expected_lines += 1
+                offset += len(line)
+
+        # [count, line] by hash, for a bounded number of distinct lines.
+        extra = {}
+        actual_lines = extra_lines = 0
+        with open(file1, "rb") as f:
+            for line in f:
+                actual_lines += 1
+                key = hash(line)
+                entry = expected.get(key)
+                if entry is not None and entry[0] > 0:
+                    entry[0] -= 1
+                    continue
+                extra_lines += 1
+                if key in extra:
+                    extra[key][0] += 1
+                elif len(extra) < max_reported:
+                    extra[key] = [1, line]
+
+        missing = [entry for entry in expected.values() if entry[0] > 0]
+        missing_lines = sum(count for count, _ in missing)
+        reported = []
+        with open(file2, "rb") as f:
+            for count, offset in missing[:max_reported]:
+                f.seek(offset)
+                reported.append((f.readline(), count))
+
+        def decoded(counts):
+            return [
+                (line.decode("utf-8", errors="replace"), count)
+                for line, count in counts
+            ]
+
+        return (
+            expected_lines,
+            actual_lines,
+            missing_lines,
+            decoded(reported),
+            extra_lines,
+            decoded((line, count) for count, line in extra.values()),
+        )
 
-                    msg += f"\nDiff leading to failure:\n{''.join(diff)}"
+    def _unordered_result(self, stream, comparison, msg):
+        """Build the failure message for lines compared in any order, or
+        return None if the lines matched.
+        """
+        expected, actual, missing, missing_lines, extra, extra_lines = comparison
+        if not missing and not extra:
+            return None
 
-                    f1.close()
-                    f2.close()
-                return msg
+        result = msg or (
+            f"{stream} mismatch (ignoring line order): "
+            f"{missing} lines missing, {extra} extra lines"
+        )
+        for name, lines in (("missing", missing_lines), ("extra", extra_lines)):
+            for line, count in lines:
+                result += f"\n{' ' * 8}{name}: {safe_repr(line)}"
+                if count > 1:
+                    result += f" (x{count})"
+        if self.option("fuzzy"):
+            # Proportion of lines matched, over both outputs.
+            ratio = 2 * (expected - missing) / max(expected + actual, 1)
+            result += f" <<{round(ratio, 2)}>>"
+        return result
+
+    def _diff_limits(self):
+        """Lines of context, and most hunks, shown in diffs of failures
+        (eg. -o diff_context=5 -o diff_hunks=1).
+        """
+        context = int(self.option("diff_context", DIFF_CONTEXT))
+        hunks = int(self.option("diff_hunks", DIFF_HUNKS))
+        return context, hunks
 
     def _verbose_compare(self, stream_readline, file_path, stream_name, msg):
         if not os.path.exists(file_path):
             return f"file missing: {file_path}"
         else:
-            # Files exist, so open and compare them
-            different = False
-            p_history = []
-            f_history = []
-
-            with open(file_path, "rb") as f:
-                while True:
-                    p_line = stream_readline()
-                    f_line = f.readline().decode("utf-8")
-
-                    # Store history of output.
-                    p_history.append(p_line)
-                    f_history.append(f_line)
-
-                    if f_line != p_line:
-                        different = True
-                        break
-
-                    if not f_line:
-                        # Reached end of file, and they are the same
-                        break
+            # Compare output line by line, up to the first difference.
+            context, _ = self._diff_limits()
+            diff = diff_stream(
+                iter(stream_readline, ""),
+                expected_file(file_path).lines(),
+                stream_name,
+                file_path,
+                context,
+            )
 
-            if different:
+            if diff is not None:
                 # Append diff to error message.
-                diff = difflib.unified_diff(
-                    p_history, f_history, fromfile=stream_name, tofile=file_path
-                )
                 msg = msg or ""
                 msg += "\nDiff leading to failure [truncated]:\n"
-                msg += "".join(diff)
+                msg += diff
                 return msg
 
     def delay(self, secs):
         """Insert a delay into a test.
         Delay is in seconds, with fractions being acceptable.
+
+        To wait for a process to be ready, wait_for_port, wait_for_output or
+        wait_for_file finish as soon as it is, rather than after a fixed time.
         """
         if not self.option("explain"):
             time.sleep(secs)
@@ -431,10 +789,13 @@ class TestCase(object):
 
         raise self.failure_exception(msg)
 
-    def assert_stdout_matches_file(self, process, file_path, msg=None):
+    def assert_stdout_matches_file(self, process, file_path, msg=None, ordered=True):
         """
         Assert that the standard output of the process matches the
         contents of the given file.
+
+        If ordered is False, the lines may appear in any order, such as
+        for output from several threads or processes.
         """
         if self.option("explain"):
             # Print out command to compare stdout.
@@ -462,7 +823,17 @@ class TestCase(object):
 
         result = None
 
-        if self.option("save"):
+        if not ordered:
+            if self.option("save"):
+                result = self._compare_files_unordered(
+                    self._stdout_filename(process), file_path, msg=msg, type="stdout"
+                )
+            else:
+                comparison = process.compare_stdout_unordered(
+                    file_path, MAX_REPORTED_LINES
+                )
+                result = self._unordered_result("stdout", comparison, msg)
+        elif self.option("save"):
             result = self._compare_files(
                 self._stdout_filename(process), file_path, msg=msg, type="stdout"
             )
@@ -481,10 +852,13 @@ class TestCase(object):
         if result is not None:
             self._check_signal(process, result)
 
-    def assert_stderr_matches_file(self, process, file_path, msg=None):
+    def assert_stderr_matches_file(self, process, file_path, msg=None, ordered=True):
         """
         Assert that the standard error of the process matches the
         contents of the given file.
+
+        If ordered is False, the lines may appear in any order, such as
+        for output from several threads or processes.
         """
         if self.option("explain"):
             # Print out command to compare stderr.
@@ -513,7 +887,17 @@ class TestCase(object):
 
         result = None
 
-        if self.option("save"):
+        if not ordered:
+            if self.option("save"):
+                result = self._compare_files_unordered(
+                    self._stderr_filename(process), file_path, msg=msg, type="stderr"
+                )
+            else:
+                comparison = process.compare_stderr_unordered(
+                    file_path, MAX_REPORTED_LINES
+                )
+                result = self._unordered_result("stderr", comparison, msg)
+        elif self.option("save"):
             result = self._compare_files(
                 self._stderr_filename(process), file_path, msg=msg, type="stderr"
             )
@@ -642,6 +1026,85 @@ class TestCase(object):
         if result is not None:
             self._check_signal(process, result)
 
+    @classmethod
+    def _pattern_set(cls, patterns):
+        """Get the compiled PatternSet for the given patterns, compiling it
+        only the first time it is used by this class of test.
+        """
+        cache = cls.__dict__.get("_pattern_sets")
+        if cache is None:
+            cache = {}
+            cls._pattern_sets = cache
+        key = tuple(patterns)
+        if key not in cache:
+            cache[key] = PatternSet(list(key))
+        return cache[key]
+
+    def _assert_contains(self, process, patterns, stream, expected, msg):
+        """Check that all (expected) or none (not expected) of the patterns
+        appear in the given stream of the process.
+        """
+        patterns = list(patterns)
+        name = "all" if expected else "none"
+        if self.option("explain"):
+            self._print_coloured(
+                f"Expect {stream} from Process {process.count} to contain "
+                f"{name} of: ",
+                attrs=["bold"],
+                end="",
+            )
+            print(", ".join(safe_repr(p) for p in patterns))
+            return
+
+        if self.option("update"):
+            # Print message to remind user to check output
+            print(f"\tCheck assert_{stream}_contains_{name}({safe_repr(patterns)})")
+            return
+
+        scan = process.scan_stdout if stream == "stdout" else process.scan_stderr
+        found = scan(self._pattern_set(patterns))
+        wrong = [p for p, f in zip(patterns, found) if f != expected]
+        if not wrong:
+            return
+
+        if expected:
+            result = f"{stream} missing {len(wrong)} of {len(patterns)} expected"
+        else:
+            result = f"{stream} contains {len(wrong)} of {len(patterns)} unexpected"
+        result = msg or f"{result}: {', '.join(safe_repr(p) for p in wrong)}"
+        if self.option("fuzzy"):
+            ratio = 1 - len(wrong) / len(patterns)
+            result += f" <<{round(ratio, 2)}>>"
+        self._check_signal(process, result)
+
+    def assert_stdout_contains_all(self, process, patterns, msg=None):
+        """
+        Assert that every one of the patterns appears somewhere in the
+        standard output of the process, in any order.
+        """
+        self._assert_contains(process, patterns, "stdout", True, msg)
+
+    def assert_stdout_contains_none(self, process, patterns, msg=None):
+        """
+        Assert that none of the patterns appear in the standard output of the
+        process.
+        """
+        self._assert_contains(process, patterns, "stdout", False, msg)
+
+    def assert_stderr_contains_all(self, process, patterns, msg=None):
+        """
+        Assert that every one of the patterns appears somewhere in the
+        standard error of the process, in any order.
+        """
+        self._assert_contains(process, patterns, "stderr", True, msg)
+
+    def assert_stderr_contains_none(self, process, patterns, msg=None):
+        """
+        Assert that none of the patterns appear in the standard error of the
+        process.
+        """
+        self._assert_contains(process, patterns, "stderr", False, msg)
+
     def assert_exit_status(self, process, status, msg=None):
         """
         Assert that the exit status of the process matches the given status.
@@ -684,6 +1147,132 @@ class TestCase(object):
             )
             self._check_signal(process, msg)
 
+    def assert_cpu_time_below(self, process, seconds, repeat=1, msg=None):
+        """
+        Assert that the process uses less than the given CPU time (user and
+        system, in seconds, including any children it waits for). With
+        repeat, the process is run that many times in total, and the median
+        is used (its input must then be given as input_file or input_data).
+        """
+        self._assert_usage_below(process, 0, seconds, repeat, msg)
+
+    def assert_max_rss_below(self, process, limit, repeat=1, msg=None):
+        """
+        Assert that the peak memory use (resident set size, in bytes) of the
+        process is less than the given limit. With repeat, the process is run
+        that many times in total, and the median is used (its input must then
+        be given as input_file or input_data).
+        """
+        self._assert_usage_below(process, 1, limit, repeat, msg)
+
+    def assert_wall_time_below(self, process, seconds, repeat=1, msg=None):
+        """
+        Assert that the process finishes in less than the given time (in
+        seconds, from starting it). With repeat, the process is run that many
+        times in total, and the median is used (its input must then be given
+        as input_file or input_data).
+        """
+        self._assert_usage_below(process, 2, seconds, repeat, msg)
+
+    def assert_instructions_below(
+        self, process, instructions, repeat=1, cpu_time=None, msg=None
+    ):
+        """
+        Assert that the process retires fewer than the given number of
+        instructions (in user space, including any children), which varies
+        far less between runs than time. Requires count_instructions to be
+        set on the test class. With repeat, the process is run that many
+        times in total, and the median is used (its input must then be given
+        as input_file or input_data).
+
+        If the kernel does not allow hardware counters, the CPU time of the
+        process is limited instead: to cpu_time seconds if given, otherwise
+        to the time taken at FALLBACK_INSTRUCTION_RATE.
+        """
+        if not self.count_instructions:
+            raise RuntimeError(
+                "Instructions were not counted for process "
+                "(count_instructions is not set)"
+            )
+        if self.option("explain") or process.perf_counters() is not None:
+            self._assert_usage_below(
+                process, _INSTRUCTIONS, instructions, repeat, msg
+            )
+            return
+
+        if cpu_time is None:
+            cpu_time = instructions / FALLBACK_INSTRUCTION_RATE
+        self.add_detail(
+            "instruction limit",
+            f"hardware counters unavailable, limiting CPU time to {cpu_time:.3f}s",
+            per_test=True,
+        )
+        self._assert_usage_below(process, 0, cpu_time, repeat, msg)
+
+    def _assert_usage_below(self, process, measure, limit, repeat, msg):
+        """Assert that a measure of the resources used by a process (an index
+        into USAGE_MEASURES) is below the limit.
+        """
+        name, units = USAGE_MEASURES[measure]
+        if repeat < 1:
+            raise ValueError("repeat must be at least 1")
+        if repeat > 1 and getattr(process, "input_sent", False):
+            # Input sent to the process is not recorded, so cannot be replayed.
+            raise ValueError(
+                "repeat requires input to be given as input_file or input_data"
+            )
+
+        if self.option("explain"):
+            self._print_coloured(
+                f"Expect {name} of Process {process.count} below "
+                f"{_format_usage(limit, units)}",
+                attrs=["bold"],
+                end="",
+            )
+            print(f" (median of {repeat} runs)" if repeat > 1 else "")
+            return
+
+        values = [self._usage(process, measure)]
+        for _ in range(repeat - 1):
+            values.append(self._usage(self._rerun(process), measure))
+        value = statistics.median(values)
+        if value < limit:
+            return
+
+        result = msg or (
+            f"{name} {_format_usage(value, units)} exceeds limit of "
+            f"{_format_usage(limit, units)}"
+        )
+        if repeat > 1:
+            result += f" (median of {repeat} runs)"
+        if self.option("fuzzy"):
+            # Partial marks for being close to the limit.
+            ratio = limit / value if value else 0
+            result += f" <<{round(ratio, 2)}>>"
+        self._check_signal(process, result)
+
+    def _usage(self, process, measure):
+        """Get a measure of the resources used by a process (an index into
+        USAGE_MEASURES), waiting for it to finish.
+        """
+        if measure == _INSTRUCTIONS:
+            counters = process.perf_counters()
+            if counters is None:
+                raise RuntimeError("Instructions were not counted for process")
+            return counters["instructions"]
+        return process.usage()[measure]
+
+    def _rerun(self, process):
+        """Start another run of a process, with the same arguments and input
+        file (or input data), and no other input. Output is captured to
+        files, so the run is never held up by a reader.
+        """
+        argv, input_file, args, kwargs = process.spawn_args
+        kwargs = dict(kwargs, capture="file")
+        rerun = self.process(list(argv), input_file, *args, **kwargs)
+        rerun.finish_input()
+        return rerun
+
     def assert_signalled(self, process, msg=None):
         """
         Assert that the process received a signal.
@@ -737,13 +1326,23 @@ class TestCase(object):
         if result is not None:
             raise self.failure_exception(result)
 
-    def add_detail(self, name, data):
-        """Record information related to the test"""
-        self.__details[name] = data
+    def add_detail(self, name, data, per_test=False):
+        """Record information related to the test. With per_test, the
+        information is kept for each test (by ID) in the results, rather than
+        replaced by that of the next test to record it.
+        """
+        if per_test:
+            self.__per_test_details.add(name)
+            self.__details.setdefault(name, {})[self.id()] = data
+        else:
+            self.__details[name] = data
 
     def _process_details(self, result):
         """Update details in the result with those stored from the test."""
-        result.update_details(self.__details)
+        details = dict(self.__details)
+        for name in self.__per_test_details:
+            details[name] = dict(result.get_details().get(name, {}), **details[name])
+        result.update_details(details)
 
     def child_pids(self, parent):
         """Get the process IDs of the children of the given parent process."""
@@ -754,7 +1353,10 @@ class TestCase(object):
             )
         elif isinstance(parent, xTracedProcess):
             pids = parent.child_pids()
+        elif os.path.isdir("/proc/self"):
+            pids = [child.pid for child in self.process_table().children(parent.pid)]
         else:
+            # No /proc available, so ask pgrep instead.
             pgrep = self.process(["pgrep", "-P", str(parent.pid)])
             while True:
                 pid = pgrep.readline_stdout()
@@ -763,9 +1365,374 @@ class TestCase(object):
                 pid = int(pid.strip())
                 pids.append(pid)
             pgrep.assert_exit_status(0)
-            del pgrep
+            pgrep.close()
+        return pids
+
+    @contextlib.contextmanager
+    def _scaled_time(self, time_scale):
+        """Speed up time by time_scale for processes created in the context.
+        Every process of the test is sped up from the same moment.
+        """
+        if not time_scale or time_scale == 1 or self.option("explain"):
+            yield
+            return
+        if time_scale < 0:
+            raise ValueError("Process time_scale must be positive.")
+
+        if self._time_epoch is None:
+            real = time.clock_gettime_ns(time.CLOCK_REALTIME)
+            monotonic = time.clock_gettime_ns(time.CLOCK_MONOTONIC)
+            self._time_epoch = f"{real}:{monotonic}"
+
+        preload = get_ld_preload()
+        if not preload:
+            set_ld_preload(protection_library())
+        original = {
+            name: os.environ.get(name) for name in (TIME_SCALE_ENV, TIME_EPOCH_ENV)
+        }
+        os.environ[TIME_SCALE_ENV] = str(time_scale)
+        os.environ[TIME_EPOCH_ENV] = self._time_epoch
+        try:
+            yield
+        finally:
+            for name, value in original.items():
+                if value is None:
+                    del os.environ[name]
+                else:
+                    os.environ[name] = value
+            set_ld_preload(preload)
+
+    def process_table(self, refresh=False):
+        """Get a snapshot of the processes running on the system.
+
+        If cache_process_table is set, the same snapshot is used for the rest
+        of the test, unless refresh is set.
+        """
+        if refresh or not self.cache_process_table or self._process_table is None:
+            self._process_table = ProcessTable()
+        return self._process_table
+
+    def descendants(self, process):
+        """Get information (pid, ppid, state) about all descendants of the
+        given process, parents before children.
+        """
+        if self.option("explain"):
+            self._print_coloured(
+                f"Get descendants of Process {process.count}", attrs=["bold"]
+            )
+            return []
+        return self.process_table().descendants(process.pid)
+
+    def wait_for_children(self, process, count, deadline):
+        """Wait up to deadline seconds for the given process to have at least
+        count children. Fail if it does not, otherwise return their IDs.
+        """
+        if self.option("explain"):
+            self._print_coloured(
+                f"Wait for Process {process.count} to have {count} child processes",
+                attrs=["bold"],
+            )
+            return []
+
+        end = time.monotonic() + deadline
+        while True:
+            children = self.process_table(refresh=True).children(process.pid)
+            if len(children) >= count or time.monotonic() >= end:
+                break
+            time.sleep(POLL_INTERVAL)
+
+        pids = [child.pid for child in children]
+        if len(pids) < count:
+            self.fail(f"expected {count} child processes, found {len(pids)}")
         return pids
 
+    def reserve_port(self):
+        """Reserve a TCP port for the test, which no other test on this host
+        (in any pool worker) will be given. Released when the test finishes.
+        """
+        port = reserve_port()
+        self._ports.append(port)
+        if self.option("explain"):
+            self._print_coloured(f"Reserve port {port}", attrs=["bold"])
+        return port
+
+    def _isolate_network(self):
+        """Create a network namespace for the test, which every process it
+        starts will join. Processes in different tests can then use the same
+        ports at the same time, without interfering.
+        """
+        self._network_pid = create_network_namespace()
+        # The holder of the namespace is not a leaked process.
+        self._baseline_pids.add(self._network_pid)
+        fds_before = open_fds()
+        set_network_namespace(self._network_pid)
+        # Nor are the descriptors held to join it the test's own.
+        self._network_fds = open_fds() - fds_before
+
+    def _release_network(self):
+        """Stop processes joining the network namespace of the test, and
+        remove it.
+        """
+        if self._network_pid is None:
+            return
+        set_network_namespace(0)
+        try:
+            os.kill(self._network_pid, signal.SIGKILL)
+            os.waitpid(self._network_pid, 0)
+        except OSError:
+            # Holder has already exited.
+            pass
+        self._network_pid = None
+        self._network_fds = set()
+
+    def _release_ports(self):
+        """Release the ports reserved by the test."""
+        for port in self._ports:
+            release_port(port)
+        self._ports = []
+
+    def wait_for_port(self, port, deadline):
+        """Wait up to deadline seconds for a server to listen on the given
+        port. Fail if it does not.
+
+        Listening sockets are found in /proc/net, so the server does not see
+        a connection. Without /proc, a non-blocking connect is used instead.
+        """
+        if self.option("explain"):
+            self._print_coloured(f"Wait for a server on port {port}", attrs=["bold"])
+            return
+
+        end = time.monotonic() + deadline
+        while True:
+            ports = listening_ports(self._network_pid or "self")
+            if ports is not None:
+                ready = port in ports
+            else:
+                ready = port_accepts(port, POLL_INTERVAL)
+            if ready or time.monotonic() >= end:
+                break
+            time.sleep(POLL_INTERVAL)
+
+        if not ready:
+            self.fail(f"no server listening on port {port} after {deadline} seconds")
+
+    def wait_for_output(self, process, pattern, deadline, stream="stdout"):
+        """Wait up to deadline seconds for a line of output from the process
+        (stdout, or stderr if stream is "stderr") to match the regular
+        expression pattern. Fail if none does, otherwise return the match.
+
+        Lines up to and including the matching line are consumed, while any
+        output after it is left to be read or checked as normal.
+        """
+        if stream not in ("stdout", "stderr"):
+            raise ValueError(f"Unknown stream: {stream}")
+        if self.option("explain"):
+            self._print_coloured(
+                f"Wait for {stream} from Process {process.count} to match "
+                f"{safe_repr(getattr(pattern, 'pattern', pattern))}",
+                attrs=["bold"],
+            )
+            return None
+
+        if isinstance(pattern, str):
+            pattern = re.compile(pattern)
+        if stream == "stdout":
+            readline = process.readline_stdout_timeout
+        else:
+            readline = process.readline_stderr_timeout
+
+        end = time.monotonic() + deadline
+        while True:
+            line = readline(max(end - time.monotonic(), 0))
+            if line is None:
+                msg = f"no match for {safe_repr(pattern.pattern)} in {stream} after {deadline} seconds"
+                break
+            if line == "":
+                msg = f"{stream} ended with no match for {safe_repr(pattern.pattern)}"
+                break
+            match = pattern.search(line)
+            if match:
+                return match
+
+        self._check_signal(process, msg)
+
+    def wait_for_file(self, path, deadline):
+        """Wait up to deadline seconds for a file to be created.
+        Fail if it is not.
+        """
+        if self.option("explain"):
+            self._print_coloured(f"Wait for file {path} to be created", attrs=["bold"])
+            return
+
+        if not _wait_for_file(str(path), max(int(deadline * 1000), 0)):
+            self.fail(f"file {path} not created after {deadline} seconds")
+
+    def generate_load(self, port, script, clients=1, sessions=1, timeout=10):
+        """Drive a server on the given port with clients concurrent sessions
+        of the script (a marks.load.LoadScript, or its steps), each client
+        running sessions of them in turn. Returns a LoadResult, whose summary
+        (latency percentiles, histogram and throughput) is added to the
+        details of the results, under "load" by test ID.
+        """
+        if self.option("explain"):
+            self._print_coloured(
+                f"Run {sessions} session(s) of {clients} concurrent client(s) "
+                f"against the server on port {port}",
+                attrs=["bold"],
+            )
+            return None
+        if self._network_pid is not None:
+            raise RuntimeError("Load cannot be generated into an isolated network")
+
+        load = generate_load(port, script, clients, sessions, timeout=timeout)
+        self.add_detail("load", load.summary(), per_test=True)
+        return load
+
+    def assert_latency_below(self, load, seconds, percentile=95, msg=None):
+        """
+        Assert that the given percentile of request latency from a load run
+        (see generate_load) is below the limit, in seconds. Failed sessions
+        fail the assertion.
+        """
+        if self.option("explain"):
+            self._print_coloured(
+                f"Expect p{percentile} request latency below {seconds:.3f}s",
+                attrs=["bold"],
+            )
+            return
+
+        latency = load.percentile(percentile)
+        if load.errors:
+            result = msg or (
+                f"{len(load.errors)} client session(s) failed: {load.errors[0]}"
+            )
+        elif latency is None:
+            result = msg or "no requests completed"
+        elif latency < seconds:
+            return
+        else:
+            result = msg or (
+                f"p{percentile} request latency {latency:.3f}s exceeds limit of "
+                f"{seconds:.3f}s"
+            )
+            if self.option("fuzzy"):
+                # Partial marks for being close to the limit.
+                result += f" <<{round(seconds / latency, 2)}>>"
+        self.fail(result)
+
+    def assert_throughput_above(self, load, requests_per_second, msg=None):
+        """
+        Assert that a load run (see generate_load) completed more than the
+        given number of requests per second.
+        """
+        if self.option("explain"):
+            self._print_coloured(
+                f"Expect throughput above {requests_per_second} requests/s",
+                attrs=["bold"],
+            )
+            return
+
+        if load.throughput > requests_per_second:
+            return
+        result = msg or (
+            f"throughput {load.throughput:.1f} requests/s below "
+            f"{requests_per_second} requests/s"
+        )
+        if self.option("fuzzy"):
+            # Partial marks for being close to the limit.
+            ratio = load.throughput / requests_per_second
+            result += f" <<{round(ratio, 2)}>>"
+        self.fail(result)
+
+    def mock_server(self, transcript, port=None, timeout=None):
+        """Start a server in the test, in place of a server process, which
+        sends the transcript (bytes, or the path of a file) to the first
+        client to connect, and records what it sends back. The port is
+        reserved if not given. The server is listening when returned, so
+        the client can be started without a delay.
+        """
+        if port is None:
+            port = self.reserve_port()
+        if self.option("explain"):
+            self._print_coloured(
+                f"Start mock server on port {port}, sending "
+                f"{safe_repr(transcript)}",
+                attrs=["bold"],
+            )
+            return None
+        if self._network_pid is not None:
+            raise RuntimeError("Mock peers cannot join an isolated network")
+
+        server = MockServer(transcript, port, timeout=timeout or self.timeout or 10)
+        self._mocks.append(server)
+        return server
+
+    def mock_client(self, port, transcript, timeout=None):
+        """Start a client in the test, in place of a client process, which
+        connects to the server on the given port (once it is listening),
+        sends the transcript (bytes, or the path of a file), and records what
+        it sends back.
+        """
+        if self.option("explain"):
+            self._print_coloured(
+                f"Start mock client of port {port}, sending "
+                f"{safe_repr(transcript)}",
+                attrs=["bold"],
+            )
+            return None
+        if self._network_pid is not None:
+            raise RuntimeError("Mock peers cannot join an isolated network")
+
+        client = MockClient(port, transcript, timeout=timeout or self.timeout or 10)
+        self._mocks.append(client)
+        return client
+
+    def assert_mock_received(self, mock, output, msg=None):
+        """
+        Assert that a mock server or client received exactly the given output
+        from the program, waiting for it to arrive (or the connection to
+        finish).
+        """
+        if self.option("explain"):
+            self._print_coloured(
+                "Expect output sent to mock peer: ", attrs=["bold"], end=""
+            )
+            print(safe_repr(output))
+            return
+
+        received = mock.expect(output)
+        if received == output:
+            return
+        result = msg or "mock peer received mismatch"
+        if mock.error:
+            result += f" ({mock.error})"
+        if self.option("fuzzy"):
+            ratio = self._match_ratio(received, output)
+            result += f" <<{round(ratio, 2)}>>"
+        self.fail(result)
+
+    def assert_mock_received_file(self, mock, file_path, msg=None):
+        """
+        Assert that a mock server or client received exactly the contents of
+        the file from the program, waiting for it to arrive (or the
+        connection to finish).
+        """
+        if self.option("explain"):
+            self._print_coloured(
+                f"Expect output sent to mock peer to match file: {file_path}",
+                attrs=["bold"],
+            )
+            return
+
+        with open(file_path, errors="replace") as f:
+            self.assert_mock_received(mock, f.read(), msg=msg)
+
+    def _close_mocks(self):
+        """Close the mock servers and clients of the test."""
+        for mock in self._mocks:
+            mock.close()
+        self._mocks = []
+
     def signal_process(self, pid, sig, explain_process=None):
         """Send a signal to the process with the given ID."""
         if self.option("explain"):
@@ -0,0 +1,219 @@
+import collections
+import difflib
+import hashlib
+import itertools
+import mmap
+import os
+
+DIFF_CONTEXT = 3
+"""Lines of context shown around each difference"""
+
+DIFF_HUNKS = 3
+"""Most hunks (groups of nearby differences) shown, from the first"""
+
+DIFF_WINDOW = 200
+"""Most lines of each output diffed, from the first difference"""
+
+MAX_DIFF_LINE = 200
+"""Most characters shown of a line"""
+
+MAX_DIFF_SIZE = 8 * 1024
+"""Most characters in a diff (whole lines are left out beyond this)"""
+
+_BLOCK_SIZE = 2**16
+"""Bytes compared, counted or hashed at once"""
+
+
+def _show(prefix, text):
+    """Format a line of a diff, cut short if too long to show."""
+    if len(text) > MAX_DIFF_LINE:
+        text = text[:MAX_DIFF_LINE] + " [...]\n"
+    elif not text.endswith("\n"):
+        text += "\n\\ No newline at end of file\n"
+    return prefix + text
+
+
+def _format_range(start, length):
+    """Format a range of lines for a hunk header, as difflib does."""
+    if length == 1:
+        return str(start + 1)
+    if not length:
+        return f"{start},0"
+    return f"{start + 1},{length}"
+
+
+def render_diff(
+    actual,
+    expected,
+    start,
+    fromfile,
+    tofile,
+    context=DIFF_CONTEXT,
+    hunks=DIFF_HUNKS,
+    more=False,
+):
+    """Render a unified diff of windows of two outputs, each a list of
+    (key, text) for its lines from line start (counting from 0), compared by
+    key. At most hunks hunks, and MAX_DIFF_SIZE characters, are shown. If more
+    (either output goes on past its window), or anything is left out, the
+    diff ends with a note that it was truncated.
+    """
+    matcher = difflib.SequenceMatcher(
+        None, [key for key, _ in actual], [key for key, _ in expected], autojunk=False
+    )
+    lines = [f"--- {fromfile}\n", f"+++ {tofile}\n"]
+    size = sum(map(len, lines))
+    truncated = more
+    for count, group in enumerate(matcher.get_grouped_opcodes(context)):
+        if count == hunks:
+            truncated = True
+            break
+        first, last = group[0], group[-1]
+        hunk = [
+            "@@ -{} +{} @@\n".format(
+                _format_range(start + first[1], last[2] - first[1]),
+                _format_range(start + first[3], last[4] - first[3]),
+            )
+        ]
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                hunk.extend(_show(" ", text) for _, text in actual[i1:i2])
+                continue
+            if tag in ("replace", "delete"):
+                hunk.extend(_show("-", text) for _, text in actual[i1:i2])
+            if tag in ("replace", "insert"):
+                hunk.extend(_show("+", text) for _, text in expected[j1:j2])
+        for line in hunk:
+            if size + len(line) > MAX_DIFF_SIZE:
+                truncated = True
+                break
+            lines.append(line)
+            size += len(line)
+        if truncated:
+            break
+    if truncated:
+        lines.append("[diff truncated]\n")
+    return "".join(lines)
+
+
+def _map(path):
+    """Map a file into memory (or give b"" for an empty file)."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _common_length(first, second):
+    """Length of the common prefix of two buffers. Blocks are compared in
+    turn, and the first that differs is halved down to the first difference.
+    """
+    length = min(len(first), len(second))
+    for start in range(0, length, _BLOCK_SIZE):
+        end = min(start + _BLOCK_SIZE, length)
+        if first[start:end] != second[start:end]:
+            while end - start > 1:
+                middle = (start + end) // 2
+                if first[start:middle] == second[start:middle]:
+                    start = middle
+                else:
+                    end = middle
+            return start
+    return length
+
+
+def _count_lines(data, start, end):
+    """Count the line breaks in a buffer between offsets start and end."""
+    return sum(
+        data[block : min(block + _BLOCK_SIZE, end)].count(b"\n")
+        for block in range(start, end, _BLOCK_SIZE)
+    )
+
+
+def _read_lines(data, start, limit):
+    """Read up to limit lines of a buffer from offset start, as (key, text).
+    Each line is hashed whole, but only as much as is shown is decoded.
+    Returns the lines, and whether more follow.
+    """
+    lines = []
+    while start < len(data) and len(lines) < limit:
+        end = data.find(b"\n", start)
+        end = len(data) if end == -1 else end + 1
+        key = hashlib.blake2b(digest_size=16)
+        for block in range(start, end, _BLOCK_SIZE):
+            key.update(data[block : min(block + _BLOCK_SIZE, end)])
+        text = data[start : min(end, start + MAX_DIFF_LINE + 1)]
+        lines.append((key.digest(), text.decode(errors="replace")))
+        start = end
+    return lines, start < len(data)
+
+
+def diff_files(actual_path, expected_path, context=DIFF_CONTEXT, hunks=DIFF_HUNKS):
+    """Render a unified diff of two files (actual and expected output), in
+    time and memory bounded by the window diffed, not the size of the files.
+
+    The first difference is found by comparing the files a block at a time.
+    Only DIFF_WINDOW lines of each file from there (and the context before
+    it) are diffed, showing up to hunks hunks.
+    """
+    actual, expected = _map(actual_path), _map(expected_path)
+    try:
+        offset = _common_length(actual, expected)
+        # Go back to the start of the line with the first difference, and
+        # then the lines of context before it (the same in both files).
+        line_start = start = expected.rfind(b"\n", 0, offset) + 1
+        for _ in range(context):
+            if start == 0:
+                break
+            start = expected.rfind(b"\n", 0, start - 1) + 1
+        before = _count_lines(expected, start, line_start)
+
+        actual_lines, actual_more = _read_lines(actual, start, before + DIFF_WINDOW)
+        expected_lines, expected_more = _read_lines(
+            expected, start, before + DIFF_WINDOW
+        )
+        return render_diff(
+            actual_lines,
+            expected_lines,
+            _count_lines(expected, 0, start),
+            actual_path,
+            expected_path,
+            context,
+            hunks,
+            actual_more or expected_more,
+        )
+    finally:
+        for data in (actual, expected):
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+
+def diff_stream(actual, expected, fromfile, tofile, context=DIFF_CONTEXT):
+    """Render a unified diff of output read line by line (such as from a
+    running process) against expected output lines, up to the first
+    difference. Nothing is read past it, so a process waiting for input is
+    not waited on, and only the last context matching lines are kept.
+    Returns None if the outputs are the same.
+    """
+    before = collections.deque(maxlen=context)
+    line = 0
+    for actual_line, expected_line in itertools.zip_longest(actual, expected):
+        if actual_line != expected_line:
+            actual_lines = [(text, text) for text in before]
+            expected_lines = list(actual_lines)
+            if actual_line is not None:
+                actual_lines.append((actual_line, actual_line))
+            if expected_line is not None:
+                expected_lines.append((expected_line, expected_line))
+            return render_diff(
+                actual_lines,
+                expected_lines,
+                line - len(before),
+                fromfile,
+                tofile,
+                context,
+                hunks=1,
+            )
+        before.append(actual_line)
+        line += 1
+    return None
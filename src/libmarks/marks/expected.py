@@ -0,0 +1,188 @@
+import atexit
+import collections
+import mmap
+import os
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .store import FixtureStore, FIXTURE_STORE_ENV
+from .util import open_fds
+
+_CHUNK_SIZE = 2**20
+"""Bytes compared at once without NumPy"""
+
+_READ_SIZE = 2**24
+"""Largest file read into memory (and cached); larger files are mapped into
+memory for each use, so no descriptor is held for them between uses"""
+
+_CACHE_SIZE = 2**26
+"""Most bytes of files read into the cache, after which the least recently
+used are dropped"""
+
+_cache = collections.OrderedDict()
+"""Expected output files loaded by this process, by real path, from least to
+most recently used"""
+_cached_size = 0
+_cache_lock = threading.Lock()
+
+_store = None
+"""Fixture store of the marking run this process is a worker of, if any"""
+_store_attached = False
+_store_fds = frozenset()
+"""Descriptors held open for the fixture store"""
+
+
+class ExpectedFile(object):
+
+    """An expected output file, read into memory once and shared by every
+    comparison against it in this process (or given by the fixture store).
+    Files larger than _READ_SIZE are mapped into memory instead, and not
+    cached.
+    """
+
+    def __init__(self, path, stamp, data=None):
+        self.path = path
+        self.stamp = stamp
+        """(device, inode, size, modification time) when the file was loaded"""
+        self.size = stamp[2]
+        """Length of the file, in bytes"""
+        if data is None and self.size:
+            with open(path, "rb") as f:
+                if self.size <= _READ_SIZE:
+                    data = f.read()
+                else:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = data if data is not None else b""
+        """Contents of the file, as a buffer"""
+
+    def lines(self):
+        """Generate the lines of the file, as text."""
+        pending = b""
+        for start in range(0, self.size, _CHUNK_SIZE):
+            lines = (pending + bytes(self.data[start : start + _CHUNK_SIZE])).split(
+                b"\n"
+            )
+            pending = lines.pop()
+            for line in lines:
+                yield (line + b"\n").decode(errors="replace")
+        if pending:
+            yield pending.decode(errors="replace")
+
+
+def _stamp(path):
+    info = os.stat(path)
+    return (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns)
+
+
+def fixture_store():
+    """Get the fixture store of the marking run this process is a worker of,
+    attaching to it the first time. Returns None if there is none.
+    """
+    global _store, _store_attached, _store_fds
+    if not _store_attached:
+        _store_attached = True
+        name = os.environ.get(FIXTURE_STORE_ENV)
+        if name:
+            fds_before = open_fds()
+            try:
+                _store = FixtureStore.attach(name)
+                atexit.register(_detach_store)
+            except (OSError, ValueError):
+                _store = None
+            _store_fds = frozenset(open_fds() - fds_before)
+    return _store
+
+
+def held_fds():
+    """Get the descriptors held open by expected output files (for the
+    fixture store, which stays attached), so they are not counted against
+    the descriptors of a test.
+    """
+    return _store_fds
+
+
+def _detach_store():
+    """Detach from the fixture store on exit, once no files from it remain."""
+    global _cached_size
+    with _cache_lock:
+        _cache.clear()
+        _cached_size = 0
+        _store.close()
+
+
+def _load(path, stamp):
+    """Load an expected output file from the fixture store, if it is there
+    and unchanged, or else from the filesystem.
+    """
+    store = fixture_store()
+    contents = store.get(path, stamp) if store is not None else None
+    return ExpectedFile(path, stamp, contents)
+
+
+def _cost(expected):
+    """Bytes of memory an expected output file takes up in the cache. Files
+    in the fixture store are shared, so cost nothing.
+    """
+    return len(expected.data) if isinstance(expected.data, bytes) else 0
+
+
+def expected_file(path):
+    """Get an expected output file from the cache, loading it if it is not
+    yet loaded, or has changed since.
+    """
+    global _cached_size
+    path = os.path.realpath(path)
+    stamp = _stamp(path)
+    with _cache_lock:
+        cached = _cache.get(path)
+        if cached is not None and cached.stamp == stamp:
+            _cache.move_to_end(path)
+            return cached
+        if cached is not None:
+            del _cache[path]
+            _cached_size -= _cost(cached)
+
+        loaded = _load(path, stamp)
+        if isinstance(loaded.data, mmap.mmap):
+            # Too large to keep, so mapped for this use only.
+            return loaded
+        _cache[path] = loaded
+        _cached_size += _cost(loaded)
+        while _cached_size > _CACHE_SIZE and len(_cache) > 1:
+            _, dropped = _cache.popitem(last=False)
+            _cached_size -= _cost(dropped)
+        return loaded
+
+
+def _buffers_equal(first, second):
+    """Compare two buffers of the same length, vectorised by NumPy if it is
+    available, otherwise a chunk at a time.
+    """
+    if numpy is not None:
+        return numpy.array_equal(
+            numpy.frombuffer(first, dtype=numpy.uint8),
+            numpy.frombuffer(second, dtype=numpy.uint8),
+        )
+    for start in range(0, len(first), _CHUNK_SIZE):
+        end = start + _CHUNK_SIZE
+        if first[start:end] != second[start:end]:
+            return False
+    return True
+
+
+def files_equal(actual_path, expected_path):
+    """Check if a file has exactly the contents of an expected output file.
+    Files of different lengths are rejected without reading either.
+    """
+    expected = expected_file(expected_path)
+    if os.stat(actual_path).st_size != expected.size:
+        return False
+    if expected.size == 0:
+        return True
+    with open(actual_path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as actual:
+            return _buffers_equal(actual, expected.data)
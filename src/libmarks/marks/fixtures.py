@@ -0,0 +1,145 @@
+import os
+import sys
+from .procs import xProcess, ExplainProcess
+from .util import coloured_text
+
+FIXTURE_SCOPES = ("class",)
+"""Scopes over which a fixture process can be shared"""
+
+
+def fixture_process(scope="class", **kwargs):
+    """Share one process between the tests of a class, such as a server that
+    each test connects a different client to.
+
+    The decorated function is given the test class, and returns the argv of
+    the process. Any keyword arguments are passed on when creating the
+    process. Output is read through pipes, as for any process, so tests can
+    read and check it while the process runs.
+
+        @marks.fixture_process(scope="class")
+        def server(cls):
+            return ["./server", "2310"]
+
+    A fixture whose output no test reads can be given capture="file", so it
+    never blocks on a full pipe. Output captured to a file can only be read
+    once the process exits, which a fixture only does if it dies, so a test
+    reading or checking it would wait forever.
+
+    The process is started when the class is set up, and killed when it is
+    torn down. Each test gets the process as an attribute (self.server), and
+    if it has died since the last test, it is restarted before the next one.
+    Fixture processes run outside of any network namespace of a test.
+    """
+    if scope not in FIXTURE_SCOPES:
+        raise ValueError(f"Unknown fixture scope: {scope}")
+
+    def decorator(factory):
+        return FixtureProcess(factory, scope, **kwargs)
+
+    return decorator
+
+
+def _alive(pid):
+    """Check if a process still exists (even if it may already have been
+    reaped by something other than its Process, such as a sweep).
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def fixture_processes(class_):
+    """Get the fixture processes of a test class, including inherited ones."""
+    fixtures = {}
+    for base in reversed(class_.__mro__):
+        for name, value in vars(base).items():
+            if isinstance(value, FixtureProcess):
+                fixtures[name] = value
+            else:
+                fixtures.pop(name, None)
+    return list(fixtures.values())
+
+
+class FixtureProcess(object):
+
+    """A process shared by all tests of a class (see fixture_process).
+
+    Each test class using the fixture, including subclasses, has its own
+    process.
+    """
+
+    def __init__(self, factory, scope="class", **kwargs):
+        self.factory = factory
+        self.scope = scope
+        self.name = factory.__name__
+        self.__doc__ = factory.__doc__
+        self._kwargs = kwargs
+        # Running process for each test class.
+        self._processes = {}
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        class_ = type(instance)
+        if class_ not in self._processes:
+            # Test run on its own, without the class being set up.
+            self.start(class_)
+        return self._processes[class_]
+
+    def start(self, class_):
+        """Start the process for a test class."""
+        argv = list(self.factory(class_))
+        options = getattr(class_, "__marks_options__", {})
+        if options.get("explain"):
+            process = ExplainProcess(argv, **self._kwargs)
+            process.count = self.name
+            text = f"Start fixture Process {self.name}:"
+            if sys.stdout.isatty():
+                text = coloured_text(text, attrs=["bold"])
+            print(text)
+            print(f"\t{' '.join(argv)}")
+        else:
+            process = xProcess(argv, **self._kwargs)
+        self._processes[class_] = process
+        return process
+
+    def pid(self, class_):
+        """Get the process ID of the process for a test class, or None if it
+        is not running.
+        """
+        process = self._processes.get(class_)
+        if process is None or isinstance(process, ExplainProcess):
+            return None
+        return process.pid
+
+    def check(self, class_):
+        """Restart the process for a test class if it has died.
+        Returns whether it was restarted.
+        """
+        process = self._processes.get(class_)
+        if process is None or isinstance(process, ExplainProcess):
+            return False
+        if not process.check_finished() and _alive(process.pid):
+            return False
+        process.close()
+        self.start(class_)
+        return True
+
+    def stop(self, class_):
+        """Kill the process for a test class, if it is running."""
+        process = self._processes.pop(class_, None)
+        if process is None or isinstance(process, ExplainProcess):
+            return
+        try:
+            process.kill()
+        except RuntimeError:
+            # Process has already exited.
+            pass
+        process.close()
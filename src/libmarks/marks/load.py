@@ -0,0 +1,176 @@
+import asyncio
+import math
+import time
+
+LATENCY_PERCENTILES = (50, 95, 99)
+"""Percentiles of request latency reported for a load run"""
+
+LATENCY_BUCKETS = tuple(10 ** (e / 2) for e in range(-8, 3))
+"""Upper bounds (seconds) of the buckets of the latency histogram, from 0.1ms
+to 10s in half decades"""
+
+
+class LoadScript(object):
+
+    """The requests each client session makes of a server, in order.
+
+    Each step is a line to send, and the number of lines expected in
+    response (the latency of a request is the time from sending it until its
+    last response line arrives). A step given as a string expects one line.
+    A step with no line to send (None) just waits for responses, such as a
+    greeting from the server.
+    """
+
+    def __init__(self, steps):
+        self.steps = []
+        for step in steps:
+            if isinstance(step, str) or step is None:
+                step = (step, 1)
+            request, responses = step
+            if request is not None and not request.endswith("\n"):
+                request += "\n"
+            self.steps.append((request, responses))
+
+    @classmethod
+    def from_file(cls, file_path, responses=1):
+        """Create a script sending each line of a file (such as a client
+        input file), expecting the given number of lines after each.
+        """
+        with open(file_path) as f:
+            return cls((line, responses) for line in f)
+
+    @property
+    def requests(self):
+        """Number of requests made in a session"""
+        return sum(1 for request, _ in self.steps if request is not None)
+
+
+class LoadResult(object):
+
+    """Latency and throughput measured from a load run."""
+
+    def __init__(self, clients, sessions):
+        self.clients = clients
+        """Number of concurrent clients"""
+        self.sessions = sessions
+        """Number of sessions run by each client"""
+        self.latencies = []
+        """Latency (seconds) of each completed request"""
+        self.errors = []
+        """Description of each failed session"""
+        self.duration = 0
+        """Time (seconds) from the first connection to the last session ending"""
+
+    @property
+    def requests(self):
+        """Number of completed requests"""
+        return len(self.latencies)
+
+    @property
+    def throughput(self):
+        """Completed requests per second"""
+        return self.requests / self.duration if self.duration else 0
+
+    def percentile(self, percentile):
+        """Get a percentile (0-100) of request latency, in seconds, or None if
+        no requests completed. Uses the nearest rank.
+        """
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        rank = math.ceil(percentile / 100 * len(latencies))
+        return latencies[min(max(rank, 1), len(latencies)) - 1]
+
+    def histogram(self):
+        """Count requests by latency, as (upper bound in seconds, count) for
+        each of LATENCY_BUCKETS, with a final bucket (None) for the rest.
+        """
+        counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        for latency in self.latencies:
+            index = len(LATENCY_BUCKETS)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    index = i
+                    break
+            counts[index] += 1
+        return list(zip(LATENCY_BUCKETS + (None,), counts))
+
+    def summary(self):
+        """Summarise the run as a dictionary, for the details of a result."""
+        summary = {
+            "clients": self.clients,
+            "sessions": self.sessions,
+            "requests": self.requests,
+            "errors": len(self.errors),
+            "duration": self.duration,
+            "throughput": self.throughput,
+            "histogram": [
+                [bound, count] for bound, count in self.histogram() if count
+            ],
+        }
+        for percentile in LATENCY_PERCENTILES:
+            summary[f"p{percentile}"] = self.percentile(percentile)
+        return summary
+
+
+async def _session(host, port, script, timeout, result):
+    """Run one session of the script, recording each request's latency."""
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(host, port), timeout
+    )
+    try:
+        for request, responses in script.steps:
+            start = time.monotonic()
+            if request is not None:
+                writer.write(request.encode())
+                await writer.drain()
+            for _ in range(responses):
+                line = await asyncio.wait_for(reader.readline(), timeout)
+                if not line:
+                    raise ConnectionError("connection closed by server")
+            if request is not None:
+                result.latencies.append(time.monotonic() - start)
+    finally:
+        writer.close()
+
+
+async def _client(host, port, script, timeout, result):
+    """Run the sessions of one client, one after another."""
+    for _ in range(result.sessions):
+        try:
+            await _session(host, port, script, timeout, result)
+        except asyncio.TimeoutError:
+            result.errors.append(f"no response within {timeout} seconds")
+        except (OSError, ConnectionError) as e:
+            result.errors.append(str(e) or type(e).__name__)
+
+
+async def _generate(host, port, script, clients, timeout, result):
+    start = time.monotonic()
+    await asyncio.gather(
+        *(_client(host, port, script, timeout, result) for _ in range(clients))
+    )
+    result.duration = time.monotonic() - start
+
+
+def generate_load(port, script, clients=1, sessions=1, host="127.0.0.1", timeout=10):
+    """Drive a server on the given port with concurrent client sessions.
+
+    Each of clients connects, runs the script (a LoadScript, or the steps of
+    one) and disconnects, sessions times over. Requests which get no
+    response within timeout seconds end their session as an error.
+    Returns a LoadResult.
+    """
+    if clients < 1 or sessions < 1:
+        raise ValueError("clients and sessions must be at least 1")
+    if not isinstance(script, LoadScript):
+        script = LoadScript(script)
+    result = LoadResult(clients, sessions)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(
+            _generate(host, port, script, clients, timeout, result)
+        )
+    finally:
+        loop.close()
+    return result
@@ -11,11 +11,17 @@ import datetime
 import pathlib
 
 from .runner import BasicTestRunner, MarkingTestRunner
+from .affinity import AffinityPlan, init_worker, pinned_worker
+from .store import FixtureStore, FIXTURE_STORE_ENV
+from .util import protection_library
 
 
 NUM_PROCESSES = 4
 RESULTS_FILENAME = "results.json"
 
+# Environment variable read by the protection library for the fork limit.
+FORK_LIMIT_ENV = "MARKS_FORK_LIMIT"
+
 
 class LogException(object):
     """Log any exception raised in a Pool worker"""
@@ -73,9 +79,10 @@ def mark_submission(path, test, options):
             if options.get("marking_setup", False):
                 options["marking_setup"](options)
 
-            # Run the tests.
+            # Run the tests, on the CPUs of this worker (if pinned).
             runner = MarkingTestRunner(**options)
-            result = runner.run(test)
+            with pinned_worker():
+                result = runner.run(test)
 
             # Allow custom teardown to be performed via function callback
             if options.get("marking_tear_down", False):
@@ -155,9 +162,44 @@ class MarkingRunner(BasicTestRunner):
     def _set_protection(self):
         import marks
 
-        preload = self.options.get("ld_preload", _default_protection())
+        preload = self.options.get("ld_preload", protection_library())
         marks.set_ld_preload(preload)
 
+        # Limit the number of forks each tested process tree may make
+        # (eg. -o fork_limit=50), enforced by the protection library.
+        fork_limit = self.options.get("fork_limit")
+        if fork_limit:
+            os.environ[FORK_LIMIT_ENV] = str(int(fork_limit))
+
+    def _affinity_plan(self, processes):
+        """Plan the CPUs for each worker, if pinning workers to CPUs
+        (eg. -o pin_cpus -o reserve_cpus=2).
+        """
+        if not self.options.get("pin_cpus") or not hasattr(os, "sched_setaffinity"):
+            return None
+        reserved = int(self.options.get("reserve_cpus", 0))
+        plan = AffinityPlan(processes, reserved)
+        print("Pinning workers to CPUs:", plan.worker_cpus)
+        if plan.reserved_cpus:
+            print("Reserved CPUs for performance sensitive tests:", plan.reserved_cpus)
+        return plan
+
+    def _fixture_store(self):
+        """Load fixture files (eg. -o fixture_store=tests, with several paths
+        separated by os.pathsep) into shared memory, once for all workers.
+        Returns the store, or None if not loading fixtures.
+        """
+        paths = self.options.get("fixture_store")
+        if not paths:
+            return None
+        store = FixtureStore.create(str(paths).split(os.pathsep))
+        os.environ[FIXTURE_STORE_ENV] = store.name
+        print(
+            f"Loaded {len(store.files)} fixture files ({store.size} bytes) "
+            + "into shared memory"
+        )
+        return store
+
     def _get_test_names(self, results):
         for res in results:
             tests = res.get("tests", None)
@@ -188,9 +230,17 @@ class MarkingRunner(BasicTestRunner):
         }
         print("Starting marking:", count["submissions"], "submissions")
 
+        # Share fixture files between the workers.
+        store = self._fixture_store()
+
         # Run tests over all submissions
         mp.log_to_stderr()
-        pool = LoggingPool(processes=processes, maxtasksperchild=1)
+        pool = LoggingPool(
+            processes=processes,
+            maxtasksperchild=1,
+            initializer=init_worker,
+            initargs=(self._affinity_plan(processes),),
+        )
         results = []
 
         def complete(result):
@@ -216,6 +266,10 @@ class MarkingRunner(BasicTestRunner):
         except KeyboardInterrupt:
             pool.terminate()
             pool.join()
+        finally:
+            if store is not None:
+                del os.environ[FIXTURE_STORE_ENV]
+                store.unlink()
 
         # Create paths to output files
         directory = pathlib.Path(self.options.get("directory")).resolve()
@@ -280,9 +334,3 @@ class MarkingRunner(BasicTestRunner):
         end_time = datetime.datetime.now()
         print("Time taken: ", str(end_time - start_time))
 
-
-def _default_protection():
-    """Get the path to the included protection library"""
-    import marks
-
-    return str(pathlib.Path(marks.__file__).resolve().parent / "libprotect.so")
@@ -0,0 +1,164 @@
+import socket
+import threading
+import time
+
+# Interval (seconds) between attempts to connect to a server.
+_CONNECT_INTERVAL = 0.01
+
+
+def _load_transcript(transcript):
+    """Get the bytes of a transcript, given as bytes, or a path to a file."""
+    if isinstance(transcript, bytes):
+        return transcript
+    with open(transcript, "rb") as f:
+        return f.read()
+
+
+class MockPeer(object):
+
+    """One end of a connection, run on a thread of the test, which sends a
+    transcript to the program being tested and records what it sends back
+    (like `nc` with the transcript as its input).
+
+    The transcript is sent as soon as the connection is made. Everything
+    received is recorded until the program closes the connection, or
+    nothing is received for timeout seconds.
+    """
+
+    def __init__(self, transcript, timeout=10):
+        self.transcript = _load_transcript(transcript)
+        self.timeout = timeout
+        self.error = None
+        """Description of what went wrong with the connection, if anything"""
+        self._received = bytearray()
+        self._socket = None
+        self._closed = False
+        self._done = False
+        self._changed = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        try:
+            sock = self._connect()
+            with sock:
+                sock.settimeout(self.timeout)
+                sock.sendall(self.transcript)
+                while True:
+                    data = sock.recv(8192)
+                    if not data:
+                        break
+                    with self._changed:
+                        self._received += data
+                        self._changed.notify_all()
+        except socket.timeout:
+            self.error = f"nothing received for {self.timeout} seconds"
+        except OSError as e:
+            if not self._closed:
+                self.error = str(e)
+        finally:
+            with self._changed:
+                self._done = True
+                self._changed.notify_all()
+
+    def _connect(self):
+        """Make the connection to the program. Returns the socket."""
+        raise NotImplementedError
+
+    def wait(self, timeout=None):
+        """Wait for the connection to finish. Returns whether it did."""
+        with self._changed:
+            return self._changed.wait_for(
+                lambda: self._done, self.timeout if timeout is None else timeout
+            )
+
+    def received(self, timeout=None):
+        """Wait for the connection to finish, then return everything the
+        program sent, as text.
+        """
+        self.wait(timeout)
+        return bytes(self._received).decode(errors="replace")
+
+    def expect(self, output, timeout=None):
+        """Wait until the program has sent exactly the given output (text),
+        has sent something else (so can no longer send it), or the connection
+        finishes. Returns everything the program sent, as text, so the
+        program need not close the connection to be checked.
+        """
+        expected = output.encode()
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self._done
+                or self._received == expected
+                or not expected.startswith(self._received),
+                self.timeout if timeout is None else timeout,
+            )
+            return bytes(self._received).decode(errors="replace")
+
+    def close(self):
+        """Close the connection, if still open."""
+        self._closed = True
+        if self._socket is not None:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._socket.close()
+        self._thread.join()
+
+
+class MockServer(MockPeer):
+
+    """A server accepting one connection from the program being tested.
+
+    The server is listening once created, so a client can be started
+    straight away.
+    """
+
+    def __init__(self, transcript, port, host="127.0.0.1", timeout=10):
+        super(MockServer, self).__init__(transcript, timeout)
+        self.port = port
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self._socket.bind((host, port))
+            self._socket.listen(1)
+        except OSError:
+            self._socket.close()
+            raise
+        self._thread.start()
+
+    def _connect(self):
+        self._socket.settimeout(self.timeout)
+        with self._socket:
+            sock, _ = self._socket.accept()
+        self._socket = sock
+        return sock
+
+
+class MockClient(MockPeer):
+
+    """A client connecting to the program being tested, retrying until it
+    is listening (for up to timeout seconds), so no delay is needed after
+    starting the server.
+    """
+
+    def __init__(self, port, transcript, host="127.0.0.1", timeout=10):
+        super(MockClient, self).__init__(transcript, timeout)
+        self.port = port
+        self.host = host
+        self._thread.start()
+
+    def _connect(self):
+        end = time.monotonic() + self.timeout
+        while not self._closed:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._socket = sock
+            try:
+                sock.connect((self.host, self.port))
+                return sock
+            except ConnectionRefusedError:
+                sock.close()
+                if time.monotonic() >= end:
+                    raise
+                time.sleep(_CONNECT_INTERVAL)
+        raise OSError("closed before connecting")
@@ -0,0 +1,106 @@
+import fcntl
+import os
+import socket
+import tempfile
+
+PORT_RANGE = (20000, 32768)
+"""Range of ports handed out (first included, last excluded), kept below the
+usual ephemeral range so reserved ports do not clash with outgoing connections"""
+
+PORT_DIR_ENV = "MARKS_PORT_DIR"
+"""Environment variable to override the directory holding port locks"""
+
+# Lock descriptors for the ports reserved by this process.
+_reserved = {}
+
+
+def _lock_dir():
+    """Get the directory of port locks, shared by every user on the host."""
+    path = os.environ.get(PORT_DIR_ENV) or os.path.join(
+        tempfile.gettempdir(), "marks-ports"
+    )
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+            # Any user may add locks, but not remove those of others.
+            os.chmod(path, 0o1777)
+        except FileExistsError:
+            # Created by another process in the meantime.
+            pass
+    return path
+
+
+def _open_lock(path):
+    """Open a lock file, creating it if needed."""
+    try:
+        # Opened without O_CREAT first, as creating over a file owned by
+        # another user in a sticky directory may be refused.
+        return os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return os.open(path, os.O_RDONLY | os.O_CREAT, 0o644)
+
+
+def _port_free(port):
+    """Check that nothing is bound to (or lingering on) the port."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        try:
+            sock.bind(("", port))
+        except OSError:
+            return False
+    return True
+
+
+def reserve_port():
+    """Reserve a free TCP port, which no other process using marks on this
+    host will be given until it is released.
+
+    A port is held by an exclusive lock on its lock file, so reservations are
+    shared by all pool workers, and are released if a worker dies. Each port
+    is also checked with a bind, to skip ports used outside of marks.
+    """
+    start, end = PORT_RANGE
+    count = end - start
+    # Start workers at different points, so they rarely contend for a lock.
+    offset = (os.getpid() * 7919) % count
+    directory = _lock_dir()
+
+    for i in range(count):
+        port = start + (offset + i) % count
+        if port in _reserved:
+            continue
+
+        try:
+            fd = _open_lock(os.path.join(directory, str(port)))
+        except OSError:
+            # Lock file cannot be used, so leave the port alone.
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # Reserved by another process.
+            os.close(fd)
+            continue
+
+        if not _port_free(port):
+            os.close(fd)
+            continue
+
+        _reserved[port] = fd
+        return port
+
+    raise RuntimeError("No free ports left to reserve.")
+
+
+def release_port(port):
+    """Release a port reserved by this process."""
+    fd = _reserved.pop(port, None)
+    if fd is not None:
+        # Closing the descriptor releases the lock.
+        os.close(fd)
+
+
+def held_fds():
+    """Get the lock descriptors held for the ports reserved by this process,
+    so they are not counted against the descriptors of a test.
+    """
+    return set(_reserved.values())
@@ -1,32 +1,137 @@
 from __future__ import division, print_function
+import array
+import os
 import sys
+import tempfile
+from .capture import OutputCapture
 from .util import safe_repr, coloured_text
 from .process import Process as _Process
 from .process import TracedProcess as _TracedProcess
 from .process import TimeoutProcess as _TimeoutProcess
 
 
+CAPTURE_MODES = ("pipe", "file")
+"""Ways in which the output of a process can be captured"""
+
+PERF_COUNTERS = ("instructions", "cache_misses")
+"""Hardware counts returned by perf_counters(), in order"""
+
+
+def _native_kwargs(kwargs):
+    """Build the keyword arguments for creating a native process."""
+    native = {}
+    input_file = kwargs.get("input_file", None)
+    if input_file is not None:
+        native["input_file"] = input_file
+
+    capture = kwargs.get("capture", "pipe")
+    if capture not in CAPTURE_MODES:
+        raise ValueError(f"Unknown capture mode: {capture}")
+    native["capture_file"] = capture == "file"
+    return native
+
+
+def _idle_timeout_ms(kwargs):
+    """Convert the idle timeout (in seconds) to milliseconds, or 0 if unset."""
+    idle_timeout = kwargs.get("idle_timeout", None)
+    if idle_timeout is None:
+        return 0
+    if idle_timeout <= 0:
+        raise ValueError("Process idle_timeout must be positive.")
+    return max(int(idle_timeout * 1000), 1)
+
+
+class InputData(object):
+
+    """Input for a process, held in a sealed in-memory file.
+
+    The data never touches the filesystem, and the same InputData can be
+    given to any number of processes, as each one opens the file separately.
+    """
+
+    def __init__(self, data, encoding="utf-8"):
+        # Set first, so close() works however far initialisation gets.
+        self._fd = None
+        self._file = None
+        if isinstance(data, str):
+            data = data.encode(encoding)
+        data = memoryview(data).cast("B")
+        self.size = len(data)
+
+        if hasattr(os, "memfd_create"):
+            import fcntl
+
+            self._fd = os.memfd_create(
+                "marks-input", os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING
+            )
+            self._write(data)
+            # Seal the file so the input cannot change between processes.
+            fcntl.fcntl(
+                self._fd,
+                fcntl.F_ADD_SEALS,
+                fcntl.F_SEAL_SHRINK
+                | fcntl.F_SEAL_GROW
+                | fcntl.F_SEAL_WRITE
+                | fcntl.F_SEAL_SEAL,
+            )
+            self.path = f"/proc/self/fd/{self._fd}"
+        else:
+            # No memfd support, so fall back to a temporary file.
+            self._file = tempfile.NamedTemporaryFile(prefix="marks-input-")
+            self._fd = self._file.fileno()
+            self._write(data)
+            self.path = self._file.name
+
+    def _write(self, data):
+        written = 0
+        while written < len(data):
+            written += os.write(self._fd, data[written:])
+
+    def close(self):
+        """Release the file holding the input."""
+        if self._fd is None:
+            return
+        if self._file is not None:
+            self._file.close()
+        else:
+            os.close(self._fd)
+        self._fd = None
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 class xProcess(object):
     def __init__(self, argv, *vec, **kwargs):
-        input_file = kwargs.get("input_file", None)
-        if input_file is None:
-            self._proc = _Process(argv)
-        else:
-            self._proc = _Process(argv, input_file)
+        if kwargs.get("idle_timeout", None) is not None:
+            raise ValueError("Process idle_timeout requires a timeout.")
+        self._proc = _Process(argv, **_native_kwargs(kwargs))
         self._setup_attributes()
 
     def _setup_attributes(self):
+        self._stdout_capture = None
+        self._stderr_capture = None
         self.pid = self._proc.pid
         self.exit_status = self._proc.exit_status
         self.abnormal_exit = self._proc.abnormal_exit
         self.signalled = self._proc.signalled
         self.signal = self._proc.signal
         self.timeout = self._proc.timeout
+        self.stall_reason = self._proc.stall_reason
+        self.input_sent = False
 
     def send(self, message, **kwargs):
+        self.input_sent = True
         self._proc.send(message)
 
     def send_file(self, fname, **kwargs):
+        self.input_sent = True
         self._proc.send_file(fname)
 
     def finish_input(self, **kwargs):
@@ -50,6 +155,86 @@ class xProcess(object):
     def readline_stderr(self, **kwargs):
         return self._proc.readline_stderr()
 
+    def readline_stdout_timeout(self, timeout, **kwargs):
+        """Read a line from stdout, waiting at most timeout seconds.
+        Returns None if the line was not complete in time, in which case the
+        partial line is kept, and read first by the next read of stdout.
+        """
+        return self._proc.readline_stdout_timeout(max(int(timeout * 1000), 0))
+
+    def readline_stderr_timeout(self, timeout, **kwargs):
+        """Read a line from stderr, waiting at most timeout seconds.
+        Returns None if the line was not complete in time, in which case the
+        partial line is kept, and read first by the next read of stderr.
+        """
+        return self._proc.readline_stderr_timeout(max(int(timeout * 1000), 0))
+
+    def read_stdout(self, n=-1, **kwargs):
+        """Read n bytes (or to end of file if n is -1) from stdout."""
+        return self._proc.read_stdout(n)
+
+    def read_stderr(self, n=-1, **kwargs):
+        """Read n bytes (or to end of file if n is -1) from stderr."""
+        return self._proc.read_stderr(n)
+
+    def read_available_stdout(self, **kwargs):
+        """Read the bytes available from stdout, without blocking."""
+        return self._proc.read_available_stdout()
+
+    def read_available_stderr(self, **kwargs):
+        """Read the bytes available from stderr, without blocking."""
+        return self._proc.read_available_stderr()
+
+    def readinto_stdout(self, buffer, **kwargs):
+        """Read from stdout into a writable buffer, returning the byte count."""
+        return self._proc.readinto_stdout(buffer)
+
+    def readinto_stderr(self, buffer, **kwargs):
+        """Read from stderr into a writable buffer, returning the byte count."""
+        return self._proc.readinto_stderr(buffer)
+
+    def stdout_capture(self, **kwargs):
+        """Read the rest of stdout into an OutputCapture, indexed by line.
+        The same capture is returned by later calls.
+        """
+        if self._stdout_capture is None:
+            self._stdout_capture = OutputCapture(*self._proc.capture_stdout())
+        return self._stdout_capture
+
+    def stderr_capture(self, **kwargs):
+        """Read the rest of stderr into an OutputCapture, indexed by line.
+        The same capture is returned by later calls.
+        """
+        if self._stderr_capture is None:
+            self._stderr_capture = OutputCapture(*self._proc.capture_stderr())
+        return self._stderr_capture
+
+    def scan_stdout(self, patterns, **kwargs):
+        """Read the rest of stdout, checking for each of a PatternSet.
+        Returns a list of flags, set for each pattern that was found.
+        """
+        return self._proc.scan_stdout(patterns)
+
+    def scan_stderr(self, patterns, **kwargs):
+        """Read the rest of stderr, checking for each of a PatternSet.
+        Returns a list of flags, set for each pattern that was found.
+        """
+        return self._proc.scan_stderr(patterns)
+
+    def compare_stdout_unordered(self, fname, max_reported=10, **kwargs):
+        """Compare the lines of stdout with those of a file, in any order.
+        Returns (expected lines, actual lines, missing lines, [(line, count)],
+        extra lines, [(line, count)]), reporting at most max_reported lines.
+        """
+        return self._proc.compare_stdout_unordered(fname, max_reported)
+
+    def compare_stderr_unordered(self, fname, max_reported=10, **kwargs):
+        """Compare the lines of stderr with those of a file, in any order.
+        Returns (expected lines, actual lines, missing lines, [(line, count)],
+        extra lines, [(line, count)]), reporting at most max_reported lines.
+        """
+        return self._proc.compare_stderr_unordered(fname, max_reported)
+
     def print_stdout(self, **kwargs):
         return self._proc.print_stdout()
 
@@ -74,33 +259,62 @@ class xProcess(object):
     def kill(self, **kwargs):
         self._proc.kill()
 
+    def close(self, **kwargs):
+        """Kill the process if running, and release its pipes and files."""
+        self._proc.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def check_signalled(self, **kwargs):
         return self._proc.check_signalled()
 
+    def check_finished(self, **kwargs):
+        """Check if the process has finished, without waiting for it."""
+        return self._proc.check_finished()
+
+    def usage(self, **kwargs):
+        """Wait for the process to finish, and return the resources it used:
+        (CPU time in seconds, peak resident set size in bytes, wall time in
+        seconds).
+        """
+        return self._proc.usage()
+
+    def perf_counters(self, **kwargs):
+        """Wait for the process to finish, and return the hardware counts of
+        it and its children, from when it was run: {"instructions": retired
+        instructions, "cache_misses": cache misses (None if not counted)}.
+        Returns None if counters were not enabled when the process started, or
+        the kernel does not allow perf events.
+        """
+        counts = self._proc.perf_counts()
+        if counts is None:
+            return None
+        return dict(zip(PERF_COUNTERS, counts))
+
 
 class xTracedProcess(xProcess):
     def __init__(self, argv, *vec, **kwargs):
         timeout = kwargs.get("timeout", None)
-        input_file = kwargs.get("input_file", None)
         if timeout is None:
             raise ValueError("timeout keyword arg required")
-        if input_file is None:
-            self._proc = _TracedProcess(argv, timeout)
-        else:
-            self._proc = _TracedProcess(argv, timeout, input_file)
+        self._proc = _TracedProcess(
+            argv, timeout, idle_timeout=_idle_timeout_ms(kwargs), **_native_kwargs(kwargs)
+        )
         self._setup_attributes()
 
 
 class xTimeoutProcess(xProcess):
     def __init__(self, argv, *vec, **kwargs):
         timeout = kwargs.get("timeout", None)
-        input_file = kwargs.get("input_file", None)
         if timeout is None:
             raise ValueError("timeout keyword arg required")
-        if input_file is None:
-            self._proc = _TimeoutProcess(argv, timeout)
-        else:
-            self._proc = _TimeoutProcess(argv, timeout, input_file)
+        self._proc = _TimeoutProcess(
+            argv, timeout, idle_timeout=_idle_timeout_ms(kwargs), **_native_kwargs(kwargs)
+        )
         self._setup_attributes()
 
 
@@ -154,6 +368,48 @@ class ExplainProcess(object):
             )
         return ""
 
+    def _explain_read(self, stream, kwargs):
+        if "explain" in kwargs:
+            self._print_coloured(kwargs["explain"], attrs=["bold"], end="\n")
+        else:
+            self._print_coloured(
+                f"Read output from {stream} of Process {self.count}",
+                attrs=["bold"],
+                end="\n",
+            )
+
+    def read_stdout(self, n=-1, **kwargs):
+        self._explain_read("stdout", kwargs)
+        return b""
+
+    def read_stderr(self, n=-1, **kwargs):
+        self._explain_read("stderr", kwargs)
+        return b""
+
+    def read_available_stdout(self, **kwargs):
+        self._explain_read("stdout", kwargs)
+        return b""
+
+    def read_available_stderr(self, **kwargs):
+        self._explain_read("stderr", kwargs)
+        return b""
+
+    def readinto_stdout(self, buffer, **kwargs):
+        self._explain_read("stdout", kwargs)
+        return 0
+
+    def stdout_capture(self, **kwargs):
+        self._explain_read("stdout", kwargs)
+        return OutputCapture(b"", array.array("q", [0]).tobytes())
+
+    def stderr_capture(self, **kwargs):
+        self._explain_read("stderr", kwargs)
+        return OutputCapture(b"", array.array("q", [0]).tobytes())
+
+    def readinto_stderr(self, buffer, **kwargs):
+        self._explain_read("stderr", kwargs)
+        return 0
+
     def send(self, message, **kwargs):
         if "explain" in kwargs:
             self._print_coloured(kwargs["explain"], attrs=["bold"], end="\n")
@@ -267,3 +523,12 @@ class ExplainProcess(object):
         self._print_coloured(
             f"Was Process {self.count} signalled?", attrs=["bold"], end="\n"
         )
+
+    def close(self, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
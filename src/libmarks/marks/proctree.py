@@ -0,0 +1,67 @@
+from collections import namedtuple
+from .process import scan_processes
+
+# Descriptions of the states reported in /proc/<pid>/stat.
+STATES = {
+    "R": "running",
+    "S": "sleeping",
+    "D": "disk sleep",
+    "Z": "zombie",
+    "T": "stopped",
+    "t": "tracing stop",
+    "X": "dead",
+    "I": "idle",
+}
+
+
+class ProcessInfo(namedtuple("ProcessInfo", ["pid", "ppid", "state", "name"])):
+
+    """Information about a single process, as read from /proc."""
+
+    __slots__ = ()
+
+    @property
+    def state_name(self):
+        """Description of the state of the process (eg. running, zombie)."""
+        return STATES.get(self.state, "unknown")
+
+    @property
+    def zombie(self):
+        """Whether the process has exited, but not yet been reaped."""
+        return self.state in ("Z", "X")
+
+
+class ProcessTable(object):
+
+    """Snapshot of the processes running on the system, read from /proc."""
+
+    def __init__(self):
+        self._processes = {}
+        self._children = {}
+        for pid, ppid, state, name in scan_processes():
+            self._processes[pid] = ProcessInfo(pid, ppid, state, name)
+            self._children.setdefault(ppid, []).append(pid)
+
+    def __contains__(self, pid):
+        return pid in self._processes
+
+    def __len__(self):
+        return len(self._processes)
+
+    def get(self, pid):
+        """Return the information for a process, or None if it does not exist."""
+        return self._processes.get(pid)
+
+    def children(self, pid):
+        """Return the direct children of a process."""
+        return [self._processes[c] for c in sorted(self._children.get(pid, []))]
+
+    def descendants(self, pid):
+        """Return all descendants of a process, parents before children."""
+        result = []
+        pending = [pid]
+        while pending:
+            children = self.children(pending.pop(0))
+            result.extend(children)
+            pending.extend(child.pid for child in children)
+        return result
@@ -0,0 +1,233 @@
+import bisect
+import collections
+import itertools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAX_COST = 10**7
+"""Default bound on the work (roughly, line comparisons) of a line match"""
+
+NGRAM_SIZE = 4
+"""Length (in bytes) of the n-grams compared in byte mode"""
+
+_NGRAM_BUCKETS = 2**20
+"""Buckets n-grams are hashed into in byte mode, bounding its memory"""
+
+_CHUNK_SIZE = 2**16
+"""Bytes of output hashed at once in byte mode"""
+
+
+def match_ratio(expected, actual, mode="chars", max_cost=MAX_COST):
+    """Measure the similarity of two outputs, from 0 (nothing in common) to 1
+    (identical), with the matcher registered for mode.
+
+    Outputs are iterables of lines (such as open files, or iter(readline,
+    "")), read once and never held in memory whole. Lines are first compared
+    directly, so identical outputs give 1.0 with no further work, and only
+    what follows a common prefix is given to the matcher.
+    """
+    try:
+        matcher = MATCHERS[mode]
+    except KeyError:
+        raise ValueError(f"Unknown fuzzy matching mode: {mode}")
+
+    # The common prefix matched, in the units of the matcher.
+    length = _UNIT_LENGTHS[matcher.units]
+    expected, actual = iter(expected), iter(actual)
+    prefix = 0
+    for expected_line, actual_line in itertools.zip_longest(expected, actual):
+        if expected_line != actual_line:
+            # Put back the first differing lines.
+            if expected_line is not None:
+                expected = itertools.chain([expected_line], expected)
+            if actual_line is not None:
+                actual = itertools.chain([actual_line], actual)
+            break
+        prefix += length(expected_line)
+    else:
+        return 1.0
+
+    matched, total = matcher(expected, actual, max_cost)
+    matched += prefix
+    total += 2 * prefix
+    return 2 * matched / total if total else 1.0
+
+
+def register_matcher(mode, matcher, units="chars"):
+    """Add a matcher for fuzzy matching, used when fuzzy_mode is mode.
+
+    The matcher is given the two outputs (iterators of lines, after any
+    common prefix) and the cost bound, and returns (matched, total): the
+    units ("lines", "chars" or UTF-8 "bytes") of output that matched, and
+    the units of both outputs together.
+    """
+    if units not in _UNIT_LENGTHS:
+        raise ValueError(f"Unknown units for a matcher: {units}")
+    matcher.units = units
+    MATCHERS[mode] = matcher
+
+
+def _encoded_length(line):
+    """Length of a line in bytes, encoded as the byte matcher encodes it."""
+    return len(line.encode(errors="surrogateescape"))
+
+
+_UNIT_LENGTHS = {"lines": lambda line: 1, "chars": len, "bytes": _encoded_length}
+"""Length of a line in each of the units a matcher can count in"""
+
+
+def _match_chars(expected, actual, max_cost):
+    """Overlap of the multisets of characters of the outputs (the measure of
+    difflib's quick_ratio), counted as the lines arrive.
+    """
+    expected_counts, actual_counts = collections.Counter(), collections.Counter()
+    for line in expected:
+        expected_counts.update(line)
+    for line in actual:
+        actual_counts.update(line)
+    matched = sum((expected_counts & actual_counts).values())
+    total = sum(expected_counts.values()) + sum(actual_counts.values())
+    return matched, total
+
+
+def _lcs_length(a, b, max_distance):
+    """Length of the longest common subsequence of two sequences, by Myers'
+    O((N + M)D) algorithm, or None if they differ by more than max_distance
+    insertions and deletions.
+    """
+    n, m = len(a), len(b)
+    max_distance = min(max_distance, n + m)
+    offset = max_distance + 1
+    furthest = [0] * (2 * max_distance + 3)
+    for distance in range(max_distance + 1):
+        for k in range(-distance, distance + 1, 2):
+            if k == -distance or (
+                k != distance and furthest[offset + k - 1] < furthest[offset + k + 1]
+            ):
+                x = furthest[offset + k + 1]
+            else:
+                x = furthest[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            furthest[offset + k] = x
+            if x >= n and y >= m:
+                return (n + m - distance) // 2
+    return None
+
+
+def _greedy_common_length(a, b):
+    """Length of a common subsequence of two sequences, found by matching
+    each item of b to the next occurrence in a, in O((N + M) log N) time.
+    It is at most the longest, and the same when few items are moved.
+    """
+    positions = collections.defaultdict(list)
+    for i, item in enumerate(a):
+        positions[item].append(i)
+    last = -1
+    length = 0
+    for item in b:
+        found = positions.get(item)
+        if found:
+            i = bisect.bisect_right(found, last)
+            if i < len(found):
+                last = found[i]
+                length += 1
+    return length
+
+
+def _match_lines(expected, actual, max_cost):
+    """Longest common subsequence of the lines of the outputs (as hashes).
+    If finding it would take more than max_cost work, a common subsequence
+    found greedily is used instead.
+    """
+    a = [hash(line) for line in expected]
+    b = [hash(line) for line in actual]
+
+    # Common lines at the end need no search.
+    suffix = 0
+    while suffix < min(len(a), len(b)) and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+    if suffix:
+        a, b = a[:-suffix], b[:-suffix]
+
+    total = len(a) + len(b) + 2 * suffix
+    matched = None
+    if a and b:
+        matched = _lcs_length(a, b, max(max_cost // (len(a) + len(b)), 1))
+    else:
+        matched = 0
+    if matched is None:
+        matched = _greedy_common_length(a, b)
+    return matched + suffix, total
+
+
+def _ngram_chunks(lines):
+    """Split output into chunks of bytes, overlapping by an n-gram less one
+    byte, so every n-gram is in exactly one chunk. The output is padded at
+    the start, so each byte ends one n-gram (even in short outputs).
+    """
+    pending = bytes(NGRAM_SIZE - 1)
+    for line in lines:
+        pending += line.encode(errors="surrogateescape")
+        if len(pending) >= _CHUNK_SIZE:
+            yield pending
+            pending = pending[-(NGRAM_SIZE - 1) :]
+    if len(pending) >= NGRAM_SIZE:
+        yield pending
+
+
+def _count_ngrams(lines):
+    """Count the n-grams of the output, hashed into a fixed number of buckets,
+    so time is linear in the output and memory is constant.
+    Returns (counts, characters).
+    """
+    counts = numpy.zeros(_NGRAM_BUCKETS, dtype=numpy.int64)
+    length = 0
+    for chunk in _ngram_chunks(lines):
+        data = numpy.frombuffer(chunk, dtype=numpy.uint8).astype(numpy.uint64)
+        grams = numpy.zeros(len(data) - NGRAM_SIZE + 1, dtype=numpy.uint64)
+        for i in range(NGRAM_SIZE):
+            grams = (grams << numpy.uint64(8)) | data[i : len(grams) + i]
+        # Multiplicative hash into the buckets.
+        buckets = (grams * numpy.uint64(0x9E3779B97F4A7C15)) >> numpy.uint64(44)
+        numpy.add.at(counts, buckets.astype(numpy.int64), 1)
+        length += len(grams)
+    return counts, length
+
+
+def _count_ngrams_exact(lines):
+    """Count the n-grams of the output exactly, without NumPy."""
+    counts = collections.Counter()
+    for chunk in _ngram_chunks(lines):
+        counts.update(
+            chunk[i : i + NGRAM_SIZE] for i in range(len(chunk) - NGRAM_SIZE + 1)
+        )
+    return counts, sum(counts.values())
+
+
+def _match_bytes(expected, actual, max_cost):
+    """Overlap of the multisets of byte n-grams of the outputs, which unlike
+    single characters, is sensitive to local order. Uses NumPy if available.
+    """
+    if numpy is not None:
+        expected_counts, expected_length = _count_ngrams(expected)
+        actual_counts, actual_length = _count_ngrams(actual)
+        matched = int(numpy.minimum(expected_counts, actual_counts).sum())
+    else:
+        expected_counts, expected_length = _count_ngrams_exact(expected)
+        actual_counts, actual_length = _count_ngrams_exact(actual)
+        matched = sum((expected_counts & actual_counts).values())
+    return matched, expected_length + actual_length
+
+
+MATCHERS = {}
+"""Matcher for each fuzzy matching mode"""
+
+register_matcher("chars", _match_chars)
+register_matcher("lines", _match_lines, units="lines")
+register_matcher("bytes", _match_bytes, units="bytes")
@@ -0,0 +1,146 @@
+import os
+import struct
+from multiprocessing import shared_memory
+
+FIXTURE_STORE_ENV = "MARKS_FIXTURE_STORE"
+"""Environment variable naming the fixture store of a marking run, read by
+its workers (and the native expected output cache)"""
+
+_MAGIC = b"MARKSFX2"
+_HEADER = struct.Struct("=8sQ")
+"""Store header: magic, number of files"""
+_ENTRY = struct.Struct("=QQQQqI")
+"""Index entry: offset, size, device, inode, modification time (ns), length
+of the path (which follows the entry)"""
+
+
+def _fixture_paths(paths):
+    """Get the real paths of the files given, and of the files under the
+    directories given, once each.
+    """
+    found = {}
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    found.setdefault(os.path.realpath(os.path.join(root, name)))
+        else:
+            found.setdefault(os.path.realpath(path))
+    return [path for path in found if os.path.isfile(path)]
+
+
+class FixtureStore(object):
+
+    """Expected output and other fixture files, loaded once by the parent of
+    a marking run into one block of shared memory. Workers attach to the
+    store by name, so each file is held in memory once however many workers
+    there are, and workers never read it from the filesystem.
+
+    The block starts with an index of the files (by real path, with their
+    size, device, inode and modification time), followed by their
+    contents.
+    """
+
+    def __init__(self, memory):
+        self._memory = memory
+        self.name = memory.name
+        """Name to attach to the store by"""
+        self.files = {}
+        """(stamp, contents) of each file, by real path"""
+
+        buf = memory.buf
+        magic, count = _HEADER.unpack_from(buf, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"Not a fixture store: {self.name}")
+        position = _HEADER.size
+        for _ in range(count):
+            offset, size, device, inode, modified, length = _ENTRY.unpack_from(
+                buf, position
+            )
+            position += _ENTRY.size
+            path = bytes(buf[position : position + length]).decode()
+            position += length
+            self.files[path] = (
+                (device, inode, size, modified),
+                buf[offset : offset + size],
+            )
+
+    @classmethod
+    def create(cls, paths):
+        """Load files (and the files under directories) into a new store.
+        The store lasts until unlink is called.
+        """
+        files = []
+        for path in _fixture_paths(paths):
+            info = os.stat(path)
+            stamp = (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns)
+            files.append((path, os.fsencode(path), stamp))
+
+        index_size = _HEADER.size + sum(
+            _ENTRY.size + len(encoded) for _, encoded, _ in files
+        )
+        total = index_size + sum(stamp[2] for _, _, stamp in files)
+        memory = shared_memory.SharedMemory(create=True, size=max(total, 1))
+        try:
+            buf = memory.buf
+            _HEADER.pack_into(buf, 0, _MAGIC, len(files))
+            position = _HEADER.size
+            offset = index_size
+            for path, encoded, stamp in files:
+                device, inode, size, modified = stamp
+                contents = buf[offset : offset + size]
+                with open(path, "rb") as f:
+                    read = 0
+                    while read < size:
+                        count = f.readinto(contents[read:])
+                        if not count:
+                            # File shrunk since it was found.
+                            raise OSError(f"Fixture file changed while loading: {path}")
+                        read += count
+                contents.release()
+                _ENTRY.pack_into(
+                    buf, position, offset, size, device, inode, modified, len(encoded)
+                )
+                position += _ENTRY.size
+                buf[position : position + len(encoded)] = encoded
+                position += len(encoded)
+                offset += size
+            del buf
+            return cls(memory)
+        except BaseException:
+            memory.close()
+            memory.unlink()
+            raise
+
+    @classmethod
+    def attach(cls, name):
+        """Attach to the store created (by another process) with name."""
+        return cls(shared_memory.SharedMemory(name=name))
+
+    @property
+    def size(self):
+        """Total size of the files in the store, in bytes"""
+        return sum(len(contents) for _, contents in self.files.values())
+
+    def get(self, path, stamp):
+        """Get the contents of a file by real path, if it is in the store and
+        unchanged since (stamp as for the store index). Returns None
+        otherwise.
+        """
+        entry = self.files.get(path)
+        if entry is None or entry[0] != stamp:
+            return None
+        return entry[1]
+
+    def close(self):
+        """Detach from the store."""
+        for _, contents in self.files.values():
+            contents.release()
+        self.files = {}
+        self._memory.close()
+
+    def unlink(self):
+        """Detach from the store and remove it, once no longer needed."""
+        self.close()
+        self._memory.unlink()
@@ -1,5 +1,6 @@
 import sys
 from .case import _TestWrapper
+from .fixtures import fixture_processes
 from .result import TestResult
 from .util import strclass
 
@@ -129,6 +130,13 @@ class TestSuite(object):
 
             # TODO: Add error if setup failed.
 
+        fixtures = fixture_processes(class_)
+        if fixtures and wrapper.success:
+            # Start the processes shared by the tests of the class.
+            with wrapper.test_executer(self):
+                for fixture in fixtures:
+                    fixture.start(class_)
+
         # Record result for all test classes. If no setup_class() method
         # available, then treat as success.
         result.add_class_setup(class_, wrapper.success)
@@ -145,6 +153,10 @@ class TestSuite(object):
             # if not wrapper.success:
             #     result.add_error()
 
+        # Kill the processes shared by the tests of the class.
+        for fixture in fixture_processes(class_):
+            fixture.stop(class_)
+
     def _tear_down_classes(self, result):
         for class_ in result.test_classes():
             self._tear_down_class(class_, result)
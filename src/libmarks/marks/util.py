@@ -1,4 +1,8 @@
+import errno
 import os
+import pathlib
+import select
+import socket
 
 # Maximum length for a string representation of an object.
 _MAX_LENGTH = 80
@@ -27,6 +31,66 @@ def safe_repr(obj, length=None):
     return result[:length] + " [truncated]..."
 
 
+def protection_library():
+    """Get the path to the included protection library (libprotect.so)."""
+    return str(pathlib.Path(__file__).resolve().parent / "libprotect.so")
+
+
+def open_fds():
+    """Return the set of file descriptors currently open in this process."""
+    fd_dir = "/proc/self/fd" if os.path.isdir("/proc/self/fd") else "/dev/fd"
+    fds = set()
+    for name in os.listdir(fd_dir):
+        fd = int(name)
+        try:
+            os.fstat(fd)
+        except OSError:
+            # Descriptor used to list the directory, now closed.
+            continue
+        fds.add(fd)
+    return fds
+
+
+# Socket state of a listening TCP socket, in /proc/net/tcp.
+_TCP_LISTEN = "0A"
+
+
+def listening_ports(pid="self"):
+    """Return the set of local TCP ports with a listening socket in the
+    network namespace of the given process, read from /proc/<pid>/net, or
+    None if it is unavailable.
+    """
+    ports = set()
+    found = False
+    for table in (f"/proc/{pid}/net/tcp", f"/proc/{pid}/net/tcp6"):
+        try:
+            with open(table) as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+        found = True
+        for line in lines:
+            fields = line.split()
+            if len(fields) > 3 and fields[3] == _TCP_LISTEN:
+                ports.add(int(fields[1].rsplit(":", 1)[1], 16))
+    return ports if found else None
+
+
+def port_accepts(port, timeout, host="127.0.0.1"):
+    """Check if a connection to the port is accepted within timeout seconds,
+    using a non-blocking connect.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.setblocking(False)
+        result = sock.connect_ex((host, port))
+        if result == errno.EINPROGRESS:
+            _, writable, _ = select.select([], [sock], [], timeout)
+            if not writable:
+                return False
+            result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        return result == 0
+
+
 # Colours for terminal text
 # Based on Termcolor by Konstantin Lepa <konstantin.lepa@gmail.com>
 
@@ -20,10 +20,14 @@ boostMacros = [('BOOST_BIND_GLOBAL_PLACEHOLDERS', '1')]
 boostLibs = ['boost_python-py36']
 
 moduleProcess = Extension('marks.process', sources=['src/process.cpp', 'src/glue.cpp', 
-                                             'src/traced_process.cpp'],
-                            libraries = boostLibs,
+                                             'src/traced_process.cpp', 'src/proc_table.cpp',
+                                             'src/pattern_set.cpp', 'src/probes.cpp',
+                                             'src/namespace.cpp', 'src/perf_counters.cpp',
+                                             'src/expected_cache.cpp'],
+                            libraries = boostLibs + ['rt'],
                             define_macros = boostMacros)
-moduleProtect = Extension('libprotect', sources=['src/protection.c'])
+moduleProtect = Extension('libprotect', sources=['src/protection.c'],
+                            libraries = ['dl', 'rt'])
 
 setup(name='marks', version='1.0',
         description='CSSE2310 libmarks',
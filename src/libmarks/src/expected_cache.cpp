@@ -0,0 +1,182 @@
+#include <string>
+#include <unordered_map>
+#include <cstdint>
+#include <cstring>
+#include <cstdlib>
+#include <climits>
+#include <unistd.h>
+#include <fcntl.h>
+#include <sys/stat.h>
+#include <sys/mman.h>
+#include <pthread.h>
+#include <boost/shared_ptr.hpp>
+
+#include "process.hpp"
+
+/** Expected Output Cache **/
+
+/* Fixture store of a marking run, shared by its workers (see store.py) */
+#define FIXTURE_STORE_ENV "MARKS_FIXTURE_STORE"
+#define STORE_MAGIC "MARKSFX2"
+#define STORE_HEADER_SIZE 16
+#define STORE_ENTRY_SIZE 44
+
+/* Expected output files mapped by this process, by real path */
+namespace {
+    std::unordered_map<std::string, boost::shared_ptr<ExpectedFile> > expected_files;
+    pthread_mutex_t expected_files_mutex = PTHREAD_MUTEX_INITIALIZER;
+    bool store_attached = false;
+}
+
+ExpectedFile::ExpectedFile()
+    : data(NULL), size(0), device(0), inode(0), modified(), mapped(false)
+{
+}
+
+ExpectedFile::~ExpectedFile()
+{
+    if (mapped && data != NULL)
+        munmap((void *) data, size);
+}
+
+/**
+ * Check if a loaded file is still the file at its path.
+ * @param  info Status of the file at the path.
+ * @return      true if the file is unchanged since it was loaded.
+ */
+bool ExpectedFile::matches(const struct stat& info) const
+{
+    return device == info.st_dev && inode == info.st_ino &&
+        size == (size_t) info.st_size &&
+        modified.tv_sec == info.st_mtim.tv_sec &&
+        modified.tv_nsec == info.st_mtim.tv_nsec;
+}
+
+/**
+ * Map a file into memory, and record its size.
+ * @param  path Real path of the file.
+ * @param  info Status of the file.
+ * @return      The loaded file, or NULL if it could not be mapped.
+ */
+static boost::shared_ptr<ExpectedFile> map_expected_file(const char *path,
+        const struct stat& info)
+{
+    boost::shared_ptr<ExpectedFile> file(new ExpectedFile());
+    file->mapped = true;
+    file->device = info.st_dev;
+    file->inode = info.st_ino;
+    file->modified = info.st_mtim;
+    if (info.st_size > 0) {
+        int fd = open(path, O_RDONLY | O_CLOEXEC);
+        if (fd == -1)
+            return boost::shared_ptr<ExpectedFile>();
+        void *data = mmap(NULL, info.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+        close(fd);
+        if (data == MAP_FAILED)
+            return boost::shared_ptr<ExpectedFile>();
+        file->data = (const char *) data;
+        file->size = info.st_size;
+    }
+    return file;
+}
+
+template <typename T>
+static T read_store_value(const char *position)
+{
+    T value;
+    memcpy(&value, position, sizeof(T));
+    return value;
+}
+
+/**
+ * Add the files of the fixture store of the marking run this process is a
+ * worker of (if any) to the cache. The store is mapped once, and stays
+ * mapped, as its files are shared with every worker.
+ */
+static void attach_fixture_store()
+{
+    const char *name = getenv(FIXTURE_STORE_ENV);
+    if (name == NULL || *name == '\0')
+        return;
+
+    int fd = shm_open(("/" + std::string(name)).c_str(), O_RDONLY, 0);
+    if (fd == -1)
+        return;
+    struct stat info;
+    void *mapping = MAP_FAILED;
+    if (fstat(fd, &info) == 0 && info.st_size >= STORE_HEADER_SIZE)
+        mapping = mmap(NULL, info.st_size, PROT_READ, MAP_SHARED, fd, 0);
+    close(fd);
+    if (mapping == MAP_FAILED)
+        return;
+
+    const char *store = (const char *) mapping;
+    size_t storeSize = info.st_size;
+    if (memcmp(store, STORE_MAGIC, strlen(STORE_MAGIC)) != 0) {
+        munmap(mapping, storeSize);
+        return;
+    }
+
+    // Index entries: offset, size, device, inode, modification time (ns),
+    // then the path, prefixed by its length.
+    uint64_t count = read_store_value<uint64_t>(store + 8);
+    size_t position = STORE_HEADER_SIZE;
+    for (uint64_t i = 0; i < count; ++i) {
+        if (position + STORE_ENTRY_SIZE > storeSize)
+            break;
+        const char *entry = store + position;
+        uint64_t offset = read_store_value<uint64_t>(entry);
+        uint64_t size = read_store_value<uint64_t>(entry + 8);
+        int64_t modified = read_store_value<int64_t>(entry + 32);
+        uint32_t pathLength = read_store_value<uint32_t>(entry + 40);
+        position += STORE_ENTRY_SIZE;
+        if (position + pathLength > storeSize || offset + size > storeSize)
+            break;
+
+        boost::shared_ptr<ExpectedFile> file(new ExpectedFile());
+        file->data = size > 0 ? store + offset : NULL;
+        file->size = size;
+        file->device = read_store_value<uint64_t>(entry + 16);
+        file->inode = read_store_value<uint64_t>(entry + 24);
+        file->modified.tv_sec = modified / 1000000000;
+        file->modified.tv_nsec = modified % 1000000000;
+        expected_files[std::string(store + position, pathLength)] = file;
+        position += pathLength;
+    }
+}
+
+/**
+ * Get an expected output file, mapping it into memory the first time it is
+ * used, or if it has changed since. Files in the fixture store of a marking
+ * run are served from it.
+ * @param  filePath Path to the file.
+ * @return          The file, shared with every other user of it.
+ */
+boost::shared_ptr<ExpectedFile> load_expected_file(const char *filePath)
+{
+    char path[PATH_MAX];
+    struct stat info;
+    if (realpath(filePath, path) == NULL || stat(path, &info) == -1) {
+        throw StreamException();
+    }
+
+    pthread_mutex_lock(&expected_files_mutex);
+    if (!store_attached) {
+        store_attached = true;
+        attach_fixture_store();
+    }
+    boost::shared_ptr<ExpectedFile>& cached = expected_files[path];
+    if (!cached || !cached->matches(info)) {
+        cached = map_expected_file(path, info);
+    }
+    boost::shared_ptr<ExpectedFile> file = cached;
+    if (!file) {
+        expected_files.erase(path);
+    }
+    pthread_mutex_unlock(&expected_files_mutex);
+
+    if (!file) {
+        throw StreamException();
+    }
+    return file;
+}
@@ -111,6 +111,11 @@ void stream_finished_exception_translator(const StreamFinishedException& e) {
 }
 
 
+void namespace_exception_translator(const NamespaceException& e) {
+    PyErr_SetString(PyExc_RuntimeError, "MARKS: Could not create network namespace");
+}
+
+
 BOOST_PYTHON_MODULE(process)
 {
     using namespace boost::python;
@@ -118,7 +123,8 @@ BOOST_PYTHON_MODULE(process)
     // Register interable conversions.
     iterable_converter()
         // Build-in type.
-        .from_python<std::vector<std::string> >();
+        .from_python<std::vector<std::string> >()
+        .from_python<std::vector<int> >();
 
     register_exception_translator<CloseException>(&close_exception_translator);
     register_exception_translator<ExecException>(&exec_exception_translator);
@@ -128,19 +134,40 @@ BOOST_PYTHON_MODULE(process)
     register_exception_translator<SignalException>(&signal_exception_translator);
     register_exception_translator<StreamException>(&stream_exception_translator);
     register_exception_translator<StreamFinishedException>(&stream_finished_exception_translator);
+    register_exception_translator<NamespaceException>(&namespace_exception_translator);
 
     /* Allow LD_PRELOAD value to be set for all processes */
     def("set_ld_preload", set_ld_preload);
     def("get_ld_preload", get_ld_preload);
 
+    /* Allow CPUs to be set for all processes */
+    def("set_cpu_affinity", set_cpu_affinity);
+    def("get_cpu_affinity", get_cpu_affinity);
+
+    /* Allow hardware counters to be enabled for all processes */
+    def("set_perf_counters", set_perf_counters);
+    def("get_perf_counters", get_perf_counters);
+
+    class_<PatternSet>("PatternSet", "Set of patterns found in a single pass", init<std::vector<std::string> >())
+        .def("__len__", &PatternSet::size)
+    ;
+
+    /* Inspect processes running on the system */
+    def("scan_processes", scan_processes);
+    def("set_child_subreaper", set_child_subreaper);
+    def("wait_for_file", wait_for_file);
+    def("create_network_namespace", create_network_namespace);
+    def("set_network_namespace", set_network_namespace);
+
     class_<Process, boost::shared_ptr<Process> >("Process", "Process class docstring", no_init)
-        .def("__init__", make_constructor(&create_process, default_call_policies(), (arg("argv"), arg("input_file")="")))
+        .def("__init__", make_constructor(&create_process, default_call_policies(), (arg("argv"), arg("input_file")="", arg("capture_file")=false)))
         .add_property("pid", &Process::get_pid)
         .add_property("abnormal_exit", &Process::get_abnormal_exit)
         .add_property("signalled", &Process::get_signalled)
         .add_property("signal", &Process::get_signal)
         .def("exit_status", &Process::get_exit_status)
         .def("timeout", &Process::get_timeout)
+        .def("stall_reason", &Process::get_stall_reason)
         .def("send", &Process::send)
         .def("send_file", &Process::send_file)
         .def("finish_input", &Process::finish_input)
@@ -150,6 +177,20 @@ BOOST_PYTHON_MODULE(process)
         .def("expect_stderr_file", &Process::expect_stderr_file)
         .def("readline_stdout", &Process::readline_stdout)
         .def("readline_stderr", &Process::readline_stderr)
+        .def("readline_stdout_timeout", &Process::readline_stdout_timeout)
+        .def("readline_stderr_timeout", &Process::readline_stderr_timeout)
+        .def("read_stdout", &Process::read_stdout, (arg("n")=-1))
+        .def("read_stderr", &Process::read_stderr, (arg("n")=-1))
+        .def("read_available_stdout", &Process::read_available_stdout)
+        .def("read_available_stderr", &Process::read_available_stderr)
+        .def("readinto_stdout", &Process::readinto_stdout)
+        .def("readinto_stderr", &Process::readinto_stderr)
+        .def("capture_stdout", &Process::capture_stdout)
+        .def("capture_stderr", &Process::capture_stderr)
+        .def("scan_stdout", &Process::scan_stdout)
+        .def("scan_stderr", &Process::scan_stderr)
+        .def("compare_stdout_unordered", &Process::compare_stdout_unordered)
+        .def("compare_stderr_unordered", &Process::compare_stderr_unordered)
         .def("print_stdout", &Process::print_stdout)
         .def("print_stderr", &Process::print_stderr)
         .def("assert_exit_status", &Process::assert_exit_status)
@@ -158,17 +199,22 @@ BOOST_PYTHON_MODULE(process)
         .def("send_signal", &Process::send_signal)
         .def("send_signal_group", &Process::send_signal_group)
         .def("kill", &Process::send_kill)
+        .def("close", &Process::close_process)
         .def("check_signalled", &Process::check_signalled)
+        .def("check_finished", &Process::check_finished)
+        .def("usage", &Process::get_usage)
+        .def("perf_counts", &Process::get_perf_counts)
     ;
 
     class_<TimeoutProcess, boost::shared_ptr<TimeoutProcess>, bases<Process> >("TimeoutProcess", "Timeout Process class docstring", no_init)
-        .def("__init__", make_constructor(&create_timeout_process, default_call_policies(), (arg("argv"), arg("timeout"), arg("input_file")="")))
+        .def("__init__", make_constructor(&create_timeout_process, default_call_policies(), (arg("argv"), arg("timeout"), arg("input_file")="", arg("capture_file")=false, arg("idle_timeout")=0)))
         .add_property("pid", &TimeoutProcess::get_pid)
         .add_property("abnormal_exit", &TimeoutProcess::get_abnormal_exit)
         .add_property("signalled", &TimeoutProcess::get_signalled)
         .add_property("signal", &TimeoutProcess::get_signal)
         .def("exit_status", &TimeoutProcess::get_exit_status)
         .def("timeout", &TimeoutProcess::get_timeout)
+        .def("stall_reason", &TimeoutProcess::get_stall_reason)
         .def("send", &TimeoutProcess::send)
         .def("send_file", &TimeoutProcess::send_file)
         .def("finish_input", &TimeoutProcess::finish_input)
@@ -178,6 +224,20 @@ BOOST_PYTHON_MODULE(process)
         .def("expect_stderr_file", &TimeoutProcess::expect_stderr_file)
         .def("readline_stdout", &TimeoutProcess::readline_stdout)
         .def("readline_stderr", &TimeoutProcess::readline_stderr)
+        .def("readline_stdout_timeout", &TimeoutProcess::readline_stdout_timeout)
+        .def("readline_stderr_timeout", &TimeoutProcess::readline_stderr_timeout)
+        .def("read_stdout", &TimeoutProcess::read_stdout, (arg("n")=-1))
+        .def("read_stderr", &TimeoutProcess::read_stderr, (arg("n")=-1))
+        .def("read_available_stdout", &TimeoutProcess::read_available_stdout)
+        .def("read_available_stderr", &TimeoutProcess::read_available_stderr)
+        .def("readinto_stdout", &TimeoutProcess::readinto_stdout)
+        .def("readinto_stderr", &TimeoutProcess::readinto_stderr)
+        .def("capture_stdout", &TimeoutProcess::capture_stdout)
+        .def("capture_stderr", &TimeoutProcess::capture_stderr)
+        .def("scan_stdout", &TimeoutProcess::scan_stdout)
+        .def("scan_stderr", &TimeoutProcess::scan_stderr)
+        .def("compare_stdout_unordered", &TimeoutProcess::compare_stdout_unordered)
+        .def("compare_stderr_unordered", &TimeoutProcess::compare_stderr_unordered)
         .def("print_stdout", &TimeoutProcess::print_stdout)
         .def("print_stderr", &TimeoutProcess::print_stderr)
         .def("assert_exit_status", &TimeoutProcess::assert_exit_status)
@@ -186,17 +246,22 @@ BOOST_PYTHON_MODULE(process)
         .def("send_signal", &TimeoutProcess::send_signal)
         .def("send_signal_group", &TimeoutProcess::send_signal_group)
         .def("kill", &TimeoutProcess::send_kill)
+        .def("close", &TimeoutProcess::close_process)
         .def("check_signalled", &TimeoutProcess::check_signalled)
+        .def("check_finished", &TimeoutProcess::check_finished)
+        .def("usage", &TimeoutProcess::get_usage)
+        .def("perf_counts", &TimeoutProcess::get_perf_counts)
     ;
 
     class_<TracedProcess, boost::shared_ptr<TracedProcess>, bases<Process> >("TracedProcess", "Traced Process class docstring", no_init)
-        .def("__init__", make_constructor(&create_traced_process, default_call_policies(), (arg("argv"), arg("timeout"), arg("input_file")="")))
+        .def("__init__", make_constructor(&create_traced_process, default_call_policies(), (arg("argv"), arg("timeout"), arg("input_file")="", arg("capture_file")=false, arg("idle_timeout")=0)))
         .add_property("pid", &TracedProcess::get_pid)
         .add_property("abnormal_exit", &TracedProcess::get_abnormal_exit)
         .add_property("signalled", &TracedProcess::get_signalled)
         .add_property("signal", &TracedProcess::get_signal)
         .def("exit_status", &TracedProcess::get_exit_status)
         .def("timeout", &TracedProcess::get_timeout)
+        .def("stall_reason", &TracedProcess::get_stall_reason)
         .def("send", &TracedProcess::send)
         .def("send_file", &TracedProcess::send_file)
         .def("finish_input", &TracedProcess::finish_input)
@@ -206,6 +271,20 @@ BOOST_PYTHON_MODULE(process)
         .def("expect_stderr_file", &TracedProcess::expect_stderr_file)
         .def("readline_stdout", &TracedProcess::readline_stdout)
         .def("readline_stderr", &TracedProcess::readline_stderr)
+        .def("readline_stdout_timeout", &TracedProcess::readline_stdout_timeout)
+        .def("readline_stderr_timeout", &TracedProcess::readline_stderr_timeout)
+        .def("read_stdout", &TracedProcess::read_stdout, (arg("n")=-1))
+        .def("read_stderr", &TracedProcess::read_stderr, (arg("n")=-1))
+        .def("read_available_stdout", &TracedProcess::read_available_stdout)
+        .def("read_available_stderr", &TracedProcess::read_available_stderr)
+        .def("readinto_stdout", &TracedProcess::readinto_stdout)
+        .def("readinto_stderr", &TracedProcess::readinto_stderr)
+        .def("capture_stdout", &TracedProcess::capture_stdout)
+        .def("capture_stderr", &TracedProcess::capture_stderr)
+        .def("scan_stdout", &TracedProcess::scan_stdout)
+        .def("scan_stderr", &TracedProcess::scan_stderr)
+        .def("compare_stdout_unordered", &TracedProcess::compare_stdout_unordered)
+        .def("compare_stderr_unordered", &TracedProcess::compare_stderr_unordered)
         .def("print_stdout", &TracedProcess::print_stdout)
         .def("print_stderr", &TracedProcess::print_stderr)
         .def("assert_exit_status", &TracedProcess::assert_exit_status)
@@ -214,7 +293,11 @@ BOOST_PYTHON_MODULE(process)
         .def("send_signal", &TracedProcess::send_signal)
         .def("send_signal_group", &TracedProcess::send_signal_group)
         .def("kill", &TracedProcess::send_kill)
+        .def("close", &TracedProcess::close_process)
         .def("check_signalled", &TracedProcess::check_signalled)
+        .def("check_finished", &TracedProcess::check_finished)
+        .def("usage", &TracedProcess::get_usage)
+        .def("perf_counts", &TracedProcess::get_perf_counts)
         .def("child_pids", &TracedProcess::child_pids_list)
     ;
 
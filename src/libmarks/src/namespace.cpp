@@ -0,0 +1,195 @@
+#include <string>
+#include <cstdio>
+#include <cstring>
+#include <cerrno>
+#include <csignal>
+#include <unistd.h>
+#include <fcntl.h>
+#include <sys/types.h>
+#include <sys/wait.h>
+#include <boost/python.hpp>
+
+#ifdef __linux__
+#include <sched.h>
+#include <net/if.h>
+#include <sys/ioctl.h>
+#include <sys/prctl.h>
+#include <sys/socket.h>
+#include <sys/syscall.h>
+#endif
+
+#include "process.hpp"
+
+/** Network Namespaces **/
+
+/* Namespaces joined by every Process created, or -1 for none */
+namespace {
+    int userNamespace = -1;
+    int networkNamespace = -1;
+}
+
+#ifdef __linux__
+/**
+ * Write a value to a file, such as a mapping in /proc/self.
+ * @return 0 on success, -1 on failure.
+ */
+static int write_file(const char *path, const char *value)
+{
+    int fd = open(path, O_WRONLY);
+    if (fd == -1)
+        return -1;
+    ssize_t length = strlen(value);
+    ssize_t written = write(fd, value, length);
+    close(fd);
+    return written == length ? 0 : -1;
+}
+
+/**
+ * Move this process into a new user and network namespace, keeping its user
+ * and group IDs, and bring up the loopback interface (the only interface in
+ * the new network namespace).
+ * @return 0 on success, -1 on failure.
+ */
+static int enter_new_namespace(uid_t uid, gid_t gid)
+{
+    char map[64];
+
+    if (unshare(CLONE_NEWUSER | CLONE_NEWNET) == -1)
+        return -1;
+
+    // Groups must be denied before an unprivileged process can map its group.
+    if (write_file("/proc/self/setgroups", "deny") == -1 && errno != ENOENT)
+        return -1;
+    snprintf(map, sizeof(map), "%d %d 1\n", (int) uid, (int) uid);
+    if (write_file("/proc/self/uid_map", map) == -1)
+        return -1;
+    snprintf(map, sizeof(map), "%d %d 1\n", (int) gid, (int) gid);
+    if (write_file("/proc/self/gid_map", map) == -1)
+        return -1;
+
+    int sock = socket(AF_INET, SOCK_DGRAM, 0);
+    if (sock == -1)
+        return -1;
+    struct ifreq ifr;
+    memset(&ifr, 0, sizeof(ifr));
+    strncpy(ifr.ifr_name, "lo", IFNAMSIZ - 1);
+    int result = ioctl(sock, SIOCGIFFLAGS, &ifr);
+    if (result != -1) {
+        ifr.ifr_flags |= IFF_UP | IFF_RUNNING;
+        result = ioctl(sock, SIOCSIFFLAGS, &ifr);
+    }
+    close(sock);
+    return result;
+}
+#endif
+
+/**
+ * Create a process holding open a new, unprivileged user and network
+ * namespace, with only a loopback interface. The process waits until it is
+ * killed, and is killed if this process exits.
+ * @return The process ID of the holder, whose namespaces can be joined with
+ *         set_network_namespace().
+ */
+pid_t create_network_namespace()
+{
+#ifdef __linux__
+    int ready[2];
+    if (pipe(ready) == -1)
+        throw PipeException();
+
+    uid_t uid = getuid();
+    gid_t gid = getgid();
+    pid_t pid = fork();
+    if (pid == -1) {
+        close(ready[READ]);
+        close(ready[WRITE]);
+        throw NamespaceException();
+    }
+
+    if (pid == 0) {
+        // Do not hold open any pipes (or other files) of the parent.
+        int keep = STDERR_FILENO + 1;
+        if (ready[WRITE] != keep) {
+            dup2(ready[WRITE], keep);
+            ready[WRITE] = keep;
+        }
+#ifdef SYS_close_range
+        if (syscall(SYS_close_range, keep + 1, ~0U, 0) == -1)
+#endif
+        {
+            long maxFd = sysconf(_SC_OPEN_MAX);
+            for (int fd = keep + 1; fd < maxFd; ++fd)
+                close(fd);
+        }
+        prctl(PR_SET_PDEATHSIG, SIGKILL);
+
+        char status = enter_new_namespace(uid, gid) == 0;
+        write(ready[WRITE], &status, 1);
+        close(ready[WRITE]);
+        if (!status)
+            _exit(1);
+
+        while (true)
+            pause();
+    }
+
+    char status = 0;
+    close(ready[WRITE]);
+    ssize_t length = read(ready[READ], &status, 1);
+    close(ready[READ]);
+    if (length != 1 || !status) {
+        kill(pid, SIGKILL);
+        waitpid(pid, NULL, 0);
+        throw NamespaceException();
+    }
+    return pid;
+#else
+    throw NamespaceException();
+#endif
+}
+
+/**
+ * Set the namespaces joined by every Process created from now on.
+ * @param pid The holder of the namespaces (from create_network_namespace),
+ *            or 0 for processes to share the network of this process.
+ */
+void set_network_namespace(pid_t pid)
+{
+    if (userNamespace != -1) {
+        close(userNamespace);
+        userNamespace = -1;
+    }
+    if (networkNamespace != -1) {
+        close(networkNamespace);
+        networkNamespace = -1;
+    }
+    if (pid <= 0)
+        return;
+
+    char path[64];
+    snprintf(path, sizeof(path), "/proc/%d/ns/user", (int) pid);
+    userNamespace = open(path, O_RDONLY | O_CLOEXEC);
+    snprintf(path, sizeof(path), "/proc/%d/ns/net", (int) pid);
+    networkNamespace = open(path, O_RDONLY | O_CLOEXEC);
+    if (userNamespace == -1 || networkNamespace == -1) {
+        set_network_namespace(0);
+        throw NamespaceException();
+    }
+}
+
+/**
+ * Join the namespaces set with set_network_namespace(), if any.
+ * Called in the child, before exec.
+ * @return 0 on success, -1 on failure.
+ */
+int join_network_namespace()
+{
+#ifdef __linux__
+    if (userNamespace == -1)
+        return 0;
+    if (setns(userNamespace, CLONE_NEWUSER) == -1 ||
+            setns(networkNamespace, CLONE_NEWNET) == -1)
+        return -1;
+#endif
+    return 0;
+}
@@ -0,0 +1,110 @@
+#include <string>
+#include <vector>
+#include <cstdio>
+#include <boost/python.hpp>
+
+#include "process.hpp"
+
+/** Pattern Set **/
+
+/**
+ * Compile the patterns into an Aho-Corasick automaton, so all of them can be
+ * found in a single pass over the input.
+ * @param patterns The patterns to search for.
+ */
+PatternSet::PatternSet(std::vector<std::string> patterns):
+    patterns(patterns)
+{
+    // Root state.
+    transitions.push_back(std::vector<int>(256, -1));
+    matches.push_back(std::vector<int>());
+
+    // Build the trie of patterns.
+    for (size_t i = 0; i < patterns.size(); ++i) {
+        int state = 0;
+        const std::string& pattern = patterns[i];
+        for (size_t j = 0; j < pattern.length(); ++j) {
+            unsigned char c = pattern[j];
+            if (transitions[state][c] == -1) {
+                transitions[state][c] = transitions.size();
+                transitions.push_back(std::vector<int>(256, -1));
+                matches.push_back(std::vector<int>());
+            }
+            state = transitions[state][c];
+        }
+        matches[state].push_back(i);
+    }
+
+    // Add failure transitions breadth first, turning the trie into a DFA.
+    std::vector<int> failure(transitions.size(), 0);
+    std::vector<int> queue;
+    for (int c = 0; c < 256; ++c) {
+        int next = transitions[0][c];
+        if (next == -1) {
+            transitions[0][c] = 0;
+        } else {
+            queue.push_back(next);
+        }
+    }
+
+    for (size_t head = 0; head < queue.size(); ++head) {
+        int state = queue[head];
+        const std::vector<int>& inherited = matches[failure[state]];
+        matches[state].insert(matches[state].end(), inherited.begin(), inherited.end());
+
+        for (int c = 0; c < 256; ++c) {
+            int next = transitions[state][c];
+            if (next == -1) {
+                transitions[state][c] = transitions[failure[state]][c];
+            } else {
+                failure[next] = transitions[failure[state]][c];
+                queue.push_back(next);
+            }
+        }
+    }
+}
+
+size_t PatternSet::size()
+{
+    return patterns.size();
+}
+
+/**
+ * Read a stream until end of file, recording which patterns appear in it.
+ * The GIL must be released by the caller.
+ * @param  stream The stream to read from.
+ * @param  prefix Output already taken from the stream, scanned first.
+ * @return        Flag for each pattern, set if the pattern was found.
+ */
+std::vector<bool> PatternSet::scan(FILE *stream, const std::string& prefix)
+{
+    std::vector<bool> found(patterns.size(), false);
+    size_t remaining = patterns.size();
+
+    // Empty patterns are always found.
+    for (size_t i = 0; i < matches[0].size(); ++i) {
+        found[matches[0][i]] = true;
+        remaining--;
+    }
+
+    char buf[BUFSIZ];
+    const char *data = prefix.data();
+    size_t length = prefix.length();
+    int state = 0;
+    do {
+        // Once everything is found, the rest of the stream is only drained.
+        for (size_t i = 0; i < length && remaining > 0; ++i) {
+            state = transitions[state][(unsigned char) data[i]];
+            const std::vector<int>& matched = matches[state];
+            for (size_t m = 0; m < matched.size(); ++m) {
+                if (!found[matched[m]]) {
+                    found[matched[m]] = true;
+                    remaining--;
+                }
+            }
+        }
+        data = buf;
+    } while ((length = fread(buf, 1, sizeof(buf), stream)) > 0);
+
+    return found;
+}
@@ -0,0 +1,154 @@
+#include <cstring>
+#include <cstdint>
+#include <unistd.h>
+#include <sys/types.h>
+#include <sys/socket.h>
+#include <boost/python.hpp>
+
+#ifdef __linux__
+#include <linux/perf_event.h>
+#include <sys/syscall.h>
+#endif
+
+#include "process.hpp"
+
+/** Performance Counters **/
+
+/* Whether Processes created count their instructions and cache misses */
+namespace {
+    bool perf_value = false;
+}
+
+void set_perf_counters(bool enabled)
+{
+    perf_value = enabled;
+}
+
+bool get_perf_counters()
+{
+    return perf_value;
+}
+
+#ifdef __linux__
+/**
+ * Open a hardware counter for the calling process, counting user space
+ * events from its next exec, including any children it creates.
+ * @return The counter, or -1 if it could not be opened.
+ */
+static int open_counter(uint64_t config)
+{
+    struct perf_event_attr attr;
+    memset(&attr, 0, sizeof(attr));
+    attr.size = sizeof(attr);
+    attr.type = PERF_TYPE_HARDWARE;
+    attr.config = config;
+    attr.disabled = 1;
+    attr.enable_on_exec = 1;
+    attr.inherit = 1;
+    attr.exclude_kernel = 1;
+    attr.exclude_hv = 1;
+    attr.read_format = PERF_FORMAT_TOTAL_TIME_ENABLED |
+        PERF_FORMAT_TOTAL_TIME_RUNNING;
+    return syscall(SYS_perf_event_open, &attr, 0, -1, -1, PERF_FLAG_FD_CLOEXEC);
+}
+#endif
+
+/**
+ * Open the counters for the child, and send them to the parent, which keeps
+ * them open after the child has exited. Called in the child, before exec.
+ * Counters that cannot be opened (such as when the kernel disallows perf
+ * events) are sent as -1.
+ * @param socket The child end of the socket to the parent.
+ */
+void send_perf_counters(int socket)
+{
+    int counters[PERF_COUNTERS] = {-1, -1};
+#ifdef __linux__
+    counters[0] = open_counter(PERF_COUNT_HW_INSTRUCTIONS);
+    counters[1] = open_counter(PERF_COUNT_HW_CACHE_MISSES);
+#endif
+
+    // Send which counters were opened, with the descriptors of those that were.
+    char opened[PERF_COUNTERS];
+    int fds[PERF_COUNTERS];
+    int count = 0;
+    for (int i = 0; i < PERF_COUNTERS; ++i) {
+        opened[i] = counters[i] != -1;
+        if (opened[i])
+            fds[count++] = counters[i];
+    }
+
+    struct iovec data = {opened, sizeof(opened)};
+    char control[CMSG_SPACE(sizeof(fds))];
+    memset(control, 0, sizeof(control));
+    struct msghdr message;
+    memset(&message, 0, sizeof(message));
+    message.msg_iov = &data;
+    message.msg_iovlen = 1;
+    if (count > 0) {
+        message.msg_control = control;
+        message.msg_controllen = CMSG_SPACE(count * sizeof(int));
+        struct cmsghdr *header = CMSG_FIRSTHDR(&message);
+        header->cmsg_level = SOL_SOCKET;
+        header->cmsg_type = SCM_RIGHTS;
+        header->cmsg_len = CMSG_LEN(count * sizeof(int));
+        memcpy(CMSG_DATA(header), fds, count * sizeof(int));
+    }
+    sendmsg(socket, &message, 0);
+
+    // The parent now holds the counters.
+    for (int i = 0; i < count; ++i)
+        close(fds[i]);
+    close(socket);
+}
+
+/**
+ * Receive the counters opened by the child. Called in the parent, after the
+ * child has exec'd (or failed to).
+ * @param socket   The parent end of the socket to the child.
+ * @param counters Set to the counters, or -1 for those not opened.
+ */
+void receive_perf_counters(int socket, int *counters)
+{
+    char opened[PERF_COUNTERS] = {0};
+    int fds[PERF_COUNTERS];
+    struct iovec data = {opened, sizeof(opened)};
+    char control[CMSG_SPACE(sizeof(fds))];
+    struct msghdr message;
+    memset(&message, 0, sizeof(message));
+    message.msg_iov = &data;
+    message.msg_iovlen = 1;
+    message.msg_control = control;
+    message.msg_controllen = sizeof(control);
+
+    int count = 0;
+    if (recvmsg(socket, &message, MSG_CMSG_CLOEXEC) > 0) {
+        struct cmsghdr *header = CMSG_FIRSTHDR(&message);
+        if (header != NULL && header->cmsg_level == SOL_SOCKET &&
+                header->cmsg_type == SCM_RIGHTS) {
+            count = (header->cmsg_len - CMSG_LEN(0)) / sizeof(int);
+            memcpy(fds, CMSG_DATA(header), count * sizeof(int));
+        }
+    }
+
+    int next = 0;
+    for (int i = 0; i < PERF_COUNTERS; ++i) {
+        counters[i] = (opened[i] && next < count) ? fds[next++] : -1;
+    }
+    close(socket);
+}
+
+/**
+ * Read a counter, scaled up if it was only counting for part of the time
+ * (when the hardware was shared with other counters).
+ * @return The count, or -1 if it could not be read.
+ */
+long long read_perf_counter(int counter)
+{
+    uint64_t values[3];
+    if (counter == -1 || read(counter, values, sizeof(values)) != sizeof(values))
+        return -1;
+    if (values[2] == 0)
+        return values[1] == 0 ? (long long) values[0] : -1;
+    return (long long) ((double) values[0] * values[1] / values[2]);
+}
@@ -0,0 +1,76 @@
+#include <string>
+#include <cstring>
+#include <ctime>
+#include <unistd.h>
+#include <poll.h>
+#include <boost/python.hpp>
+
+#ifdef __linux__
+#include <sys/inotify.h>
+#endif
+
+#include "process.hpp"
+
+/** Readiness Probes **/
+
+/**
+ * Get the time from a monotonic clock.
+ * @return The time, in milliseconds.
+ */
+static long now_ms()
+{
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return now.tv_sec * 1000L + now.tv_nsec / 1000000;
+}
+
+/**
+ * Wait for a file to exist, watching its directory with inotify so the wait
+ * ends as soon as the file is created (or moved into place). Falls back to
+ * polling if the directory cannot be watched.
+ * @param  path      Path of the file to wait for.
+ * @param  timeoutMs The most time (in milliseconds) to wait.
+ * @return           true if the file exists, false if the time ran out.
+ */
+bool wait_for_file(std::string path, long timeoutMs)
+{
+    ScopedGILRelease release;
+    long deadline = now_ms() + timeoutMs;
+    int watch = -1;
+
+#ifdef __linux__
+    size_t slash = path.rfind('/');
+    std::string directory = slash == std::string::npos ? "." :
+        slash == 0 ? "/" : path.substr(0, slash);
+
+    watch = inotify_init1(IN_NONBLOCK | IN_CLOEXEC);
+    if (watch != -1 && inotify_add_watch(watch, directory.c_str(),
+            IN_CREATE | IN_MOVED_TO | IN_ATTRIB) == -1) {
+        close(watch);
+        watch = -1;
+    }
+#endif
+
+    // Checked after the watch is added, so a new file cannot be missed.
+    bool found;
+    long remaining;
+    char events[4096];
+    while (!(found = access(path.c_str(), F_OK) == 0) &&
+            (remaining = deadline - now_ms()) > 0) {
+        if (watch == -1) {
+            // No watch, so check again shortly.
+            struct timespec delay = {0, 10 * 1000000};
+            nanosleep(&delay, NULL);
+            continue;
+        }
+        struct pollfd ready = {watch, POLLIN, 0};
+        if (poll(&ready, 1, remaining) > 0) {
+            // Only the existence of the file matters, not the events.
+            while (read(watch, events, sizeof(events)) > 0) {}
+        }
+    }
+
+    if (watch != -1)
+        close(watch);
+    return found;
+}
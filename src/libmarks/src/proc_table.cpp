@@ -0,0 +1,237 @@
+#include <string>
+#include <vector>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <cctype>
+#include <dirent.h>
+#include <sys/types.h>
+#include <sys/syscall.h>
+#include <boost/python.hpp>
+
+#ifdef __linux__
+#include <sys/prctl.h>
+#endif
+
+#include "process.hpp"
+
+/** Process Table **/
+
+/**
+ * Read a file from /proc/<pid>/.
+ * @param  pid  The process to read.
+ * @param  file Name of the file within /proc/<pid>/.
+ * @param  buf  Buffer for the (null terminated) contents.
+ * @param  size Size of the buffer.
+ * @return      true if the file was read, false if it could not be opened.
+ */
+static bool read_proc_file(pid_t pid, const char *file, char *buf, size_t size)
+{
+    char path[64];
+
+    snprintf(path, sizeof(path), "/proc/%d/%s", (int) pid, file);
+    FILE *f = fopen(path, "r");
+    if (f == NULL)
+        return false;
+
+    size_t length = fread(buf, 1, size - 1, f);
+    fclose(f);
+    buf[length] = '\0';
+    return true;
+}
+
+/**
+ * Read the parent process ID, state and name of a process from
+ * /proc/<pid>/stat.
+ * @param  pid   The process to read.
+ * @param  ppid  Set to the parent process ID.
+ * @param  state Set to the single character state of the process.
+ * @param  name  Set to the command name of the process.
+ * @return       true if the process was read, false if it no longer exists.
+ */
+static bool read_stat(pid_t pid, pid_t *ppid, char *state, std::string *name)
+{
+    char buf[512];
+    if (!read_proc_file(pid, "stat", buf, sizeof(buf)))
+        return false;
+
+    // The command name may contain spaces and brackets, so the fields
+    // after it are found from the last closing bracket.
+    char *start = strchr(buf, '(');
+    char *end = strrchr(buf, ')');
+    int parent;
+    if (start == NULL || end == NULL || end < start ||
+            sscanf(end + 1, " %c %d", state, &parent) != 2)
+        return false;
+
+    *ppid = parent;
+    name->assign(start + 1, end - start - 1);
+    return true;
+}
+
+/**
+ * Scan /proc for every process on the system.
+ * @return List of (pid, ppid, state, name) tuples. Empty if /proc is
+ *         unavailable.
+ */
+boost::python::list scan_processes()
+{
+    boost::python::list table;
+    DIR *proc = opendir("/proc");
+    if (proc == NULL)
+        return table;
+
+    struct dirent *entry;
+    while ((entry = readdir(proc)) != NULL) {
+        if (!isdigit(entry->d_name[0]))
+            continue;
+
+        pid_t pid = atoi(entry->d_name);
+        pid_t ppid;
+        char state;
+        std::string name;
+        if (read_stat(pid, &ppid, &state, &name)) {
+            table.append(boost::python::make_tuple(pid, ppid,
+                std::string(1, state), name));
+        }
+    }
+
+    closedir(proc);
+    return table;
+}
+
+/**
+ * Check what a blocked process is waiting for, from the system call it is
+ * blocked in, or its wait channel if the system call cannot be read.
+ * @param  pid     The process to check.
+ * @param  sample  Updated if the process is reading its input or writing its
+ *                 output.
+ */
+static void check_blocked(pid_t pid, ProgressSample *sample)
+{
+    char buf[256];
+    long number;
+    unsigned long fd;
+
+    if (read_proc_file(pid, "syscall", buf, sizeof(buf))) {
+        // "running" if not in a system call, otherwise the number and args.
+        if (sscanf(buf, "%ld 0x%lx", &number, &fd) != 2)
+            return;
+        if (number == SYS_read && fd == 0)
+            sample->readingInput = true;
+        else if (number == SYS_write && (fd == 1 || fd == 2))
+            sample->writingOutput = true;
+    } else if (read_proc_file(pid, "wchan", buf, sizeof(buf))) {
+        // Cannot tell which descriptor, so assume a read is from stdin.
+        if (strstr(buf, "pipe_read") != NULL || strstr(buf, "pipe_wait") != NULL
+                || strstr(buf, "tty_read") != NULL)
+            sample->readingInput = true;
+        else if (strstr(buf, "pipe_write") != NULL)
+            sample->writingOutput = true;
+    }
+}
+
+/**
+ * Add the progress of a process to a sample, if it is in a process group.
+ * @param  pid    The process to sample.
+ * @param  pgid   The process group being sampled.
+ * @param  sample Updated with the progress of the process.
+ * @return        true if the process is in the group and still running.
+ */
+static bool sample_process(pid_t pid, pid_t pgid, ProgressSample *sample)
+{
+    char buf[512];
+    if (!read_proc_file(pid, "stat", buf, sizeof(buf)))
+        return false;
+
+    // Fields after the command name: state, ppid, pgrp, session, tty_nr,
+    // tpgid, flags, minflt, cminflt, majflt, cmajflt, utime, stime.
+    char *end = strrchr(buf, ')');
+    char state;
+    int group;
+    unsigned long long utime, stime;
+    if (end == NULL || sscanf(end + 1,
+            " %c %*d %d %*d %*d %*d %*u %*u %*u %*u %*u %llu %llu",
+            &state, &group, &utime, &stime) != 4)
+        return false;
+    if (group != pgid || state == 'Z' || state == 'X')
+        return false;
+
+    sample->processes++;
+    sample->pidTotal += pid;
+    sample->cpuTicks += utime + stime;
+
+    if (read_proc_file(pid, "io", buf, sizeof(buf))) {
+        unsigned long long rchar, wchar;
+        if (sscanf(buf, "rchar: %llu wchar: %llu", &rchar, &wchar) == 2)
+            sample->ioBytes += rchar + wchar;
+    }
+
+    if (state != 'R')
+        check_blocked(pid, sample);
+    return true;
+}
+
+/**
+ * Sample the progress of every process in a process group: the CPU time
+ * they have used, the bytes they have read and written, and whether any are
+ * blocked on their input or output.
+ *
+ * Finding the group means scanning every process on the system, so the
+ * members found are kept, and only they are sampled until the next scan.
+ * Processes started since the last scan are not seen until the next.
+ * @param  pgid    The process group to sample.
+ * @param  sample  Set to the progress of the group.
+ * @param  members The members of the group, from the last scan. Updated to
+ *                 those still running.
+ * @param  scan    Whether to scan for the members of the group (as well as
+ *                 if none are known).
+ * @return         true if any process in the group is still running.
+ */
+bool sample_progress(pid_t pgid, ProgressSample *sample,
+        std::vector<pid_t>& members, bool scan)
+{
+    *sample = ProgressSample();
+    std::vector<pid_t> running;
+
+    if (!scan && !members.empty()) {
+        for (size_t i = 0; i < members.size(); ++i) {
+            if (sample_process(members[i], pgid, sample))
+                running.push_back(members[i]);
+        }
+        members.swap(running);
+        return sample->processes > 0;
+    }
+
+    DIR *proc = opendir("/proc");
+    if (proc == NULL)
+        return false;
+
+    struct dirent *entry;
+    while ((entry = readdir(proc)) != NULL) {
+        if (!isdigit(entry->d_name[0]))
+            continue;
+
+        pid_t pid = atoi(entry->d_name);
+        if (sample_process(pid, pgid, sample))
+            running.push_back(pid);
+    }
+
+    closedir(proc);
+    members.swap(running);
+    return sample->processes > 0;
+}
+
+/**
+ * Make this process adopt any orphaned descendants, rather than init, so
+ * processes that escape their parent can still be found and reaped.
+ * @return true if this process is now a subreaper, false if unsupported.
+ */
+bool set_child_subreaper()
+{
+#ifdef __linux__
+    return prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == 0;
+#else
+    return false;
+#endif
+}
@@ -2,18 +2,31 @@
 #include <fstream>
 #include <string>
 #include <vector>
+#include <algorithm>
+#include <unordered_map>
 #include <cstdio>
 #include <cstdlib>
 #include <cstring>
 #include <csignal>
+#include <cerrno>
+#include <ctime>
 #include <unistd.h>
+#include <sched.h>
 #include <sys/wait.h>
+#include <sys/stat.h>
+#include <sys/mman.h>
+#include <sys/socket.h>
 #include <fcntl.h>
+#include <poll.h>
 #include <pthread.h>
 #include <boost/shared_ptr.hpp>
 
 #include "process.hpp"
 
+/* Environment variables read by libprotect (see protection.c) */
+#define FORK_LIMIT_ENV "MARKS_FORK_LIMIT"
+#define FORK_COUNTER_ENV "MARKS_FORK_COUNTER"
+
 /* Allow global value for LD_PRELOAD to be set for all Processes created */
 namespace {
     std::string preload_value = "";
@@ -29,72 +42,181 @@ std::string get_ld_preload()
     return preload_value;
 }
 
+/* Allow CPUs to be set for all Processes created (empty to inherit) */
+namespace {
+    std::vector<int> affinity_value;
+}
+
+void set_cpu_affinity(std::vector<int> cpus)
+{
+    affinity_value = cpus;
+}
+
+boost::python::list get_cpu_affinity()
+{
+    boost::python::list cpus;
+    for (size_t i = 0; i < affinity_value.size(); ++i)
+        cpus.append(affinity_value[i]);
+    return cpus;
+}
+
+/**
+ * Restrict the calling process to the CPUs set with set_cpu_affinity().
+ * Called in the child, before exec.
+ * @return 0 on success (or if no CPUs are set), -1 on failure.
+ */
+static int apply_cpu_affinity()
+{
+#ifdef __linux__
+    if (affinity_value.empty())
+        return 0;
+    cpu_set_t cpus;
+    CPU_ZERO(&cpus);
+    for (size_t i = 0; i < affinity_value.size(); ++i)
+        CPU_SET(affinity_value[i], &cpus);
+    return sched_setaffinity(0, sizeof(cpus), &cpus);
+#else
+    return 0;
+#endif
+}
+
+/**
+ * Get the time from a monotonic clock.
+ * @return The time, in seconds.
+ */
+static double monotonic_seconds()
+{
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return now.tv_sec + now.tv_nsec / 1e9;
+}
+
 /* Use to create a new Process, so init() is called */
-boost::shared_ptr<Process> create_process(std::vector<std::string> argv, std::string inputFile)
+boost::shared_ptr<Process> create_process(std::vector<std::string> argv, std::string inputFile, bool captureFile)
 {
-    boost::shared_ptr<Process> p(new Process(argv, inputFile));
+    boost::shared_ptr<Process> p(new Process(argv, inputFile, captureFile));
     p->init();
     return p;
 }
 
 /* Use to create a new TimeoutProcess, so init() is called */
-boost::shared_ptr<TimeoutProcess> create_timeout_process(std::vector<std::string> argv, int timeout, std::string inputFile)
+boost::shared_ptr<TimeoutProcess> create_timeout_process(std::vector<std::string> argv, int timeout, std::string inputFile, bool captureFile, int idleTimeout)
 {
-    boost::shared_ptr<TimeoutProcess> p(new TimeoutProcess(argv, timeout, inputFile));
+    boost::shared_ptr<TimeoutProcess> p(new TimeoutProcess(argv, timeout, inputFile, captureFile, idleTimeout));
     p->init();
     return p;
 }
 
-/* Helper to release the GIL */
-class ScopedGILRelease
+/**
+ * Create an anonymous file to capture the output of a child process.
+ * The file is never visible on the filesystem, and is removed once the
+ * last descriptor referring to it is closed.
+ * @param  name Name of the file, used only for debugging.
+ * @return      File descriptor for the file, or -1 on failure.
+ */
+static int create_capture_fd(const char *name)
+{
+    int fd = -1;
+#ifdef __linux__
+    fd = memfd_create(name, MFD_CLOEXEC);
+    if (fd == -1) {
+        // Kernel may not support memfd, so fall back to an unnamed file.
+        fd = open(P_tmpdir, O_TMPFILE | O_RDWR | O_CLOEXEC, S_IRUSR | S_IWUSR);
+    }
+#else
+    char path[] = P_tmpdir "/marks-capture-XXXXXX";
+    fd = mkstemp(path);
+    if (fd != -1) {
+        unlink(path);
+        fcntl(fd, F_SETFD, FD_CLOEXEC);
+    }
+#endif
+    return fd;
+}
+
+/**
+ * Create the shared memory object libprotect counts the forks of a child
+ * (and its descendants) in, when a fork limit is set. The child opens it by
+ * name, so no descriptor is inherited, and it lasts until the process is
+ * closed however the child exits.
+ * @return Name of the counter, or "" if there is no limit, or it could not
+ *         be created (in which case forks are only counted until exec).
+ */
+static std::string create_fork_counter()
+{
+    static volatile int counters = 0;
+    const char *limit = getenv(FORK_LIMIT_ENV);
+    if (preload_value.empty() || limit == NULL || *limit == '\0')
+        return "";
+
+    std::string name = "/marks-forks-" + std::to_string(getpid()) + "-" +
+        std::to_string(__sync_add_and_fetch(&counters, 1));
+    int fd = shm_open(name.c_str(), O_RDWR | O_CREAT | O_EXCL | O_CLOEXEC,
+            S_IRUSR | S_IWUSR);
+    if (fd == -1)
+        return "";
+    if (ftruncate(fd, sizeof(long)) == -1) {
+        close(fd);
+        shm_unlink(name.c_str());
+        return "";
+    }
+    close(fd);
+    return name;
+}
+
+/* Helper to mark the parent as waiting on the child's output (or exit) */
+class ScopedOutputWait
 {
 public:
-    inline ScopedGILRelease()
+    inline ScopedOutputWait(volatile int *waiters): m_waiters(waiters)
     {
-        m_thread_state = PyEval_SaveThread();
+        __sync_add_and_fetch(m_waiters, 1);
     }
 
-    inline ~ScopedGILRelease()
+    inline ~ScopedOutputWait()
     {
-        PyEval_RestoreThread(m_thread_state);
-        m_thread_state = NULL;
+        __sync_sub_and_fetch(m_waiters, 1);
     }
 
 private:
-    PyThreadState * m_thread_state;
+    volatile int *m_waiters;
 };
 
 
 /* Public */
-Process::Process(std::vector<std::string> argv, std::string inputFile):
-    argv(argv), inputFile(inputFile),
-    input(NULL), output(NULL), error(NULL), finished(false),
-    abnormalExit(false), signalled(false), timeout(false)
+Process::Process(std::vector<std::string> argv, std::string inputFile, bool captureFile):
+    argv(argv), inputFile(inputFile), captureFile(captureFile),
+    captureOut(-1), captureErr(-1), input(NULL), output(NULL), error(NULL), finished(false),
+    abnormalExit(false), signalled(false), timeout(false), stallReason(NULL),
+    outputWaiters(0),
+    startTime(0), endTime(0)
 {
+    memset(&usage, 0, sizeof(usage));
+    perfSocket[READ] = perfSocket[WRITE] = -1;
+    for (int i = 0; i < PERF_COUNTERS; ++i)
+        perfCounters[i] = -1;
     signalNum = -1;
     exitStatus = -1;
 }
 
 Process::Process(std::vector<std::string> argv):
-    argv(argv), inputFile(""),
-    input(NULL), output(NULL), error(NULL), finished(false),
-    abnormalExit(false), signalled(false), timeout(false)
+    argv(argv), inputFile(""), captureFile(false),
+    captureOut(-1), captureErr(-1), input(NULL), output(NULL), error(NULL), finished(false),
+    abnormalExit(false), signalled(false), timeout(false), stallReason(NULL),
+    outputWaiters(0),
+    startTime(0), endTime(0)
 {
+    memset(&usage, 0, sizeof(usage));
+    perfSocket[READ] = perfSocket[WRITE] = -1;
+    for (int i = 0; i < PERF_COUNTERS; ++i)
+        perfCounters[i] = -1;
     signalNum = -1;
     exitStatus = -1;
 }
 
 Process::~Process()
 {
-    if (!finished) {
-        try {
-            send_kill();
-        } catch (SignalException& e) {
-            // Nothing can be done at this point, so ignore.
-        }
-    }
-    close_stream(&output);
-    close_stream(&error);
+    close_process();
     // Destroy mutex.
     pthread_mutex_destroy(&finishMutex);
 }
@@ -111,6 +233,8 @@ bool Process::send(const std::string& message)
         return false;
     }
 
+    // Writing blocks while the pipe is full, so let other threads run.
+    ScopedGILRelease release;
     int count = fprintf(input, "%s", message.c_str());
     if (count == -1 || (unsigned int) count != message.length()) {
         // Sending failed.
@@ -158,41 +282,143 @@ bool Process::finish_input()
 
 bool Process::expect_stdout(const std::string& expected)
 {
+    open_capture(&output);
     return expect(expected, &output);
 }
 
 bool Process::expect_stderr(const std::string& expected)
 {
+    open_capture(&error);
     return expect(expected, &error);
 }
 
 bool Process::expect_stdout_file(char *filePath)
 {
+    if (captureOut != -1)
+        return compare_capture(filePath, &output);
     return expect_file(filePath, &output);
 }
 
 bool Process::expect_stderr_file(char *filePath)
 {
+    if (captureErr != -1)
+        return compare_capture(filePath, &error);
     return expect_file(filePath, &error);
 }
 
 std::string Process::readline_stdout()
 {
+    open_capture(&output);
     return readline(&output);
 }
 
+/**
+ * Read a line from stdout, waiting at most timeoutMs for it.
+ * @return The line, or None if the line was not complete in time.
+ */
+boost::python::object Process::readline_stdout_timeout(long timeoutMs)
+{
+    open_capture(&output);
+    return readline_timeout(&output, timeoutMs);
+}
+
+/**
+ * Read a line from stderr, waiting at most timeoutMs for it.
+ * @return The line, or None if the line was not complete in time.
+ */
+boost::python::object Process::readline_stderr_timeout(long timeoutMs)
+{
+    open_capture(&error);
+    return readline_timeout(&error, timeoutMs);
+}
+
 std::string Process::readline_stderr()
 {
+    open_capture(&error);
     return readline(&error);
 }
 
+boost::python::object Process::read_stdout(long size)
+{
+    open_capture(&output);
+    return read_stream(&output, size);
+}
+
+boost::python::object Process::read_stderr(long size)
+{
+    open_capture(&error);
+    return read_stream(&error, size);
+}
+
+boost::python::object Process::read_available_stdout()
+{
+    open_capture(&output);
+    return read_available(&output);
+}
+
+boost::python::object Process::read_available_stderr()
+{
+    open_capture(&error);
+    return read_available(&error);
+}
+
+long Process::readinto_stdout(boost::python::object buffer)
+{
+    open_capture(&output);
+    return readinto_stream(&output, buffer);
+}
+
+long Process::readinto_stderr(boost::python::object buffer)
+{
+    open_capture(&error);
+    return readinto_stream(&error, buffer);
+}
+
+boost::python::object Process::capture_stdout()
+{
+    open_capture(&output);
+    return capture_stream(&output);
+}
+
+boost::python::object Process::capture_stderr()
+{
+    open_capture(&error);
+    return capture_stream(&error);
+}
+
+boost::python::list Process::scan_stdout(PatternSet& patterns)
+{
+    open_capture(&output);
+    return scan_stream(&output, patterns);
+}
+
+boost::python::list Process::scan_stderr(PatternSet& patterns)
+{
+    open_capture(&error);
+    return scan_stream(&error, patterns);
+}
+
+boost::python::tuple Process::compare_stdout_unordered(char *filePath, size_t maxReported)
+{
+    open_capture(&output);
+    return compare_unordered(filePath, &output, maxReported);
+}
+
+boost::python::tuple Process::compare_stderr_unordered(char *filePath, size_t maxReported)
+{
+    open_capture(&error);
+    return compare_unordered(filePath, &error, maxReported);
+}
+
 void Process::print_stdout()
 {
+    open_capture(&output);
     print_stream(&output);
 }
 
 void Process::print_stderr()
 {
+    open_capture(&error);
     print_stream(&error);
 }
 
@@ -282,6 +508,52 @@ void Process::send_kill()
     perform_wait(true);
 }
 
+/**
+ * Kill the child (if it is still running) and release the pipes and files
+ * used to communicate with it. Nothing can be sent to or read from the
+ * process once it is closed.
+ */
+void Process::close_process()
+{
+    if (!finished) {
+        try {
+            send_kill();
+        } catch (SignalException& e) {
+            // Nothing can be done at this point, so ignore.
+        }
+    }
+
+    // Input may also be closed by the timeout thread finishing the process.
+    pthread_mutex_lock(&finishMutex);
+    close_stream(&input);
+    pthread_mutex_unlock(&finishMutex);
+
+    close_stream(&output);
+    close_stream(&error);
+
+    // Close any capture files that were never read.
+    if (captureOut != -1) {
+        close(captureOut);
+        captureOut = -1;
+    }
+    if (captureErr != -1) {
+        close(captureErr);
+        captureErr = -1;
+    }
+
+    for (int i = 0; i < PERF_COUNTERS; ++i) {
+        if (perfCounters[i] != -1) {
+            close(perfCounters[i]);
+            perfCounters[i] = -1;
+        }
+    }
+
+    if (!forkCounter.empty()) {
+        shm_unlink(forkCounter.c_str());
+        forkCounter.clear();
+    }
+}
+
 /**
  * Check if the child process was signalled, via a non-blocking call to
  * `waitpid`.
@@ -293,28 +565,113 @@ bool Process::check_signalled()
     return finished && signalled;
 }
 
+/**
+ * Get the resources used by the child (including any descendants it waited
+ * for), waiting for it to finish.
+ * @return (CPU time in seconds, peak resident set size in bytes, wall time
+ *         in seconds from starting the child until it was reaped).
+ */
+boost::python::tuple Process::get_usage()
+{
+    if (!finished)
+        perform_wait(true);
+
+    double cpuTime = usage.ru_utime.tv_sec + usage.ru_utime.tv_usec / 1e6 +
+        usage.ru_stime.tv_sec + usage.ru_stime.tv_usec / 1e6;
+#ifdef __APPLE__
+    long maxRss = usage.ru_maxrss;
+#else
+    // Reported in kilobytes.
+    long maxRss = usage.ru_maxrss * 1024L;
+#endif
+    double wallTime = (finished ? endTime : monotonic_seconds()) - startTime;
+    return boost::python::make_tuple(cpuTime, maxRss, wallTime);
+}
+
+/**
+ * Get the hardware counts of the child (including any descendants), waiting
+ * for it to finish.
+ * @return (instructions retired, cache misses or None), or None if the
+ *         counters were not enabled or the kernel does not allow them.
+ */
+boost::python::object Process::get_perf_counts()
+{
+    if (!finished)
+        perform_wait(true);
+
+    long long instructions = read_perf_counter(perfCounters[0]);
+    if (instructions == -1)
+        return boost::python::object();
+    long long cacheMisses = read_perf_counter(perfCounters[1]);
+    if (cacheMisses == -1)
+        return boost::python::make_tuple(instructions, boost::python::object());
+    return boost::python::make_tuple(instructions, cacheMisses);
+}
+
+/**
+ * Check if the child process has finished, via a non-blocking call to
+ * `waitpid`.
+ * @return true if process is finished, false otherwise.
+ */
+bool Process::check_finished()
+{
+    perform_wait(false);
+    return finished;
+}
+
 bool Process::get_timeout()
 {
     return timeout;
 }
 
+/**
+ * Get the reason the process was stopped early for making no progress.
+ * @return The reason, or an empty string if it was not stopped early.
+ */
+std::string Process::get_stall_reason()
+{
+    const char *reason = stallReason;
+    return reason != NULL ? reason : "";
+}
+
 /* Private */
 void Process::init()
 {
+    // Initialise mutex for finishing a process.
+    pthread_mutex_init(&finishMutex, NULL);
+
     // Create pipe for stdin only if there is no input file.
     if (inputFile.empty() && pipe(fdIn) != 0) {
         throw PipeException();
     }
 
-    // Create the remaining pipes.
-    if (pipe(fdOut) != 0 || pipe(fdErr) != 0 || pipe(fdCheck) != 0) {
+    if (captureFile) {
+        // Output is written straight to anonymous files instead of pipes.
+        captureOut = create_capture_fd("marks-stdout");
+        captureErr = create_capture_fd("marks-stderr");
+        if (captureOut == -1 || captureErr == -1) {
+            throw FdOpenException();
+        }
+    } else if (pipe(fdOut) != 0 || pipe(fdErr) != 0) {
         throw PipeException();
     }
 
-    // Initialise mutex for finishing a process.
-    pthread_mutex_init(&finishMutex, NULL);
+    // Create the check pipe.
+    if (pipe(fdCheck) != 0) {
+        throw PipeException();
+    }
+
+    // Create the socket the child sends its hardware counters over.
+    if (get_perf_counters() &&
+            socketpair(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0, perfSocket) != 0) {
+        throw PipeException();
+    }
+
+    // Create the counter the child's forks are limited by.
+    forkCounter = create_fork_counter();
 
     // Fork
+    startTime = monotonic_seconds();
     childPid = fork();
 
     if (childPid < 0) {
@@ -335,11 +692,20 @@ void Process::setup_parent()
 {
     // Close the ends of the pipes that are being used in the child.
     if ((inputFile.empty() && close(fdIn[READ]) == -1) ||
-            close(fdOut[WRITE]) == -1 || close(fdErr[WRITE]) == -1 ||
+            (!captureFile && close(fdOut[WRITE]) == -1) ||
+            (!captureFile && close(fdErr[WRITE]) == -1) ||
             close(fdCheck[WRITE]) == -1) {
         throw CloseException();
     }
 
+    // Take the hardware counters from the child, which sends them before any
+    // additional setup (so before it can stop to be traced).
+    if (perfSocket[READ] != -1) {
+        close(perfSocket[WRITE]);
+        receive_perf_counters(perfSocket[READ], perfCounters);
+        perfSocket[READ] = perfSocket[WRITE] = -1;
+    }
+
     if (setup_parent_pre_exec() == -1)
         throw ExecException(); // TODO: Change this exception
 
@@ -359,11 +725,20 @@ void Process::setup_parent()
         input = fdopen(fdIn[WRITE], "w"); // Input from parent to child.
     }
 
+    if (inputFile.empty() && input == NULL) {
+        throw FdOpenException();
+    }
+
+    if (captureFile) {
+        // Capture files are only opened as streams once the child exits.
+        return;
+    }
+
     // Open the remaining pipes as files, for ease of use.
     output = fdopen(fdOut[READ], "r"); // stdout from child to parent.
     error = fdopen(fdErr[READ], "r"); // stderr from child to parent.
 
-    if ((inputFile.empty() && input == NULL) || output == NULL || error == NULL) {
+    if (output == NULL || error == NULL) {
         throw FdOpenException();
     }
 }
@@ -397,20 +772,30 @@ void Process::setup_child()
         }
     }
 
-    // Set up child output (stdout).
-    if (close(fdOut[READ]) == -1 ||
-            dup2(fdOut[WRITE], STDOUT_FILENO) == -1 ||
-            close(fdOut[WRITE]) == -1) {
-        D("Failed to setup pipe for stdout" << std::endl);
-        goto childerror;
-    }
+    if (captureFile) {
+        // Set up child output (stdout) and error (stderr) as capture files.
+        if (dup2(captureOut, STDOUT_FILENO) == -1 || close(captureOut) == -1 ||
+                dup2(captureErr, STDERR_FILENO) == -1 ||
+                close(captureErr) == -1) {
+            D("Failed to setup capture files for stdout/stderr" << std::endl);
+            goto childerror;
+        }
+    } else {
+        // Set up child output (stdout).
+        if (close(fdOut[READ]) == -1 ||
+                dup2(fdOut[WRITE], STDOUT_FILENO) == -1 ||
+                close(fdOut[WRITE]) == -1) {
+            D("Failed to setup pipe for stdout" << std::endl);
+            goto childerror;
+        }
 
-    // Set up child error (stderr).
-    if (close(fdErr[READ]) == -1 ||
-            dup2(fdErr[WRITE], STDERR_FILENO) == -1 ||
-            close(fdErr[WRITE]) == -1) {
-        D("Failed to setup pipe for stderr" << std::endl);
-        goto childerror;
+        // Set up child error (stderr).
+        if (close(fdErr[READ]) == -1 ||
+                dup2(fdErr[WRITE], STDERR_FILENO) == -1 ||
+                close(fdErr[WRITE]) == -1) {
+            D("Failed to setup pipe for stderr" << std::endl);
+            goto childerror;
+        }
     }
 
     // Set up check pipe.
@@ -445,6 +830,29 @@ void Process::setup_child()
         D("LD_PRELOAD not set - value empty" << std::endl);
     }
 
+    if (!forkCounter.empty() &&
+            setenv(FORK_COUNTER_ENV, forkCounter.c_str(), 1) == -1)
+        goto childerror;
+
+    // Run on the CPUs set for the test, if any.
+    if (apply_cpu_affinity() == -1) {
+        D("Failed to set CPU affinity" << std::endl);
+        goto childerror;
+    }
+
+    // Join the network namespace of the test, if it is isolated.
+    if (join_network_namespace() == -1) {
+        D("Failed to join network namespace" << std::endl);
+        goto childerror;
+    }
+
+    // Count the instructions of the child from exec, if enabled. Counters the
+    // kernel does not allow are left out, rather than failing.
+    if (perfSocket[WRITE] != -1) {
+        close(perfSocket[READ]);
+        send_perf_counters(perfSocket[WRITE]);
+    }
+
     // Perform additional child setup, as possibly defined by subclasses.
     if (setup_child_additional() == -1)
         goto childerror;
@@ -495,55 +903,154 @@ void Process::delete_args(char **args, size_t length)
 
 bool Process::expect_file(char *filePath, FILE **stream)
 {
-    std::ifstream expectedOutput (filePath);
-
-    if (!expectedOutput.is_open()) {
-        throw StreamException();
-    }
+    ScopedOutputWait wait(&outputWaiters);
+    boost::shared_ptr<ExpectedFile> expected = load_expected_file(filePath);
 
     if (*stream == NULL) {
         // Trying to access a stream after the process has finished.
         throw StreamFinishedException();
     }
 
-    char expected, received;
+    ScopedGILRelease release;
 
-    // Char by char, check expected output against received output.
-    do {
-        expected = expectedOutput.get();
+    // Char by char, check received output against the expected output in
+    // memory, so a mismatch is found as soon as it arrives.
+    for (size_t offset = 0; ; ++offset) {
         if (*stream == NULL) // Stream may have been closed by timeout.
             return false;
-        received = fgetc(*stream);
-    } while (expectedOutput.good() && received != EOF && expected == received);
+        int received = next_char(stream);
+        if (offset == expected->size) {
+            // If output was same as expected, then it should be at end of file.
+            return received == EOF && feof(*stream);
+        }
+        if (received == EOF || (char) received != expected->data[offset])
+            return false;
+    }
+}
+
+/**
+ * Open the capture file for a stream once the child has finished, so it can
+ * be read like a pipe. Does nothing if the stream is not captured to a file,
+ * or the capture file has already been opened.
+ * @param stream The stream (output or error) to open.
+ */
+void Process::open_capture(FILE **stream)
+{
+    int *fd = (stream == &output) ? &captureOut : &captureErr;
+    if (*fd == -1)
+        return;
 
-    // If output was same as expected, then both should be at end of file.
-    if (expectedOutput.eof() && feof(*stream)) {
-        expectedOutput.close();
-        return true;
+    // Output is only complete once the child has exited.
+    perform_wait(true);
+
+    if (lseek(*fd, 0, SEEK_SET) == -1 || (*stream = fdopen(*fd, "r")) == NULL) {
+        throw FdOpenException();
     }
 
-    expectedOutput.close();
-    return false;
+    // The stream now owns the descriptor.
+    *fd = -1;
+}
+
+/**
+ * Compare the full contents of a capture file against an expected file,
+ * once the child has finished. The expected file is served from the cache,
+ * and files of differing lengths are rejected without reading either of
+ * them. The stream is left at end of file, as if it had been read from a
+ * pipe.
+ * @param  filePath Path to the file containing the expected output.
+ * @param  stream   The stream (output or error) to compare.
+ * @return          true if the contents are identical, false otherwise.
+ */
+bool Process::compare_capture(char *filePath, FILE **stream)
+{
+    int fd = (stream == &output) ? captureOut : captureErr;
+    boost::shared_ptr<ExpectedFile> expected = load_expected_file(filePath);
+
+    // Output is only complete once the child has exited.
+    perform_wait(true);
+
+    struct stat capturedStat;
+    if (fstat(fd, &capturedStat) == -1) {
+        throw StreamException();
+    }
+
+    size_t length = expected->size;
+    bool same = (size_t) capturedStat.st_size == length;
+
+    if (same && length > 0) {
+        void *captured = mmap(NULL, length, PROT_READ, MAP_SHARED, fd, 0);
+        if (captured == MAP_FAILED) {
+            throw StreamException();
+        }
+
+        same = memcmp(expected->data, captured, length) == 0;
+
+        munmap(captured, length);
+    }
+
+    // Mark the capture as consumed.
+    open_capture(stream);
+    fseek(*stream, 0, SEEK_END);
+
+    return same;
+}
+
+/**
+ * Get the partial line put back for a stream (output or error) by
+ * readline_timeout, which is read before anything else from the stream.
+ */
+std::string& Process::pending(FILE **stream)
+{
+    return (stream == &output) ? pendingOut : pendingErr;
+}
+
+/**
+ * Read a character from a stream, after any partial line put back for it.
+ * @return The character, or EOF.
+ */
+int Process::next_char(FILE **stream)
+{
+    std::string& partial = pending(stream);
+    if (partial.empty())
+        return fgetc(*stream);
+    int c = (unsigned char) partial[0];
+    partial.erase(0, 1);
+    return c;
+}
+
+/**
+ * Take up to size bytes of the partial line put back for a stream.
+ * @return The number of bytes taken.
+ */
+size_t Process::take_pending(FILE **stream, char *buf, size_t size)
+{
+    std::string& partial = pending(stream);
+    size_t length = std::min(size, partial.length());
+    memcpy(buf, partial.data(), length);
+    partial.erase(0, length);
+    return length;
 }
 
 bool Process::expect(const std::string& expected, FILE **stream)
 {
+    ScopedOutputWait wait(&outputWaiters);
     if (*stream == NULL) {
         // Trying to access a stream after the process has finished.
         throw StreamFinishedException();
     }
 
+    ScopedGILRelease release;
     if (expected.length() == 0) {
         // Expected string is 0 length, so expect EOF to be returned.
-        if (*stream == NULL || fgetc(*stream) != EOF) {
+        if (*stream == NULL || next_char(stream) != EOF) {
             return false;
         }
     } else {
         // Check each char in the expected against chars in the stream.
-        char c;
+        int c;
         for (unsigned int i = 0; i < expected.length(); ++i) {
-            if (*stream == NULL || (c = fgetc(*stream)) == EOF ||
-                    expected[i] != c) {
+            if (*stream == NULL || (c = next_char(stream)) == EOF ||
+                    expected[i] != (char) c) {
                 return false;
             }
         }
@@ -561,15 +1068,17 @@ bool Process::expect(const std::string& expected, FILE **stream)
  */
 std::string Process::readline(FILE **stream)
 {
+    ScopedOutputWait wait(&outputWaiters);
     if (*stream == NULL) {
         // Trying to access a stream after the process has finished.
         throw StreamFinishedException();
     }
 
     std::string line;
-    char c;
+    int c;
+    ScopedGILRelease release;
 
-    while(*stream != NULL && (c = fgetc(*stream)) != EOF) {
+    while(*stream != NULL && (c = next_char(stream)) != EOF) {
         line += c;
         if (c == '\n') {
             break;
@@ -579,8 +1088,450 @@ std::string Process::readline(FILE **stream)
     return line;
 }
 
+/**
+ * Read a line from a stream, giving up if it is not complete in time.
+ * The stream is made non-blocking while reading, and polled between reads,
+ * so any output after the line is left buffered in the stream.
+ * A partial line read before the time runs out is put back, to be read
+ * first by the next read of the stream.
+ * @param  stream    The stream to read from.
+ * @param  timeoutMs The most time (in milliseconds) to wait for the line.
+ * @return           The line, including the newline character ("" at end
+ *                   of file), or None if the time ran out.
+ */
+boost::python::object Process::readline_timeout(FILE **stream, long timeoutMs)
+{
+    ScopedOutputWait wait(&outputWaiters);
+
+    if (*stream == NULL) {
+        // Trying to access a stream after the process has finished.
+        throw StreamFinishedException();
+    }
+
+    int fd = fileno(*stream);
+    int flags = fcntl(fd, F_GETFL);
+    if (flags == -1 || fcntl(fd, F_SETFL, flags | O_NONBLOCK) == -1) {
+        throw StreamException();
+    }
+
+    // Continue any partial line put back by an earlier call.
+    std::string line;
+    line.swap(pending(stream));
+    bool complete = false;
+    {
+        ScopedGILRelease release;
+        struct timespec now;
+        clock_gettime(CLOCK_MONOTONIC, &now);
+        long deadline = now.tv_sec * 1000L + now.tv_nsec / 1000000 + timeoutMs;
+
+        int c;
+        while (true) {
+            while ((c = fgetc(*stream)) != EOF) {
+                line += c;
+                if (c == '\n')
+                    break;
+            }
+            if (c == '\n' || feof(*stream) || errno != EAGAIN) {
+                complete = true;
+                break;
+            }
+
+            // Nothing more to read yet, so wait for the rest of the line.
+            clearerr(*stream);
+            clock_gettime(CLOCK_MONOTONIC, &now);
+            long remaining = deadline - (now.tv_sec * 1000L + now.tv_nsec / 1000000);
+            if (remaining <= 0)
+                break;
+            struct pollfd ready = {fd, POLLIN, 0};
+            poll(&ready, 1, remaining);
+        }
+        if (ferror(*stream))
+            clearerr(*stream);
+    }
+
+    fcntl(fd, F_SETFL, flags);
+    if (!complete) {
+        // Keep the partial line for the next read.
+        pending(stream) = line;
+        return boost::python::object();
+    }
+    return boost::python::object(line);
+}
+
+/**
+ * Convert bytes read from a stream into a Python bytes object.
+ */
+static boost::python::object to_bytes(const std::vector<char>& data, size_t length)
+{
+    PyObject *bytes = PyBytes_FromStringAndSize(length ? &data[0] : "", length);
+    return boost::python::object(boost::python::handle<>(bytes));
+}
+
+/**
+ * Read from a stream until end of file, growing the buffer as required.
+ * The GIL must be released by the caller.
+ * @param  partial Output already taken from the stream, which is read first
+ *                 (and then cleared).
+ * @return The number of bytes read into the buffer.
+ */
+static size_t read_all(FILE *stream, std::vector<char>& data, std::string& partial)
+{
+    size_t length = partial.length();
+    data.assign(partial.begin(), partial.end());
+    data.resize(length + BUFSIZ);
+    partial.clear();
+    while (true) {
+        length += fread(&data[length], 1, data.size() - length, stream);
+        if (length < data.size())
+            break;
+        data.resize(data.size() * 2);
+    }
+    return length;
+}
+
+/**
+ * Read bytes from a stream, in a single call.
+ * @param  stream The stream to read from.
+ * @param  size   The number of bytes to read, or -1 to read to end of file.
+ * @return        The bytes read. Fewer bytes than requested indicates that
+ *                end of file was reached.
+ */
+boost::python::object Process::read_stream(FILE **stream, long size)
+{
+    ScopedOutputWait wait(&outputWaiters);
+    if (*stream == NULL) {
+        // Trying to access a stream after the process has finished.
+        throw StreamFinishedException();
+    }
+
+    std::vector<char> data;
+    size_t length = 0;
+
+    {
+        ScopedGILRelease release;
+
+        if (size >= 0) {
+            data.resize(size);
+            if (size > 0) {
+                length = take_pending(stream, &data[0], size);
+                length += fread(&data[length], 1, size - length, *stream);
+            }
+        } else {
+            length = read_all(*stream, data, pending(stream));
+        }
+    }
+
+    return to_bytes(data, length);
+}
+
+/**
+ * Read the rest of a stream, and index the offset of each line while doing
+ * so, allowing lines to be found without scanning the output again.
+ * @param  stream The stream to read from.
+ * @return        Tuple of the bytes read, and the offsets (as native 64 bit
+ *                integers, packed into bytes) of the start of each line
+ *                followed by the end of the output.
+ */
+boost::python::object Process::capture_stream(FILE **stream)
+{
+    ScopedOutputWait wait(&outputWaiters);
+    if (*stream == NULL) {
+        // Trying to access a stream after the process has finished.
+        throw StreamFinishedException();
+    }
+
+    std::vector<char> data;
+    std::vector<int64_t> offsets;
+    size_t length = 0;
+
+    {
+        ScopedGILRelease release;
+        length = read_all(*stream, data, pending(stream));
+
+        offsets.push_back(0);
+        const char *start = length ? &data[0] : NULL;
+        const char *end = start + length;
+        const char *pos = start;
+        while (pos < end && (pos = (const char *) memchr(pos, '\n', end - pos)) != NULL) {
+            pos++;
+            offsets.push_back(pos - start);
+        }
+        if (length > 0 && data[length - 1] != '\n') {
+            // Final line has no newline.
+            offsets.push_back(length);
+        }
+    }
+
+    PyObject *index = PyBytes_FromStringAndSize((const char *) &offsets[0],
+            offsets.size() * sizeof(int64_t));
+    return boost::python::make_tuple(to_bytes(data, length),
+            boost::python::object(boost::python::handle<>(index)));
+}
+
+/**
+ * Read the rest of a stream, searching for all of a set of patterns in a
+ * single pass.
+ * @param  stream   The stream to read from.
+ * @param  patterns The patterns to search for.
+ * @return          List of flags, set for each pattern that was found.
+ */
+boost::python::list Process::scan_stream(FILE **stream, PatternSet& patterns)
+{
+    ScopedOutputWait wait(&outputWaiters);
+    if (*stream == NULL) {
+        // Trying to access a stream after the process has finished.
+        throw StreamFinishedException();
+    }
+
+    std::vector<bool> found;
+    {
+        ScopedGILRelease release;
+        found = patterns.scan(*stream, pending(stream));
+        pending(stream).clear();
+    }
+
+    boost::python::list result;
+    for (size_t i = 0; i < found.size(); ++i)
+        result.append((bool) found[i]);
+    return result;
+}
+
+/* Number of times a line was seen, with its first appearance (as a line
+ * number and a byte offset), and its text once it is needed */
+struct LineCount {
+    long count;
+    long order;
+    off_t offset;
+    std::string line;
+};
+
+/**
+ * Hash a line using 64 bit FNV-1a.
+ */
+static uint64_t hash_line(const char *line, size_t length)
+{
+    uint64_t hash = 14695981039346656037ULL;
+    for (size_t i = 0; i < length; ++i) {
+        hash ^= (unsigned char) line[i];
+        hash *= 1099511628211ULL;
+    }
+    return hash;
+}
+
+static bool first_seen(const LineCount *a, const LineCount *b)
+{
+    return a->order < b->order;
+}
+
+/**
+ * Convert lines and their counts into a Python list of (line, count), in
+ * the order the lines were first seen.
+ */
+static boost::python::list line_counts(std::vector<const LineCount *>& lines)
+{
+    std::sort(lines.begin(), lines.end(), first_seen);
+    boost::python::list result;
+    for (size_t i = 0; i < lines.size(); ++i) {
+        PyObject *text = PyUnicode_DecodeUTF8(lines[i]->line.data(),
+                lines[i]->line.length(), "replace");
+        result.append(boost::python::make_tuple(
+                boost::python::object(boost::python::handle<>(text)),
+                lines[i]->count));
+    }
+    return result;
+}
+
+/**
+ * Compare the lines of a stream against the lines of a file, ignoring the
+ * order of the lines. The lines of the file are counted by hash, and each
+ * line read from the stream is then matched against these counts, so the
+ * stream is never held in memory. Only the first appearance of each line in
+ * the file is kept, and the text of the missing lines reported is read
+ * again from the file, so the file is not held in memory either.
+ * @param  filePath    Path to the file containing the expected output.
+ * @param  stream      The stream to read from.
+ * @param  maxReported Most distinct missing or extra lines to report.
+ * @return             Tuple of (expected line count, actual line count,
+ *                     missing line count, missing lines, extra line count,
+ *                     extra lines), where the lists of lines contain tuples
+ *                     of (line, count).
+ */
+boost::python::tuple Process::compare_unordered(char *filePath, FILE **stream,
+        size_t maxReported)
+{
+    ScopedOutputWait wait(&outputWaiters);
+    if (*stream == NULL) {
+        // Trying to access a stream after the process has finished.
+        throw StreamFinishedException();
+    }
+
+    FILE *expectedFile = fopen(filePath, "r");
+    if (expectedFile == NULL) {
+        throw StreamException();
+    }
+
+    std::unordered_map<uint64_t, LineCount> expected, extra;
+    long expectedLines = 0, actualLines = 0, extraLines = 0, missingLines = 0;
+    std::vector<LineCount *> missing;
+
+    {
+        ScopedGILRelease release;
+        char *line = NULL;
+        size_t capacity = 0;
+        ssize_t length;
+        off_t offset = 0;
+
+        while ((length = getline(&line, &capacity, expectedFile)) != -1) {
+            LineCount& entry = expected[hash_line(line, length)];
+            if (entry.count++ == 0) {
+                entry.order = expectedLines;
+                entry.offset = offset;
+            }
+            expectedLines++;
+            offset += length;
+        }
+
+        // Any partial line put back for the stream starts its first line.
+        std::string partial, first;
+        partial.swap(pending(stream));
+        while (true) {
+            length = getline(&line, &capacity, *stream);
+            const char *text = line;
+            if (!partial.empty()) {
+                first.swap(partial);
+                if (length > 0)
+                    first.append(line, length);
+                text = first.data();
+                length = first.length();
+            } else if (length == -1) {
+                break;
+            }
+            uint64_t hash = hash_line(text, length);
+            actualLines++;
+
+            std::unordered_map<uint64_t, LineCount>::iterator it = expected.find(hash);
+            if (it != expected.end() && it->second.count > 0) {
+                it->second.count--;
+                continue;
+            }
+
+            // Only keep a bounded number of distinct extra lines.
+            extraLines++;
+            it = extra.find(hash);
+            if (it != extra.end()) {
+                it->second.count++;
+            } else if (extra.size() < maxReported) {
+                LineCount& entry = extra[hash];
+                entry.count = 1;
+                entry.order = actualLines;
+                entry.line.assign(text, length);
+            }
+        }
+
+        std::unordered_map<uint64_t, LineCount>::iterator it;
+        for (it = expected.begin(); it != expected.end(); ++it) {
+            missingLines += it->second.count;
+            if (it->second.count > 0)
+                missing.push_back(&it->second);
+        }
+        std::sort(missing.begin(), missing.end(), first_seen);
+        if (missing.size() > maxReported)
+            missing.resize(maxReported);
+
+        // Read the text of the missing lines reported from the file.
+        for (size_t i = 0; i < missing.size(); ++i) {
+            if (fseeko(expectedFile, missing[i]->offset, SEEK_SET) == 0 &&
+                    (length = getline(&line, &capacity, expectedFile)) != -1)
+                missing[i]->line.assign(line, length);
+        }
+
+        free(line);
+        fclose(expectedFile);
+    }
+
+    std::vector<const LineCount *> missingCounts(missing.begin(), missing.end());
+    std::vector<const LineCount *> extras;
+    std::unordered_map<uint64_t, LineCount>::const_iterator it;
+    for (it = extra.begin(); it != extra.end(); ++it) {
+        extras.push_back(&it->second);
+    }
+
+    return boost::python::make_tuple(expectedLines, actualLines,
+            missingLines, line_counts(missingCounts), extraLines, line_counts(extras));
+}
+
+/**
+ * Read all bytes that are available from a stream without blocking.
+ * @param  stream The stream to read from.
+ * @return        The bytes read, which may be empty if nothing is available.
+ */
+boost::python::object Process::read_available(FILE **stream)
+{
+    if (*stream == NULL) {
+        // Trying to access a stream after the process has finished.
+        throw StreamFinishedException();
+    }
+
+    int fd = fileno(*stream);
+    int flags = fcntl(fd, F_GETFL);
+    if (flags == -1 || fcntl(fd, F_SETFL, flags | O_NONBLOCK) == -1) {
+        throw StreamException();
+    }
+
+    // Take what is buffered, then read until the pipe would block.
+    std::vector<char> data(pending(stream).begin(), pending(stream).end());
+    size_t length = data.size();
+    data.resize(length + BUFSIZ);
+    pending(stream).clear();
+    while (true) {
+        length += fread(&data[length], 1, data.size() - length, *stream);
+        if (length < data.size())
+            break;
+        data.resize(data.size() * 2);
+    }
+
+    // Reading would have blocked, which is not an error for this stream.
+    if (ferror(*stream))
+        clearerr(*stream);
+
+    fcntl(fd, F_SETFL, flags);
+    return to_bytes(data, length);
+}
+
+/**
+ * Read bytes from a stream directly into a writable buffer (such as a
+ * bytearray or memoryview), filling as much of it as possible.
+ * @param  stream The stream to read from.
+ * @param  buffer The object to read into.
+ * @return        The number of bytes read, 0 at end of file.
+ */
+long Process::readinto_stream(FILE **stream, boost::python::object buffer)
+{
+    ScopedOutputWait wait(&outputWaiters);
+    if (*stream == NULL) {
+        // Trying to access a stream after the process has finished.
+        throw StreamFinishedException();
+    }
+
+    Py_buffer view;
+    if (PyObject_GetBuffer(buffer.ptr(), &view, PyBUF_WRITABLE | PyBUF_C_CONTIGUOUS) == -1) {
+        boost::python::throw_error_already_set();
+    }
+
+    size_t length = 0;
+    {
+        ScopedGILRelease release;
+        length = take_pending(stream, (char *) view.buf, view.len);
+        length += fread((char *) view.buf + length, 1, view.len - length, *stream);
+    }
+
+    PyBuffer_Release(&view);
+    return length;
+}
+
 void Process::print_stream(FILE **stream)
 {
+    ScopedOutputWait wait(&outputWaiters);
     if (*stream == NULL) {
         // Trying to access a stream after the process has finished.
         throw StreamFinishedException();
@@ -588,6 +1539,8 @@ void Process::print_stream(FILE **stream)
 
     char *buf = new char[80];
 
+    std::cout << pending(stream);
+    pending(stream).clear();
     while (*stream != NULL && !feof(*stream)) {
         if (fgets(buf, 80, *stream) == NULL)
             break;
@@ -636,6 +1589,7 @@ void Process::finish_process(int status)
     //close_stream(&output);
     //close_stream(&error);
 
+    endTime = monotonic_seconds();
     finished = true;
 
     // Release mutex.
@@ -654,7 +1608,15 @@ void Process::perform_wait(bool block)
 
         // Wait on the child and reap it once it is complete.
         int status;
-        int result = waitpid(childPid, &status, options);
+        int result;
+        struct rusage childUsage;
+        if (block) {
+            ScopedOutputWait wait(&outputWaiters);
+            ScopedGILRelease release;
+            result = wait4(childPid, &status, options, &childUsage);
+        } else {
+            result = wait4(childPid, &status, options, &childUsage);
+        }
 
         if (result == -1) {
             // Error detected - Child is already finished, or call was
@@ -663,19 +1625,37 @@ void Process::perform_wait(bool block)
             // Child is not finished, so do not check status.
         } else {
             // Child is finished, so check status and close streams.
+            usage = childUsage;
             finish_process(status);
         }
     }
 }
 
 /** Timeout Process **/
+
+/* Time (in milliseconds) between scans for the processes in a group */
+#define GROUP_SCAN_INTERVAL 1000
+
+/**
+ * Get the time from a monotonic clock.
+ * @return The time, in milliseconds.
+ */
+static long monotonic_ms()
+{
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return now.tv_sec * 1000L + now.tv_nsec / 1000000;
+}
+
 /* Public */
-TimeoutProcess::TimeoutProcess(std::vector<std::string> argv, int timeout, std::string inputFile):
-    Process(argv, inputFile), timeout_duration(timeout), timeoutStarted(false)
+TimeoutProcess::TimeoutProcess(std::vector<std::string> argv, int timeout, std::string inputFile, bool captureFile, int idleTimeout):
+    Process(argv, inputFile, captureFile), timeout_duration(timeout),
+    idleTimeout(idleTimeout), timeoutStarted(false)
 {}
 
 TimeoutProcess::TimeoutProcess(std::vector<std::string> argv, int timeout):
-    Process(argv, ""), timeout_duration(timeout), timeoutStarted(false)
+    Process(argv, ""), timeout_duration(timeout), idleTimeout(0),
+    timeoutStarted(false)
 {}
 
 TimeoutProcess::~TimeoutProcess()
@@ -724,13 +1704,86 @@ void TimeoutProcess::init_timeout()
 
 void TimeoutProcess::timeout_process()
 {
-    // Sleep for timeout length
-    sleep(timeout_duration);
+    if (idleTimeout > 0) {
+        // Watch for the process stalling until the timeout.
+        watch_progress();
+    } else {
+        // Sleep for timeout length
+        sleep(timeout_duration);
+    }
 
     // If process is not finished, kill process
     perform_timeout();
 }
 
+/**
+ * Sample the progress of the process group until the timeout, stopping it
+ * early if it makes no progress (uses no CPU, reads and writes nothing, and
+ * starts no processes) for the idle timeout.
+ * A process blocked on its input or output is waiting on the test, so is
+ * only stopped if the test is also waiting on it.
+ */
+void TimeoutProcess::watch_progress()
+{
+    // Sample often enough to notice a stall soon after the idle timeout.
+    long interval = std::min(std::max(idleTimeout / 4, 10), 100);
+    long deadline = monotonic_ms() + timeout_duration * 1000L;
+    long idleSince = monotonic_ms();
+    ProgressSample last, sample;
+    // Members of the group, found by scanning every process now and then.
+    std::vector<pid_t> members;
+    long lastScan = 0;
+    bool scan = true;
+
+    while (monotonic_ms() < deadline) {
+        struct timespec delay = {interval / 1000, (interval % 1000) * 1000000};
+        nanosleep(&delay, NULL);
+
+        // Do not allow cancellation while files in /proc are open.
+        int state;
+        pthread_setcancelstate(PTHREAD_CANCEL_DISABLE, &state);
+        long now = monotonic_ms();
+        scan = scan || now - lastScan >= GROUP_SCAN_INTERVAL;
+        bool running = !finished &&
+            sample_progress(childPid, &sample, members, scan);
+        pthread_setcancelstate(state, NULL);
+        if (scan) {
+            lastScan = now;
+            scan = false;
+        }
+
+        if (!running || sample.processes != last.processes
+                || sample.pidTotal != last.pidTotal
+                || sample.cpuTicks != last.cpuTicks
+                || sample.ioBytes != last.ioBytes) {
+            // Finished (or exiting), or made progress since the last sample.
+            idleSince = now;
+            last = sample;
+            continue;
+        }
+
+        if (now - idleSince < idleTimeout)
+            continue;
+
+        if (lastScan <= idleSince) {
+            // Check for processes started since the last scan first.
+            scan = true;
+            continue;
+        }
+
+        bool testWaiting = outputWaiters > 0;
+        if (sample.readingInput) {
+            if (testWaiting) {
+                stallReason = "blocked waiting for input";
+                return;
+            }
+        } else if (!sample.writingOutput || testWaiting) {
+            stallReason = "no progress";
+            return;
+        }
+    }
+}
+
 /* Timeout thread */
 void *TimeoutProcess::timeout_thread(void *arg)
 {
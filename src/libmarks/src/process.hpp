@@ -1,8 +1,11 @@
 #include <string>
 #include <vector>
 #include <cstdio>
+#include <cstdint>
 #include <set>
 #include <sys/wait.h>
+#include <sys/stat.h>
+#include <sys/resource.h>
 #include <pthread.h>
 #include <boost/shared_ptr.hpp>
 #include <boost/python.hpp>
@@ -24,21 +27,87 @@
 #define D(x) do {} while (0)
 #endif
 
+/* Helper to release the GIL, if held (such code also runs on the threads
+ * timing out processes, which never hold it) */
+class ScopedGILRelease
+{
+public:
+    inline ScopedGILRelease()
+    {
+        m_thread_state = PyGILState_Check() ? PyEval_SaveThread() : NULL;
+    }
+
+    inline ~ScopedGILRelease()
+    {
+        if (m_thread_state != NULL)
+            PyEval_RestoreThread(m_thread_state);
+        m_thread_state = NULL;
+    }
+
+private:
+    PyThreadState * m_thread_state;
+};
+
 /* Allow global value for LD_PRELOAD to be set for all Processes created */
 void set_ld_preload(std::string);
 std::string get_ld_preload();
 
+/* Allow CPUs to be set for all Processes created */
+void set_cpu_affinity(std::vector<int>);
+boost::python::list get_cpu_affinity();
+
+/* Allow hardware counters to be enabled for all Processes created */
+#define PERF_COUNTERS 2
+void set_perf_counters(bool);
+bool get_perf_counters();
+
+/* Set of patterns to search for in a single pass (Aho-Corasick) */
+class PatternSet {
+private:
+    std::vector<std::string> patterns;
+    std::vector<std::vector<int> > transitions;
+    std::vector<std::vector<int> > matches;
+
+public:
+    PatternSet(std::vector<std::string>);
+    size_t size();
+    std::vector<bool> scan(FILE *, const std::string&);
+};
+
+/* Progress of a process group, sampled from /proc */
+struct ProgressSample {
+    int processes;
+    unsigned long long pidTotal;
+    unsigned long long cpuTicks;
+    unsigned long long ioBytes;
+    bool readingInput;
+    bool writingOutput;
+
+    ProgressSample(): processes(0), pidTotal(0), cpuTicks(0), ioBytes(0),
+        readingInput(false), writingOutput(false) {}
+};
+
 class Process {
 protected:
     std::vector<std::string> argv;
     std::string inputFile;
+    bool captureFile;
     int fdIn[2], fdOut[2], fdErr[2], fdCheck[2];
+    int captureOut, captureErr;
     pid_t childPid;
     FILE *input, *output, *error;
+    std::string pendingOut, pendingErr;  // Partial lines put back by readline_timeout
     bool finished;
     int exitStatus, signalNum;
     bool abnormalExit, signalled;
     bool timeout;
+    const char *volatile stallReason;  // Constant, set by the timeout thread before timeout
+    volatile int outputWaiters;
+    struct rusage usage;
+    double startTime, endTime;
+    int perfSocket[2];
+    int perfCounters[PERF_COUNTERS];
+    std::string forkCounter;  // Name of the fork counter shared with the child, if any
     pthread_mutex_t finishMutex;
 
     void setup_parent();
@@ -47,9 +116,21 @@ protected:
     virtual int setup_child_additional();
     char **create_args(std::vector<std::string> &);
     void delete_args(char **, size_t);
+    std::string& pending(FILE **);
+    int next_char(FILE **);
+    size_t take_pending(FILE **, char *, size_t);
     bool expect(const std::string&, FILE **);
     bool expect_file(char *, FILE **);
+    void open_capture(FILE **);
+    bool compare_capture(char *, FILE **);
     std::string readline(FILE **);
+    boost::python::object readline_timeout(FILE **, long);
+    boost::python::object read_stream(FILE **, long);
+    boost::python::object capture_stream(FILE **);
+    boost::python::list scan_stream(FILE **, PatternSet&);
+    boost::python::tuple compare_unordered(char *, FILE **, size_t);
+    boost::python::object read_available(FILE **);
+    long readinto_stream(FILE **, boost::python::object);
     void print_stream(FILE **);
     bool close_stream(FILE **);
     void finish_process(int);
@@ -57,7 +138,7 @@ protected:
 
 public:
     Process(std::vector<std::string>);
-    Process(std::vector<std::string>, std::string);
+    Process(std::vector<std::string>, std::string, bool captureFile=false);
     virtual ~Process();
     virtual void init();
     pid_t get_pid();
@@ -70,6 +151,20 @@ public:
     bool expect_stderr_file(char *);
     std::string readline_stdout();
     std::string readline_stderr();
+    boost::python::object readline_stdout_timeout(long);
+    boost::python::object readline_stderr_timeout(long);
+    boost::python::object read_stdout(long);
+    boost::python::object read_stderr(long);
+    boost::python::object read_available_stdout();
+    boost::python::object read_available_stderr();
+    long readinto_stdout(boost::python::object);
+    long readinto_stderr(boost::python::object);
+    boost::python::object capture_stdout();
+    boost::python::object capture_stderr();
+    boost::python::list scan_stdout(PatternSet&);
+    boost::python::list scan_stderr(PatternSet&);
+    boost::python::tuple compare_stdout_unordered(char *, size_t);
+    boost::python::tuple compare_stderr_unordered(char *, size_t);
     void print_stdout();
     void print_stderr();
     bool assert_exit_status(int);
@@ -82,22 +177,29 @@ public:
     void send_signal(int);
     void send_signal_group(int);
     void send_kill();
+    void close_process();
     bool check_signalled();
+    bool check_finished();
+    boost::python::tuple get_usage();
+    boost::python::object get_perf_counts();
     bool get_timeout();
+    std::string get_stall_reason();
 };
 
 class TimeoutProcess: public Process {
 protected:
     int timeout_duration;
+    int idleTimeout;
     pthread_t timeoutThread;
     bool timeoutStarted;
     void init_timeout();
     virtual void perform_timeout();
+    void watch_progress();
     static void *timeout_thread(void *);
 
 public:
     TimeoutProcess(std::vector<std::string>, int);
-    TimeoutProcess(std::vector<std::string>, int, std::string);
+    TimeoutProcess(std::vector<std::string>, int, std::string, bool captureFile=false, int idleTimeout=0);
     ~TimeoutProcess();
     virtual void init();
     int get_timeout_duration();
@@ -122,17 +224,50 @@ private:
 
 public:
     TracedProcess(std::vector<std::string>, int);
-    TracedProcess(std::vector<std::string>, int, std::string);
+    TracedProcess(std::vector<std::string>, int, std::string, bool captureFile=false, int idleTimeout=0);
     ~TracedProcess();
     virtual void init();
     std::set<pid_t> child_pids();
     boost::python::list child_pids_list();
 };
 
+/* Process table */
+boost::python::list scan_processes();
+bool sample_progress(pid_t, ProgressSample *, std::vector<pid_t>&, bool);
+bool set_child_subreaper();
+
+/* Network namespaces */
+pid_t create_network_namespace();
+void set_network_namespace(pid_t);
+int join_network_namespace();
+
+/* Hardware counters */
+void send_perf_counters(int);
+void receive_perf_counters(int, int *);
+long long read_perf_counter(int);
+
+/* Expected output cache */
+struct ExpectedFile {
+    ExpectedFile();
+    ~ExpectedFile();
+    bool matches(const struct stat&) const;
+
+    const char *data;
+    size_t size;
+    dev_t device;
+    ino_t inode;
+    struct timespec modified;
+    bool mapped;  // Whether data is a mapping of its own (not the fixture store)
+};
+boost::shared_ptr<ExpectedFile> load_expected_file(const char *);
+
+/* Readiness probes */
+bool wait_for_file(std::string, long);
+
 /* Factories */
-boost::shared_ptr<Process> create_process(std::vector<std::string> argv, std::string inputFile);
-boost::shared_ptr<TimeoutProcess> create_timeout_process(std::vector<std::string> argv, int timeout, std::string inputFile="");
-boost::shared_ptr<TracedProcess> create_traced_process(std::vector<std::string> argv, int timeout, std::string inputFile="");
+boost::shared_ptr<Process> create_process(std::vector<std::string> argv, std::string inputFile, bool captureFile=false);
+boost::shared_ptr<TimeoutProcess> create_timeout_process(std::vector<std::string> argv, int timeout, std::string inputFile="", bool captureFile=false, int idleTimeout=0);
+boost::shared_ptr<TracedProcess> create_traced_process(std::vector<std::string> argv, int timeout, std::string inputFile="", bool captureFile=false, int idleTimeout=0);
 
 /* Exceptions */
 struct CloseException {};
@@ -148,3 +283,4 @@ struct PipeException {};
 struct SignalException {};
 struct StreamException {};
 struct StreamFinishedException {};
+struct NamespaceException {};
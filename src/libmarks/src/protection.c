@@ -3,18 +3,330 @@
 #endif
 
 #include <stdio.h>
+#include <stdlib.h>
+#include <stdarg.h>
 #include <unistd.h>
+#include <fcntl.h>
+#include <sched.h>
+#include <time.h>
+#include <poll.h>
 #include <sys/types.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <sys/time.h>
+#include <sys/select.h>
 #include <signal.h>
 #include <errno.h>
 #include <dlfcn.h>
 
+/* Environment variable holding the maximum number of forks allowed */
+#define FORK_LIMIT_ENV "MARKS_FORK_LIMIT"
+/* Environment variable holding the name of the shared fork counter */
+#define FORK_COUNTER_ENV "MARKS_FORK_COUNTER"
+/* Environment variable holding the factor to speed up time by */
+#define TIME_SCALE_ENV "MARKS_TIME_SCALE"
+/* Environment variable holding the real and monotonic times (nanoseconds,
+ * as "real:monotonic") from which time is sped up */
+#define TIME_EPOCH_ENV "MARKS_TIME_EPOCH"
+
+#define NSEC_PER_SEC 1000000000LL
+/* Clocks below this are sped up (except the CPU time clocks) */
+#define MAX_CLOCK 16
+
+/* Type of the timezone argument of gettimeofday */
+#if defined(__GLIBC__) && __GLIBC__ == 2 && __GLIBC_MINOR__ < 31
+#define TIMEZONE_PTR __timezone_ptr_t
+#else
+#define TIMEZONE_PTR void *
+#endif
+
 /* Ugly hack to supress warning about void* to fn pointer */
 union orig_kill_function {
     void *sym;
     int (*fn)(pid_t, int);
 };
 
+union orig_fork_function {
+    void *sym;
+    pid_t (*fn)(void);
+};
+
+union orig_clone_function {
+    void *sym;
+    int (*fn)(int (*)(void *), void *, int, void *, ...);
+};
+
+union orig_clock_gettime_function {
+    void *sym;
+    int (*fn)(clockid_t, struct timespec *);
+};
+
+union orig_gettimeofday_function {
+    void *sym;
+    int (*fn)(struct timeval *, TIMEZONE_PTR);
+};
+
+union orig_time_function {
+    void *sym;
+    time_t (*fn)(time_t *);
+};
+
+union orig_nanosleep_function {
+    void *sym;
+    int (*fn)(const struct timespec *, struct timespec *);
+};
+
+union orig_clock_nanosleep_function {
+    void *sym;
+    int (*fn)(clockid_t, int, const struct timespec *, struct timespec *);
+};
+
+union orig_alarm_function {
+    void *sym;
+    unsigned int (*fn)(unsigned int);
+};
+
+union orig_setitimer_function {
+    void *sym;
+    int (*fn)(int, const struct itimerval *, struct itimerval *);
+};
+
+union orig_poll_function {
+    void *sym;
+    int (*fn)(struct pollfd *, nfds_t, int);
+};
+
+union orig_ppoll_function {
+    void *sym;
+    int (*fn)(struct pollfd *, nfds_t, const struct timespec *,
+            const sigset_t *);
+};
+
+union orig_select_function {
+    void *sym;
+    int (*fn)(int, fd_set *, fd_set *, fd_set *, struct timeval *);
+};
+
+union orig_pselect_function {
+    void *sym;
+    int (*fn)(int, fd_set *, fd_set *, fd_set *, const struct timespec *,
+            const sigset_t *);
+};
+
+/* Original functions, resolved once when the library is loaded */
+static union orig_kill_function orig_kill;
+static union orig_fork_function orig_fork;
+static union orig_clone_function orig_clone;
+static union orig_clock_gettime_function orig_clock_gettime;
+static union orig_gettimeofday_function orig_gettimeofday;
+static union orig_time_function orig_time;
+static union orig_nanosleep_function orig_nanosleep;
+static union orig_clock_nanosleep_function orig_clock_nanosleep;
+static union orig_alarm_function orig_alarm;
+static union orig_setitimer_function orig_setitimer;
+static union orig_poll_function orig_poll;
+static union orig_ppoll_function orig_ppoll;
+static union orig_select_function orig_select;
+static union orig_pselect_function orig_pselect;
+
+/* Fork limit (-1 for no limit) and counter shared by all descendants */
+static long fork_limit = -1;
+static volatile long *fork_count = NULL;
+
+/* Factor time is sped up by (1 when not sped up), and the time (in
+ * nanoseconds) of each clock from which it is sped up */
+static double time_scale = 1.0;
+static long long clock_epoch[MAX_CLOCK];
+
+/**
+ * Map a shared memory object holding the fork counter. The descriptor is
+ * closed once mapped, so none is left open in the program under test.
+ * @return 0 on success, -1 on failure.
+ */
+static int map_fork_counter(int fd)
+{
+    void *counter = MAP_FAILED;
+    struct stat st;
+
+    if (fstat(fd, &st) == 0 && st.st_size == sizeof(long)) {
+        counter = mmap(NULL, sizeof(long), PROT_READ | PROT_WRITE,
+                MAP_SHARED, fd, 0);
+    }
+    close(fd);
+    if (counter == MAP_FAILED) {
+        return -1;
+    }
+    fork_count = counter;
+    return 0;
+}
+
+/**
+ * Attach to the fork counter shared by the process tree. The counter is a
+ * named shared memory object, created by the marking process for each test
+ * (see process.cpp), whose name is passed down through the environment, so
+ * it is reopened after exec() as well as shared across fork(). If there is
+ * no counter (libprotect was preloaded some other way), one is created that
+ * is shared across fork() only.
+ */
+static void attach_fork_counter(void)
+{
+    char *name = getenv(FORK_COUNTER_ENV);
+
+    if (name != NULL && *name != '\0') {
+        int fd = shm_open(name, O_RDWR, 0);
+        if (fd != -1 && map_fork_counter(fd) == 0) {
+            return;
+        }
+    }
+
+    fork_count = mmap(NULL, sizeof(long), PROT_READ | PROT_WRITE,
+            MAP_SHARED | MAP_ANON, -1, 0);
+    if (fork_count == MAP_FAILED) {
+        fork_count = NULL;
+    }
+}
+
+static long long timespec_ns(const struct timespec *ts)
+{
+    return ts->tv_sec * NSEC_PER_SEC + ts->tv_nsec;
+}
+
+static struct timespec ns_timespec(long long ns)
+{
+    struct timespec ts;
+    ts.tv_sec = ns / NSEC_PER_SEC;
+    ts.tv_nsec = ns % NSEC_PER_SEC;
+    if (ts.tv_nsec < 0) {
+        ts.tv_sec -= 1;
+        ts.tv_nsec += NSEC_PER_SEC;
+    }
+    return ts;
+}
+
+/**
+ * Check if a clock is sped up. Time spent running (CPU time) is not.
+ */
+static int scaled_clock(clockid_t clock)
+{
+    return time_scale != 1.0 && clock >= 0 && clock < MAX_CLOCK &&
+        clock != CLOCK_PROCESS_CPUTIME_ID && clock != CLOCK_THREAD_CPUTIME_ID;
+}
+
+/* Convert between a sped up (virtual) time and the real time of a clock */
+static long long virtual_time(clockid_t clock, long long ns)
+{
+    return clock_epoch[clock] + (long long) ((ns - clock_epoch[clock]) * time_scale);
+}
+
+static long long real_time(clockid_t clock, long long ns)
+{
+    return clock_epoch[clock] + (long long) ((ns - clock_epoch[clock]) / time_scale);
+}
+
+/* Convert a sped up duration to the real duration, and back */
+static long long real_duration(long long ns)
+{
+    return (long long) (ns / time_scale);
+}
+
+static long long virtual_duration(long long ns)
+{
+    return (long long) (ns * time_scale);
+}
+
+/**
+ * Load the factor to speed up time by, if set. Time is sped up from the
+ * same moment in every process of the tested program (and in every program
+ * started by a test), so they all see the same sped up time. The first
+ * process sets the moment for its descendants, if the test has not.
+ */
+static void init_time_scale(void)
+{
+    char *scale = getenv(TIME_SCALE_ENV);
+    if (scale == NULL || *scale == '\0')
+        return;
+    double value = atof(scale);
+    if (value <= 0 || value == 1.0 || orig_clock_gettime.sym == NULL)
+        return;
+
+    struct timespec ts;
+    (*orig_clock_gettime.fn)(CLOCK_REALTIME, &ts);
+    long long realNow = timespec_ns(&ts);
+    (*orig_clock_gettime.fn)(CLOCK_MONOTONIC, &ts);
+    long long monoNow = timespec_ns(&ts);
+
+    long long realEpoch, monoEpoch;
+    char *epoch = getenv(TIME_EPOCH_ENV);
+    if (epoch == NULL ||
+            sscanf(epoch, "%lld:%lld", &realEpoch, &monoEpoch) != 2) {
+        char value[48];
+        realEpoch = realNow;
+        monoEpoch = monoNow;
+        snprintf(value, sizeof(value), "%lld:%lld", realEpoch, monoEpoch);
+        setenv(TIME_EPOCH_ENV, value, 1);
+    }
+
+    // Other clocks are sped up from the same moment as the monotonic clock.
+    long long elapsed = monoNow - monoEpoch;
+    for (clockid_t clock = 0; clock < MAX_CLOCK; ++clock) {
+        if ((*orig_clock_gettime.fn)(clock, &ts) == 0)
+            clock_epoch[clock] = timespec_ns(&ts) - elapsed;
+    }
+    clock_epoch[CLOCK_REALTIME] = realEpoch;
+    clock_epoch[CLOCK_MONOTONIC] = monoEpoch;
+    time_scale = value;
+}
+
+/**
+ * Resolve the original functions and load the fork limit once, rather than
+ * on every call.
+ */
+__attribute__((constructor))
+static void protect_init(void)
+{
+    orig_kill.sym = dlsym(RTLD_NEXT, "kill");
+    orig_fork.sym = dlsym(RTLD_NEXT, "fork");
+    orig_clone.sym = dlsym(RTLD_NEXT, "clone");
+    orig_clock_gettime.sym = dlsym(RTLD_NEXT, "clock_gettime");
+    orig_gettimeofday.sym = dlsym(RTLD_NEXT, "gettimeofday");
+    orig_time.sym = dlsym(RTLD_NEXT, "time");
+    orig_nanosleep.sym = dlsym(RTLD_NEXT, "nanosleep");
+    orig_clock_nanosleep.sym = dlsym(RTLD_NEXT, "clock_nanosleep");
+    orig_alarm.sym = dlsym(RTLD_NEXT, "alarm");
+    orig_setitimer.sym = dlsym(RTLD_NEXT, "setitimer");
+    orig_poll.sym = dlsym(RTLD_NEXT, "poll");
+    orig_ppoll.sym = dlsym(RTLD_NEXT, "ppoll");
+    orig_select.sym = dlsym(RTLD_NEXT, "select");
+    orig_pselect.sym = dlsym(RTLD_NEXT, "pselect");
+
+    char *limit = getenv(FORK_LIMIT_ENV);
+    if (limit != NULL && *limit != '\0') {
+        fork_limit = atol(limit);
+        attach_fork_counter();
+    }
+
+    init_time_scale();
+}
+
+/**
+ * Count a new process against the fork limit.
+ * @return 0 if the process may be created, -1 (with errno set to EAGAIN)
+ *         if the limit has been reached.
+ */
+static int count_fork(void)
+{
+    if (fork_limit < 0 || fork_count == NULL) {
+        return 0;
+    }
+
+    if (__sync_add_and_fetch(fork_count, 1) > fork_limit) {
+        __sync_sub_and_fetch(fork_count, 1);
+        errno = EAGAIN;
+        return -1;
+    }
+    return 0;
+}
+
 /**
  * Safer version of kill.
  * Do not allow all processes to be signalled (pid == -1).
@@ -29,7 +341,257 @@ int kill(pid_t pid, int sig)
         pid = -getpgrp();
     }
 
-    union orig_kill_function orig_kill;
-    orig_kill.sym = dlsym(RTLD_NEXT, "kill");
+    if (orig_kill.sym == NULL) {
+        /* Called before the library was initialised. */
+        orig_kill.sym = dlsym(RTLD_NEXT, "kill");
+    }
     return (*orig_kill.fn)(pid, sig);
 }
+
+/**
+ * Limited version of fork.
+ * Fail with EAGAIN once the process tree has forked too many times.
+ */
+pid_t fork(void)
+{
+    if (orig_fork.sym == NULL) {
+        /* Called before the library was initialised. */
+        orig_fork.sym = dlsym(RTLD_NEXT, "fork");
+    }
+
+    if (count_fork() == -1) {
+        return -1;
+    }
+    return (*orig_fork.fn)();
+}
+
+/**
+ * Limited version of vfork.
+ * The child of vfork cannot safely return from this wrapper, so a full
+ * fork is performed instead, which is a valid implementation of vfork.
+ */
+pid_t vfork(void)
+{
+    return fork();
+}
+
+/**
+ * Limited version of clone.
+ * New threads are not counted, only new processes.
+ */
+int clone(int (*fn)(void *), void *stack, int flags, void *arg, ...)
+{
+    va_list ap;
+    va_start(ap, arg);
+    pid_t *ptid = va_arg(ap, pid_t *);
+    void *tls = va_arg(ap, void *);
+    pid_t *ctid = va_arg(ap, pid_t *);
+    va_end(ap);
+
+    if (orig_clone.sym == NULL) {
+        /* Called before the library was initialised. */
+        orig_clone.sym = dlsym(RTLD_NEXT, "clone");
+    }
+
+    if (!(flags & CLONE_THREAD) && count_fork() == -1) {
+        return -1;
+    }
+    return (*orig_clone.fn)(fn, stack, flags, arg, ptid, tls, ctid);
+}
+
+/**
+ * Sped up versions of the clocks.
+ * Clocks run time_scale times faster than real time (from the moment
+ * time was first sped up), so waiting for a time to pass takes
+ * correspondingly less real time.
+ */
+int clock_gettime(clockid_t clock, struct timespec *ts)
+{
+    if (orig_clock_gettime.sym == NULL)
+        orig_clock_gettime.sym = dlsym(RTLD_NEXT, "clock_gettime");
+
+    int result = (*orig_clock_gettime.fn)(clock, ts);
+    if (result == 0 && scaled_clock(clock))
+        *ts = ns_timespec(virtual_time(clock, timespec_ns(ts)));
+    return result;
+}
+
+int gettimeofday(struct timeval *tv, TIMEZONE_PTR tz)
+{
+    if (orig_gettimeofday.sym == NULL)
+        orig_gettimeofday.sym = dlsym(RTLD_NEXT, "gettimeofday");
+
+    int result = (*orig_gettimeofday.fn)(tv, tz);
+    if (result == 0 && scaled_clock(CLOCK_REALTIME)) {
+        long long ns = virtual_time(CLOCK_REALTIME,
+                tv->tv_sec * NSEC_PER_SEC + tv->tv_usec * 1000LL);
+        tv->tv_sec = ns / NSEC_PER_SEC;
+        tv->tv_usec = (ns % NSEC_PER_SEC) / 1000;
+    }
+    return result;
+}
+
+time_t time(time_t *t)
+{
+    if (orig_time.sym == NULL)
+        orig_time.sym = dlsym(RTLD_NEXT, "time");
+
+    if (!scaled_clock(CLOCK_REALTIME))
+        return (*orig_time.fn)(t);
+
+    struct timespec ts;
+    clock_gettime(CLOCK_REALTIME, &ts);
+    if (t != NULL)
+        *t = ts.tv_sec;
+    return ts.tv_sec;
+}
+
+/**
+ * Sped up versions of sleeping.
+ * The time remaining when interrupted is given in sped up time.
+ */
+int nanosleep(const struct timespec *req, struct timespec *rem)
+{
+    if (orig_nanosleep.sym == NULL)
+        orig_nanosleep.sym = dlsym(RTLD_NEXT, "nanosleep");
+
+    if (time_scale == 1.0 || req == NULL)
+        return (*orig_nanosleep.fn)(req, rem);
+
+    struct timespec realReq = ns_timespec(real_duration(timespec_ns(req)));
+    int result = (*orig_nanosleep.fn)(&realReq, rem);
+    if (result == -1 && errno == EINTR && rem != NULL)
+        *rem = ns_timespec(virtual_duration(timespec_ns(rem)));
+    return result;
+}
+
+int clock_nanosleep(clockid_t clock, int flags, const struct timespec *req,
+        struct timespec *rem)
+{
+    if (orig_clock_nanosleep.sym == NULL)
+        orig_clock_nanosleep.sym = dlsym(RTLD_NEXT, "clock_nanosleep");
+
+    if (!scaled_clock(clock) || req == NULL)
+        return (*orig_clock_nanosleep.fn)(clock, flags, req, rem);
+
+    struct timespec realReq;
+    if (flags & TIMER_ABSTIME)
+        realReq = ns_timespec(real_time(clock, timespec_ns(req)));
+    else
+        realReq = ns_timespec(real_duration(timespec_ns(req)));
+    int result = (*orig_clock_nanosleep.fn)(clock, flags, &realReq, rem);
+    if (result == EINTR && rem != NULL && !(flags & TIMER_ABSTIME))
+        *rem = ns_timespec(virtual_duration(timespec_ns(rem)));
+    return result;
+}
+
+unsigned int sleep(unsigned int seconds)
+{
+    struct timespec req = {seconds, 0}, rem = {0, 0};
+    if (nanosleep(&req, &rem) == -1)
+        return rem.tv_sec + (rem.tv_nsec > 0);
+    return 0;
+}
+
+int usleep(useconds_t usec)
+{
+    struct timespec req = ns_timespec(usec * 1000LL);
+    return nanosleep(&req, NULL);
+}
+
+/**
+ * Sped up version of alarm, delivering SIGALRM after the sped up time.
+ */
+unsigned int alarm(unsigned int seconds)
+{
+    if (orig_alarm.sym == NULL)
+        orig_alarm.sym = dlsym(RTLD_NEXT, "alarm");
+    if (orig_setitimer.sym == NULL)
+        orig_setitimer.sym = dlsym(RTLD_NEXT, "setitimer");
+
+    if (time_scale == 1.0)
+        return (*orig_alarm.fn)(seconds);
+
+    struct itimerval value, old;
+    long long ns = real_duration(seconds * NSEC_PER_SEC);
+    value.it_interval.tv_sec = value.it_interval.tv_usec = 0;
+    value.it_value.tv_sec = ns / NSEC_PER_SEC;
+    value.it_value.tv_usec = (ns % NSEC_PER_SEC) / 1000;
+    if (seconds > 0 && value.it_value.tv_sec == 0 && value.it_value.tv_usec == 0)
+        value.it_value.tv_usec = 1;
+    if ((*orig_setitimer.fn)(ITIMER_REAL, &value, &old) == -1)
+        return 0;
+
+    // Round the time that was left to the nearest second, as alarm() does.
+    ns = virtual_duration(old.it_value.tv_sec * NSEC_PER_SEC +
+            old.it_value.tv_usec * 1000LL);
+    if (ns > 0 && ns < NSEC_PER_SEC)
+        return 1;
+    return (ns + NSEC_PER_SEC / 2) / NSEC_PER_SEC;
+}
+
+/**
+ * Sped up versions of waiting for files, with timeouts in sped up time.
+ */
+int poll(struct pollfd *fds, nfds_t nfds, int timeout)
+{
+    if (orig_poll.sym == NULL)
+        orig_poll.sym = dlsym(RTLD_NEXT, "poll");
+
+    if (time_scale != 1.0 && timeout > 0) {
+        // Wait at least 1ms, so a timeout is never turned into a poll.
+        long long ms = real_duration(timeout * 1000000LL) / 1000000;
+        timeout = ms > 0 ? (int) ms : 1;
+    }
+    return (*orig_poll.fn)(fds, nfds, timeout);
+}
+
+int ppoll(struct pollfd *fds, nfds_t nfds, const struct timespec *timeout,
+        const sigset_t *sigmask)
+{
+    if (orig_ppoll.sym == NULL)
+        orig_ppoll.sym = dlsym(RTLD_NEXT, "ppoll");
+
+    if (time_scale == 1.0 || timeout == NULL)
+        return (*orig_ppoll.fn)(fds, nfds, timeout, sigmask);
+
+    struct timespec realTimeout = ns_timespec(real_duration(timespec_ns(timeout)));
+    return (*orig_ppoll.fn)(fds, nfds, &realTimeout, sigmask);
+}
+
+int select(int nfds, fd_set *readfds, fd_set *writefds, fd_set *exceptfds,
+        struct timeval *timeout)
+{
+    if (orig_select.sym == NULL)
+        orig_select.sym = dlsym(RTLD_NEXT, "select");
+
+    if (time_scale == 1.0 || timeout == NULL)
+        return (*orig_select.fn)(nfds, readfds, writefds, exceptfds, timeout);
+
+    // Linux updates the timeout to the time not slept, so scale it back.
+    long long ns = real_duration(timeout->tv_sec * NSEC_PER_SEC +
+            timeout->tv_usec * 1000LL);
+    timeout->tv_sec = ns / NSEC_PER_SEC;
+    timeout->tv_usec = (ns % NSEC_PER_SEC) / 1000;
+    int result = (*orig_select.fn)(nfds, readfds, writefds, exceptfds, timeout);
+    ns = virtual_duration(timeout->tv_sec * NSEC_PER_SEC +
+            timeout->tv_usec * 1000LL);
+    timeout->tv_sec = ns / NSEC_PER_SEC;
+    timeout->tv_usec = (ns % NSEC_PER_SEC) / 1000;
+    return result;
+}
+
+int pselect(int nfds, fd_set *readfds, fd_set *writefds, fd_set *exceptfds,
+        const struct timespec *timeout, const sigset_t *sigmask)
+{
+    if (orig_pselect.sym == NULL)
+        orig_pselect.sym = dlsym(RTLD_NEXT, "pselect");
+
+    if (time_scale == 1.0 || timeout == NULL)
+        return (*orig_pselect.fn)(nfds, readfds, writefds, exceptfds, timeout,
+                sigmask);
+
+    struct timespec realTimeout = ns_timespec(real_duration(timespec_ns(timeout)));
+    return (*orig_pselect.fn)(nfds, readfds, writefds, exceptfds, &realTimeout,
+            sigmask);
+}
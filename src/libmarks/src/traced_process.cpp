@@ -26,16 +26,16 @@
 /** Traced Process **/
 
 /* Use to create a new Process, so init() is called */
-boost::shared_ptr<TracedProcess> create_traced_process(std::vector<std::string> argv, int timeout, std::string inputFile)
+boost::shared_ptr<TracedProcess> create_traced_process(std::vector<std::string> argv, int timeout, std::string inputFile, bool captureFile, int idleTimeout)
 {
-    boost::shared_ptr<TracedProcess> p(new TracedProcess(argv, timeout, inputFile));
+    boost::shared_ptr<TracedProcess> p(new TracedProcess(argv, timeout, inputFile, captureFile, idleTimeout));
     p->init();
     return p;
 }
 
 /* Public */
-TracedProcess::TracedProcess(std::vector<std::string> argv, int timeout, std::string inputFile):
-    TimeoutProcess(argv, timeout, inputFile), traceStarted(false)
+TracedProcess::TracedProcess(std::vector<std::string> argv, int timeout, std::string inputFile, bool captureFile, int idleTimeout):
+    TimeoutProcess(argv, timeout, inputFile, captureFile, idleTimeout), traceStarted(false)
 {
 }
 
@@ -136,7 +136,8 @@ void TracedProcess::trace_child()
     D("Time to start tracing the child " << childPid << std::endl);
 
     while (1) {
-        pid_t pid = waitpid(-1, &status, __WALL);
+        struct rusage childUsage;
+        pid_t pid = wait4(-1, &status, __WALL, &childUsage);
         D("Wait happened: " << pid << " (" << status << ")" << std::endl);
 
         if (pid < 0) {
@@ -157,6 +158,7 @@ void TracedProcess::trace_child()
 
             if (pid == childPid) {
                 // Main child has finished, so run final tests.
+                usage = childUsage;
                 finish_process(status);
             } else if (children.erase(pid) != 1) {
                 D("\tCould not erase child " << pid << std::endl);
@@ -174,6 +176,7 @@ void TracedProcess::trace_child()
 
             if (pid == childPid) {
                 // Main child has finished, so run final tests.
+                usage = childUsage;
                 finish_process(status);
             } else if (children.erase(pid) != 1) {
                 D("Could not erase child " << pid << std::endl);